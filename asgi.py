@@ -0,0 +1,10 @@
+"""
+Provide the ASGI entry point of the Pygate application, for example
+`uvicorn asgi:application`. Downloads and resumable upload chunks are then
+streamed on the event loop; all other requests go to the Flask application.
+"""
+
+from pygate import create_app
+from pygate.aio import AsyncApplication
+
+application = AsyncApplication(create_app())
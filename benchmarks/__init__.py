@@ -0,0 +1,3 @@
+"""
+Benchmarks of the Pygate application, run with `python -m benchmarks.run`
+"""
@@ -0,0 +1,264 @@
+"""
+Serve the Powergate calls made by the Pygate application from an in-process
+gRPC server, with a configurable latency per call and throughput for file
+transfers, so the application can be benchmarked without a Powergate node
+"""
+
+import hashlib
+import threading
+import time
+import uuid
+from concurrent import futures
+import grpc
+from pygate_grpc import ffs as ffs_client
+from pygate_grpc import health as health_client
+from pygate_grpc import wallet as wallet_client
+
+CHUNK_SIZE = 1024 * 1024  # 1MB
+
+ffs_rpc_pb2 = ffs_client.ffs_rpc_pb2
+ffs_rpc_pb2_grpc = ffs_client.ffs_rpc_pb2_grpc
+wallet_rpc_pb2 = wallet_client.wallet_rpc_pb2
+wallet_rpc_pb2_grpc = wallet_client.wallet_rpc_pb2_grpc
+health_rpc_pb2 = health_client.health_rpc_pb2
+health_rpc_pb2_grpc = health_client.health_rpc_pb2_grpc
+
+
+def reply(module, method, **fields):
+    """
+    Build the response message of an RPC method of a Powergate service.
+    Message names differ between Powergate releases, so they are looked up
+    from the service descriptor.
+    """
+
+    service = module.DESCRIPTOR.services_by_name["RPCService"]
+    output_type = service.methods_by_name[method].output_type
+
+    return getattr(module, output_type.name)(**fields)
+
+
+def reply_field(module, method):
+    """
+    Return the name of the only field of the response of an RPC method
+    """
+
+    service = module.DESCRIPTOR.services_by_name["RPCService"]
+
+    return service.methods_by_name[method].output_type.fields[0].name
+
+
+class FakePowergate(object):
+    """
+    An in-process Powergate answering every call after `latency` seconds and
+    sending or receiving files at up to `throughput` bytes per second (no
+    limit if None). Files are known by size only; their content is zeros.
+    """
+
+    def __init__(self, latency=0.0, throughput=None, max_workers=32):
+        self.latency = latency
+        self.throughput = throughput
+        self.max_workers = max_workers
+        self.server = None
+        self._files = {}
+        self._ffses = {}
+        self._lock = threading.Lock()
+
+    def add_file(self, cid, size):
+        """
+        Make a file of `size` bytes retrievable under `cid`
+        """
+
+        with self._lock:
+            self._files[cid] = size
+
+    def file_size(self, cid):
+        with self._lock:
+            return self._files.get(cid)
+
+    def wallet(self, token):
+        """
+        Return the wallet address of the FFS with `token`, making one up for
+        FFSes created outside of this server
+        """
+
+        with self._lock:
+            return self._ffses.setdefault(
+                token, "t3" + hashlib.sha256(token.encode()).hexdigest()[:40]
+            )
+
+    def start(self, address="127.0.0.1:0"):
+        """
+        Start serving on `address` and return the address to connect to
+        """
+
+        self.server = grpc.server(
+            futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        )
+        ffs_rpc_pb2_grpc.add_RPCServiceServicer_to_server(FfsService(self), self.server)
+        wallet_rpc_pb2_grpc.add_RPCServiceServicer_to_server(
+            WalletService(self), self.server
+        )
+        health_rpc_pb2_grpc.add_RPCServiceServicer_to_server(
+            HealthService(self), self.server
+        )
+        host = address.rpartition(":")[0]
+        port = self.server.add_insecure_port(address)
+        self.server.start()
+
+        return "{}:{}".format(host, port)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop(grace=None)
+            self.server = None
+
+    def wait(self):
+        """
+        Sleep for the latency of one call
+        """
+
+        if self.latency:
+            time.sleep(self.latency)
+
+    def transfer(self, size):
+        """
+        Sleep for as long as moving `size` bytes takes at the throughput
+        """
+
+        if self.throughput:
+            time.sleep(size / self.throughput)
+
+
+def _token(context):
+    metadata = dict(context.invocation_metadata())
+
+    return metadata.get(ffs_client.TOKEN_KEY, "")
+
+
+class FfsService(ffs_rpc_pb2_grpc.RPCServiceServicer):
+    """
+    The FFS calls used by the application. Calls renamed between Powergate
+    releases are answered under both names.
+    """
+
+    def __init__(self, powergate):
+        self.powergate = powergate
+
+    def Create(self, request, context):
+        self.powergate.wait()
+        token = str(uuid.uuid4())
+        self.powergate.wallet(token)
+
+        return reply(ffs_rpc_pb2, "Create", id=str(uuid.uuid4()), token=token)
+
+    def Addrs(self, request, context):
+        self.powergate.wait()
+        address = {
+            "name": "Initial Address",
+            "addr": self.powergate.wallet(_token(context)),
+            "type": "bls",
+        }
+
+        return reply(ffs_rpc_pb2, "Addrs", addrs=[address])
+
+    def DefaultConfig(self, request, context, method="DefaultConfig"):
+        self.powergate.wait()
+        config = {
+            "hot": {"enabled": True, "ipfs": {"add_timeout": 30}},
+            "cold": {
+                "enabled": True,
+                "filecoin": {
+                    "rep_factor": 1,
+                    "deal_min_duration": 1000,
+                    "addr": self.powergate.wallet(_token(context)),
+                },
+            },
+        }
+        field = reply_field(ffs_rpc_pb2, method)
+
+        return reply(ffs_rpc_pb2, method, **{field: config})
+
+    def DefaultStorageConfig(self, request, context):
+        return self.DefaultConfig(request, context, method="DefaultStorageConfig")
+
+    def SetDefaultConfig(self, request, context, method="SetDefaultConfig"):
+        self.powergate.wait()
+
+        return reply(ffs_rpc_pb2, method)
+
+    def SetDefaultStorageConfig(self, request, context):
+        return self.SetDefaultConfig(
+            request, context, method="SetDefaultStorageConfig"
+        )
+
+    def Stage(self, request_iterator, context, method="Stage"):
+        self.powergate.wait()
+        digest = hashlib.sha256()
+        size = 0
+        for request in request_iterator:
+            digest.update(request.chunk)
+            size += len(request.chunk)
+            self.powergate.transfer(len(request.chunk))
+        cid = "bafk" + digest.hexdigest()[:55]
+        self.powergate.add_file(cid, size)
+
+        return reply(ffs_rpc_pb2, method, cid=cid)
+
+    def AddToHot(self, request_iterator, context):
+        return self.Stage(request_iterator, context, method="AddToHot")
+
+    def PushStorageConfig(self, request, context, method="PushStorageConfig"):
+        self.powergate.wait()
+
+        return reply(ffs_rpc_pb2, method, job_id=str(uuid.uuid4()))
+
+    def PushConfig(self, request, context):
+        return self.PushStorageConfig(request, context, method="PushConfig")
+
+    def Get(self, request, context):
+        self.powergate.wait()
+        size = self.powergate.file_size(request.cid)
+        if size is None:
+            context.abort(grpc.StatusCode.NOT_FOUND, "stored item not found")
+
+        chunk = bytes(CHUNK_SIZE)
+        while size > 0:
+            length = min(size, CHUNK_SIZE)
+            self.powergate.transfer(length)
+            yield reply(ffs_rpc_pb2, "Get", chunk=chunk[:length])
+            size -= length
+
+    def ShowAll(self, request, context):
+        self.powergate.wait()
+
+        return reply(ffs_rpc_pb2, "ShowAll")
+
+    def WatchJobs(self, request, context):
+        # Every storage job succeeds as soon as it is watched
+        self.powergate.wait()
+        for job_id in request.jids:
+            job = {"id": job_id, "status": ffs_rpc_pb2.JOB_STATUS_SUCCESS}
+            yield reply(ffs_rpc_pb2, "WatchJobs", job=job)
+
+        while context.is_active():
+            time.sleep(1)
+
+
+class WalletService(wallet_rpc_pb2_grpc.RPCServiceServicer):
+    def __init__(self, powergate):
+        self.powergate = powergate
+
+    def Balance(self, request, context):
+        self.powergate.wait()
+
+        return reply(wallet_rpc_pb2, "Balance", balance=4000000000)
+
+
+class HealthService(health_rpc_pb2_grpc.RPCServiceServicer):
+    def __init__(self, powergate):
+        self.powergate = powergate
+
+    def Check(self, request, context):
+        self.powergate.wait()
+
+        return reply(health_rpc_pb2, "Check")
@@ -0,0 +1,517 @@
+"""
+Benchmark the hot paths of the Pygate application against a fake Powergate,
+reporting latency percentiles and requests per second per route, file size
+and table size. Run from the repository root:
+
+    python -m benchmarks.run --rows 1000,100000 --sizes 4K,1M --latency 0.005
+
+Save the results with --json and pass them as --baseline to a later run to
+fail it when a route got slower. A run fails whenever requests failed, as
+their timings are not comparable.
+"""
+
+import argparse
+import io
+import json
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from benchmarks.fake_powergate import FakePowergate
+
+ROUTES = ("files", "api_files", "api_logs", "wallets", "config", "download", "upload")
+
+# Routes whose cost depends on the size of the files they move
+SIZED_ROUTES = ("download", "upload")
+
+SEED_BATCH = 10000
+
+UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(text):
+    """
+    Read a size such as 512, 4K or 16M as a number of bytes
+    """
+
+    text = text.strip().upper().rstrip("B")
+    unit = text[-1:] if text[-1:] in UNITS else ""
+
+    return int(float(text[: len(text) - len(unit)]) * UNITS[unit])
+
+
+def format_size(size):
+    for unit in ("G", "M", "K"):
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return "{}{}".format(size // UNITS[unit], unit)
+
+    return str(size)
+
+
+def percentile(values, p):
+    """
+    Return the nearest-rank `p`th percentile of sorted `values`
+    """
+
+    rank = max(int(math.ceil(p / 100 * len(values))), 1)
+
+    return values[rank - 1]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.run", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument(
+        "--routes",
+        default=",".join(ROUTES),
+        help="comma-separated routes to benchmark (default: all of %(default)s)",
+    )
+    parser.add_argument(
+        "--rows",
+        default="1000,100000",
+        help="numbers of files and log entries to seed (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--sizes",
+        default="4K,256K,4M",
+        help="file sizes to download and upload (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--ffs", type=int, default=4, help="number of FFSes (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=100,
+        help="requests measured per benchmark (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=5,
+        help="requests sent before measuring (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="requests in flight at once (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="seconds the fake Powergate takes per call (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--throughput",
+        type=parse_size,
+        default=None,
+        help="bytes per second the fake Powergate sends or receives files at, "
+        "e.g. 100M (default: no limit)",
+    )
+    parser.add_argument("--json", metavar="PATH", help="write the results to PATH")
+    parser.add_argument(
+        "--baseline",
+        metavar="PATH",
+        help="compare with the results of an earlier run, exiting with status 1 "
+        "if any benchmark got slower or had failed requests",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="slowdown against the baseline allowed before it counts as a "
+        "regression (default: %(default)s)",
+    )
+
+    args = parser.parse_args(argv)
+    args.routes = [route.strip() for route in args.routes.split(",") if route]
+    unknown = set(args.routes) - set(ROUTES)
+    if unknown:
+        parser.error("unknown routes: " + ", ".join(sorted(unknown)))
+    args.rows = sorted(int(rows) for rows in args.rows.split(","))
+    args.sizes = [parse_size(size) for size in args.sizes.split(",")]
+
+    return args
+
+
+def load_app(workdir, powergate_address):
+    """
+    Import the application configured to use a database and directories in
+    `workdir` and the fake Powergate
+    """
+
+    # Read by config.py on import
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(workdir, "bench.db")
+    os.environ["POWERGATE_ADDRESS"] = powergate_address
+
+    from pygate import create_app
+
+    app = create_app()
+    app.config.update(
+        UPLOADDIR=os.path.join(workdir, "uploads/"),
+        DOWNLOADDIR=os.path.join(workdir, "downloads/"),
+        LOG_ARCHIVE_DIR=os.path.join(workdir, "logs_archive/"),
+        WORKER_LOCK_FILE=os.path.join(workdir, "pygate.lock"),
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        WTF_CSRF_ENABLED=False,
+        STORAGE_WATCH=False,
+    )
+
+    return app
+
+
+def seed(powergate, ffs_count, rows, sizes):
+    """
+    Fill the FFS, files and logs tables up to `rows` files and log entries,
+    adding one file per size in `sizes` for the downloads
+    """
+
+    from pygate import db
+    from pygate.models import Ffs, Files, Logs
+
+    ffses = Ffs.query.order_by(Ffs.id).all()
+    for i in range(len(ffses), ffs_count):
+        ffs = Ffs(
+            ffs_id="bench-ffs-{}".format(i),
+            token="bench-token-{}".format(i),
+            creation_date=datetime.now().replace(microsecond=0),
+            default=i == 0,
+        )
+        db.session.add(ffs)
+        ffses.append(ffs)
+    db.session.commit()
+
+    for size in sizes:
+        cid = download_cid(size)
+        powergate.add_file(cid, size)
+        if Files.query.filter_by(CID=cid).first() is None:
+            db.session.add(
+                Files(
+                    file_path=None,
+                    file_name="bench-{}.bin".format(format_size(size)),
+                    upload_date=datetime.now().replace(microsecond=0),
+                    file_size=size,
+                    CID=cid,
+                    ffs_id=ffses[0].id,
+                    storage_status="success",
+                )
+            )
+    db.session.commit()
+
+    started = datetime(2020, 1, 1)
+    files = Files.query.count()
+    while files < rows:
+        count = min(SEED_BATCH, rows - files)
+        db.session.execute(
+            Files.__table__.insert(),
+            [
+                {
+                    "file_name": "file-{}.bin".format(i),
+                    "upload_date": started + timedelta(minutes=i),
+                    "file_size": sizes[i % len(sizes)],
+                    "CID": "bench-cid-{}".format(i),
+                    "ffs_id": ffses[i % len(ffses)].id,
+                    "storage_status": "success",
+                }
+                for i in range(files, files + count)
+            ],
+        )
+        db.session.commit()
+        files += count
+
+    logs = Logs.query.count()
+    while logs < rows:
+        count = min(SEED_BATCH, rows - logs)
+        db.session.execute(
+            Logs.__table__.insert(),
+            [
+                {
+                    "timestamp": started + timedelta(minutes=i),
+                    "event": "Uploaded file-{0}.bin to Filecoin. "
+                    "CID: bench-cid-{0}".format(i),
+                }
+                for i in range(logs, logs + count)
+            ],
+        )
+        db.session.commit()
+        logs += count
+
+
+def download_cid(size):
+    return "bench-download-{}".format(size)
+
+
+def route_request(route, size, number):
+    """
+    Return the test client method, URL and arguments of request `number` of
+    a benchmark
+    """
+
+    if route == "files":
+        return "get", "/files", {}
+    if route == "api_files":
+        return "get", "/api/files?start=0&length=50", {}
+    if route == "api_logs":
+        return "get", "/api/logs?start=0&length=50", {}
+    if route == "wallets":
+        return "get", "/wallets", {}
+    if route == "config":
+        return "get", "/config", {}
+    if route == "download":
+        return "get", "/download/" + download_cid(size), {}
+
+    # Each upload is different, so none of them is recorded as a duplicate
+    content = number.to_bytes(8, "big") + bytes(max(size - 8, 0))
+    data = {"uploadfile": (io.BytesIO(content), "upload-{}.bin".format(number))}
+
+    return "post", "/files", {"data": data, "content_type": "multipart/form-data"}
+
+
+def run_benchmark(app, route, size, args):
+    """
+    Send the requests of one benchmark from `args.concurrency` threads and
+    return its results
+    """
+
+    clients = threading.local()
+    counter = iter(range(sys.maxsize))
+    counter_lock = threading.Lock()
+
+    def send():
+        if not hasattr(clients, "client"):
+            clients.client = app.test_client()
+        with counter_lock:
+            number = next(counter)
+        method, url, kwargs = route_request(route, size, number)
+
+        started = time.perf_counter()
+        response = getattr(clients.client, method)(url, **kwargs)
+        response.get_data()
+        elapsed = time.perf_counter() - started
+        response.close()
+
+        ok = response.status_code < 400
+        if route == "download":
+            # Failed retrievals are reported on the files page
+            ok = ok and response.mimetype == "application/octet-stream"
+
+        return elapsed, ok
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(lambda _: send(), range(args.warmup)))
+
+        started = time.perf_counter()
+        results = list(executor.map(lambda _: send(), range(args.requests)))
+        wall = time.perf_counter() - started
+
+    latencies = sorted(elapsed for elapsed, _ in results)
+
+    return {
+        "route": route,
+        "file_size": size,
+        "requests": len(results),
+        "errors": sum(1 for _, ok in results if not ok),
+        "requests_per_second": round(len(results) / wall, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def wait_for_jobs(app, timeout=600):
+    """
+    Wait for the background jobs pushing uploads to finish, so they do not
+    slow down the next benchmark
+    """
+
+    from pygate import db
+    from pygate.jobs import QUEUED, RUNNING
+    from pygate.models import Jobs
+
+    deadline = time.monotonic() + timeout
+    with app.app_context():
+        while time.monotonic() < deadline:
+            db.session.expire_all()
+            if not Jobs.query.filter(Jobs.status.in_([QUEUED, RUNNING])).count():
+                return
+            time.sleep(0.1)
+
+
+def result_key(result):
+    return (result["rows"], result["route"], result["file_size"])
+
+
+def result_name(result):
+    name = result["route"]
+    if result["file_size"]:
+        name += " " + format_size(result["file_size"])
+
+    return name + " ({} rows)".format(result["rows"])
+
+
+def failures(results):
+    """
+    Return a description of each benchmark with failed requests
+    """
+
+    return [
+        "{}: {} of {} requests failed".format(
+            result_name(result), result["errors"], result["requests"]
+        )
+        for result in results
+        if result["errors"]
+    ]
+
+
+def print_results(results):
+    header = "{:>9}  {:<10} {:>6} {:>9} {:>10} {:>10} {:>10} {:>7}"
+    print(
+        header.format(
+            "rows", "route", "size", "requests", "req/s", "p50 ms", "p99 ms", "errors"
+        )
+    )
+    for result in results:
+        print(
+            header.format(
+                result["rows"],
+                result["route"],
+                format_size(result["file_size"]) if result["file_size"] else "-",
+                result["requests"],
+                "{:.1f}".format(result["requests_per_second"]),
+                "{:.2f}".format(result["p50_ms"]),
+                "{:.2f}".format(result["p99_ms"]),
+                result["errors"],
+            )
+        )
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return a description of each benchmark that is slower than in the
+    baseline by more than `tolerance` (a fraction), in p99 latency or in
+    requests per second, or that had failed requests in either run. Failed
+    requests may be fast or slow, so such timings are not compared.
+    """
+
+    previous = {result_key(result): result for result in baseline}
+    regressions = []
+
+    for result in results:
+        before = previous.get(result_key(result))
+        if before is None:
+            continue
+
+        name = result_name(result)
+        if result["errors"] or before.get("errors"):
+            regressions.append(
+                "{}: {} of {} requests failed, {} of {} in the baseline; "
+                "timings not compared".format(
+                    name,
+                    result["errors"],
+                    result["requests"],
+                    before.get("errors", 0),
+                    before["requests"],
+                )
+            )
+            continue
+        if result["p99_ms"] > before["p99_ms"] * (1 + tolerance):
+            regressions.append(
+                "{}: p99 {:.2f} ms, was {:.2f} ms".format(
+                    name, result["p99_ms"], before["p99_ms"]
+                )
+            )
+        if result["requests_per_second"] < before["requests_per_second"] / (
+            1 + tolerance
+        ):
+            regressions.append(
+                "{}: {:.1f} req/s, was {:.1f} req/s".format(
+                    name, result["requests_per_second"], before["requests_per_second"]
+                )
+            )
+
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    powergate = FakePowergate(latency=args.latency, throughput=args.throughput)
+    address = powergate.start()
+
+    results = []
+    try:
+        with tempfile.TemporaryDirectory(prefix="pygate-bench-") as workdir:
+            app = load_app(workdir, address)
+
+            from pygate.database import create_database
+            from pygate.eventlog import flush as flush_events
+
+            with app.app_context():
+                create_database()
+
+            for rows in args.rows:
+                print("Seeding {} files and logs...".format(rows), file=sys.stderr)
+                with app.app_context():
+                    seed(powergate, args.ffs, rows, args.sizes)
+
+                for route in args.routes:
+                    sizes = args.sizes if route in SIZED_ROUTES else [None]
+                    for size in sizes:
+                        result = run_benchmark(app, route, size, args)
+                        result["rows"] = rows
+                        results.append(result)
+                        if route == "upload":
+                            wait_for_jobs(app)
+
+                with app.app_context():
+                    flush_events()
+    finally:
+        powergate.stop()
+
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(
+                {
+                    "settings": {
+                        "concurrency": args.concurrency,
+                        "latency": args.latency,
+                        "throughput": args.throughput,
+                    },
+                    "results": results,
+                },
+                output,
+                indent=2,
+            )
+
+    status = 0
+
+    failed = failures(results)
+    if failed:
+        print("\nFailed requests:")
+        for failure in failed:
+            print("  " + failure)
+        status = 1
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressions against " + args.baseline + ":")
+            for regression in regressions:
+                print("  " + regression)
+            status = 1
+
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
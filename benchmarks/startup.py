@@ -0,0 +1,212 @@
+"""
+Benchmark how long the Pygate application takes to start, timing each
+command in fresh Python processes and reporting whether it loaded the gRPC
+modules. Run from the repository root:
+
+    python -m benchmarks.startup --runs 10
+
+Save the results with --json and pass them as --baseline to a later run to
+fail it when a command got slower.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Arguments of the Python processes timed for each command
+COMMANDS = {
+    "import": ["-c", "import pygate"],
+    "version": ["-m", "pygate", "--version"],
+    "create_app": ["-c", "from pygate import create_app; create_app()"],
+    "create_db": ["create_db.py"],
+    "python": ["-c", "pass"],
+}
+
+# Modules whose loading shows that Powergate client code was imported
+GRPC_MODULES = ("grpc", "pygate_grpc", "google.protobuf")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.startup", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument(
+        "--commands",
+        default=",".join(COMMANDS),
+        help="comma-separated commands to time (default: all of %(default)s)",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=10,
+        help="processes started per command (default: %(default)s)",
+    )
+    parser.add_argument("--json", metavar="PATH", help="write the results to PATH")
+    parser.add_argument(
+        "--baseline",
+        metavar="PATH",
+        help="compare with the results of an earlier run, exiting with status 1 "
+        "if any command got slower",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="slowdown against the baseline allowed before it counts as a "
+        "regression (default: %(default)s)",
+    )
+
+    args = parser.parse_args(argv)
+    args.commands = [name.strip() for name in args.commands.split(",") if name]
+    unknown = set(args.commands) - set(COMMANDS)
+    if unknown:
+        parser.error("unknown commands: " + ", ".join(sorted(unknown)))
+
+    return args
+
+
+def run_once(arguments, env):
+    """
+    Start a Python process and return the seconds it took to exit
+    """
+
+    started = time.perf_counter()
+    subprocess.run(
+        [sys.executable] + arguments,
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+
+    return time.perf_counter() - started
+
+
+def loads_grpc(arguments, env):
+    """
+    Whether a command imports any of the gRPC modules, from the import times
+    Python reports with -X importtime
+    """
+
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime"] + arguments,
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    modules = {
+        line.rsplit("|", 1)[-1].strip()
+        for line in process.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+
+    return any(
+        module == name or module.startswith(name + ".")
+        for module in modules
+        for name in GRPC_MODULES
+    )
+
+
+def run_benchmark(name, args, env):
+    arguments = COMMANDS[name]
+
+    # The first run fills the bytecode caches
+    run_once(arguments, env)
+    seconds = sorted(run_once(arguments, env) for _ in range(args.runs))
+
+    return {
+        "command": name,
+        "runs": args.runs,
+        "min": seconds[0],
+        "median": statistics.median(seconds),
+        "max": seconds[-1],
+        "grpc": loads_grpc(arguments, env),
+    }
+
+
+def print_results(results):
+    print(
+        "{:<12} {:>6} {:>10} {:>10} {:>10}  {}".format(
+            "command", "runs", "min ms", "median ms", "max ms", "gRPC"
+        )
+    )
+    for result in results:
+        print(
+            "{:<12} {:>6} {:>10.1f} {:>10.1f} {:>10.1f}  {}".format(
+                result["command"],
+                result["runs"],
+                result["min"] * 1000,
+                result["median"] * 1000,
+                result["max"] * 1000,
+                "loaded" if result["grpc"] else "-",
+            )
+        )
+
+
+def compare(results, baseline, tolerance):
+    """
+    List the commands whose median start time is more than `tolerance`
+    slower than in the baseline
+    """
+
+    before = {result["command"]: result for result in baseline}
+    regressions = []
+    for result in results:
+        old = before.get(result["command"])
+        if old is None:
+            continue
+        if result["median"] > old["median"] * (1 + tolerance):
+            regressions.append(
+                "{}: median {:.1f}ms, was {:.1f}ms".format(
+                    result["command"], result["median"] * 1000, old["median"] * 1000
+                )
+            )
+
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="pygate-startup-") as workdir:
+        # Read by config.py on import; create_db.py fills this database
+        env = dict(os.environ)
+        env["DATABASE_URL"] = "sqlite:///" + os.path.join(workdir, "startup.db")
+
+        for name in args.commands:
+            print("Timing {}...".format(name), file=sys.stderr)
+            results.append(run_benchmark(name, args, env))
+
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump({"results": results}, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressions against " + args.baseline + ":")
+            for regression in regressions:
+                print("  " + regression)
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
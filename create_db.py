@@ -2,6 +2,8 @@
 Create the application database if it doesn't already exist
 """
 
-from pygate import db
+from pygate import app
+from pygate.database import create_database
 
-db.create_all()
+with app.app_context():
+    create_database()
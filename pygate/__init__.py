@@ -1,12 +1,61 @@
 """
-Intialize the Pygate application
+Intialize the Pygate application. Importing the package is cheap: the Flask
+application and its database are made on first use of `pygate.app` or
+`pygate.db`, while the routes and commands are only registered by
+create_app(), the entry point of everything serving requests or running
+commands.
 """
 
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
+import threading
 
-app = Flask(__name__)
-app.config.from_object("config")
-db = SQLAlchemy(app)
+_lock = threading.RLock()
+_created = False
 
-from pygate import routes, models
+
+def _make_app():
+    """
+    Create the Flask application and its database, shared by the modules of
+    the package as `pygate.app` and `pygate.db`
+    """
+
+    global app, db
+
+    from flask import Flask
+    from flask_sqlalchemy import SQLAlchemy
+
+    app = Flask(__name__)
+    app.config.from_object("config")
+    db = SQLAlchemy(app)
+
+
+def create_app():
+    """
+    Return the Pygate application with its models, metrics and routes
+    registered. The application is made once per process and later calls
+    return it again.
+    """
+
+    global _created
+
+    with _lock:
+        if "app" not in globals():
+            _make_app()
+        if not _created:
+            from pygate import models, database, metrics
+            from pygate.routes import blueprint
+
+            app.register_blueprint(blueprint)
+            _created = True
+
+    return app
+
+
+def __getattr__(name):
+    if name in ("app", "db"):
+        with _lock:
+            if name not in globals():
+                _make_app()
+
+        return globals()[name]
+
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,8 @@
+"""
+Launch the Pygate application with `python -m pygate`
+"""
+
+from pygate.cli import main
+
+if __name__ == "__main__":
+    main()
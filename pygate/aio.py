@@ -0,0 +1,377 @@
+"""
+Serve the application over ASGI, streaming downloads and the chunks of
+resumable uploads on the event loop with grpc.aio instead of holding a
+thread per request
+"""
+
+import asyncio
+import functools
+import re
+import grpc
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.datastructures import Headers
+from werkzeug.http import http_date, parse_range_header
+from pygate_grpc import ffs as ffs_client
+from pygate import app
+from pygate.models import Uploads
+from pygate.helpers import file_copies, log_download
+from pygate.powergate import node_of
+from pygate.resumable import (
+    TUS_VERSION,
+    CHUNK_SIZE,
+    ChunkWriter,
+    UploadError,
+    upload_lock,
+    forget_lock,
+    expires_at,
+)
+
+DOWNLOAD_PATH = re.compile(r"^/download/(?P<cid>[^/]+)$")
+UPLOAD_PATH = re.compile(r"^/uploads/(?P<upload_id>[^/]+)$")
+
+
+class AsyncPowergate(object):
+    """
+    Powergate FFS calls over one grpc.aio channel, shared by every request
+    handled on the event loop
+    """
+
+    def __init__(self, address):
+        self.channel = grpc.aio.insecure_channel(address)
+        self.ffs = ffs_client.ffs_rpc_pb2_grpc.RPCServiceStub(self.channel)
+
+    def get(self, cid, token):
+        """
+        Start retrieving a file, returning the call to iterate over for
+        its chunks
+        """
+
+        return self.ffs.Get(
+            ffs_client.ffs_rpc_pb2.GetRequest(cid=cid),
+            metadata=((ffs_client.TOKEN_KEY, token),),
+        )
+
+    async def close(self):
+        await self.channel.close()
+
+
+class AsyncApplication(object):
+    """
+    ASGI application serving downloads and resumable upload chunks natively
+    and every other request through the Flask (WSGI) application
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi = WsgiToAsgi(wsgi_app)
+        self.powergates = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+
+        if scope["type"] == "http":
+            download = DOWNLOAD_PATH.match(scope["path"])
+            upload = UPLOAD_PATH.match(scope["path"])
+            if download and scope["method"] == "GET":
+                if await self.download(scope, receive, send, download.group("cid")):
+                    return
+            elif upload and scope["method"] == "PATCH":
+                if await self.upload_chunk(
+                    scope, receive, send, upload.group("upload_id")
+                ):
+                    return
+
+        # Each Flask request runs on a thread of its own rather than on the
+        # single thread asgiref would otherwise share between them
+        async with ThreadSensitiveContext():
+            await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                # Resume jobs and start the background threads now, as the
+                # first requests may never reach Flask
+                await run_sync(app.try_trigger_before_first_request_functions)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                for powergate in self.powergates.values():
+                    await powergate.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def get_powergate(self, address):
+        powergate = self.powergates.get(address)
+        if powergate is None:
+            powergate = self.powergates[address] = AsyncPowergate(address)
+
+        return powergate
+
+    async def download(self, scope, receive, send, cid):
+        """
+        Stream a file from Filecoin as the download view does, stopping the
+        retrieval when the client goes away. Returns False to leave the
+        request to that view: for cached downloads, unknown CIDs,
+        unsatisfiable ranges and retrievals that fail before the first
+        chunk, whose error is then reported on the files page.
+        """
+
+        if app.config["DOWNLOAD_CACHE"]:
+            # The cache is filled and shared by threads, so it stays with Flask
+            return False
+
+        copies = await run_sync(_find_copies, cid)
+        if not copies:
+            return False
+        file = copies[0][0]
+
+        # Work out which bytes to send for HTTP Range requests. Requests for
+        # several ranges get the whole file, which RFC 7233 allows.
+        byte_range = None
+        requested = parse_range_header(request_headers(scope).get("Range"))
+        if (
+            requested is not None
+            and len(requested.ranges) == 1
+            and file.file_size is not None
+        ):
+            byte_range = requested.range_for_length(file.file_size)
+            if byte_range is None:
+                return False
+
+        # Fail over to the copies stored on other Powergate nodes
+        for file, node, token in copies:
+            call = self.get_powergate(node).get(file.CID, token)
+            replies = call.__aiter__()
+            try:
+                # Wait for the first chunk so that a failed retrieval can
+                # still be reported on the files page instead of as a
+                # truncated download
+                first_chunk = (await replies.__anext__()).chunk
+            except StopAsyncIteration:
+                first_chunk = b""
+            except Exception:
+                call.cancel()
+                continue
+            break
+        else:
+            return False
+
+        await run_sync(log_download, file)
+
+        status = 200
+        headers = Headers()
+        headers.set("Content-Type", "application/octet-stream")
+        headers.set("Content-Disposition", "attachment", filename=file.file_name)
+        headers.set("ETag", '"{}"'.format(file.CID))
+        if file.file_size is not None:
+            headers.set("Accept-Ranges", "bytes")
+            if byte_range is not None:
+                start, stop = byte_range
+                status = 206
+                headers.set(
+                    "Content-Range",
+                    "bytes {}-{}/{}".format(start, stop - 1, file.file_size),
+                )
+                headers.set("Content-Length", str(stop - start))
+            else:
+                headers.set("Content-Length", str(file.file_size))
+
+        data = _chunks(first_chunk, replies)
+        if byte_range is not None:
+            # Powergate only returns whole files, so skip to the requested range
+            data = slice_chunks(data, *byte_range)
+
+        # Some servers keep taking the body after the client went away, so
+        # the retrieval is stopped on the disconnect message instead
+        streaming = asyncio.ensure_future(send_stream(send, status, headers, data))
+        watching = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            done, _ = await asyncio.wait(
+                (streaming, watching), return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            streaming.cancel()
+            watching.cancel()
+            call.cancel()
+        if streaming in done:
+            streaming.result()
+
+        return True
+
+    async def upload_chunk(self, scope, receive, send, upload_id):
+        """
+        Write a chunk of a resumable upload as it arrives, as the PATCH
+        method of the resumable_upload view does. Returns False to leave
+        malformed requests and unknown uploads to that view.
+        """
+
+        headers = request_headers(scope)
+        if (
+            headers.get("Tus-Resumable") != TUS_VERSION
+            or headers.get("Content-Type", "").split(";")[0].strip()
+            != "application/offset+octet-stream"
+        ):
+            return False
+        try:
+            offset = int(headers.get("Upload-Offset", ""))
+        except ValueError:
+            return False
+
+        # Waiting for the lock would block the event loop
+        lock = upload_lock(upload_id)
+        if not lock.acquire(blocking=False):
+            await send_tus(send, 409, body="A chunk of the upload is being written")
+            return True
+
+        try:
+            writer = await run_sync(
+                _open_writer, upload_id, offset, headers.get("Upload-Checksum")
+            )
+            if writer is None:
+                return False
+
+            loop = asyncio.get_running_loop()
+            buffer = bytearray()
+            disconnected = False
+            try:
+                while True:
+                    message = await receive()
+                    if message["type"] == "http.disconnect":
+                        disconnected = True
+                        break
+                    buffer += message.get("body", b"")
+                    more_body = message.get("more_body", False)
+                    if buffer and (len(buffer) >= CHUNK_SIZE or not more_body):
+                        await loop.run_in_executor(None, writer.write, bytes(buffer))
+                        buffer.clear()
+                    if not more_body:
+                        break
+            except UploadError:
+                # write() has already dropped the chunk
+                raise
+            except BaseException:
+                writer.abort()
+                raise
+
+            response_headers = await run_sync(
+                _finish_writer, writer, disconnected, scope.get("root_path", "")
+            )
+        except UploadError as e:
+            await send_tus(send, e.status, body=str(e))
+            return True
+        finally:
+            lock.release()
+
+        await send_tus(send, 204, response_headers)
+
+        return True
+
+
+def request_headers(scope):
+    return Headers(
+        [(k.decode("latin-1"), v.decode("latin-1")) for k, v in scope["headers"]]
+    )
+
+
+async def send_start(send, status, headers):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (k.lower().encode("latin-1"), v.encode("latin-1"))
+                for k, v in headers.items()
+            ],
+        }
+    )
+
+
+async def send_stream(send, status, headers, chunks):
+    await send_start(send, status, headers)
+    async for chunk in chunks:
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def send_tus(send, status, headers=None, body=""):
+    response_headers = Headers(headers or {})
+    response_headers.set("Tus-Resumable", TUS_VERSION)
+    response_headers.set("Content-Length", str(len(body.encode())))
+    await send_start(send, status, response_headers)
+    await send({"type": "http.response.body", "body": body.encode()})
+
+
+async def run_sync(func, *args):
+    """
+    Run blocking code, such as database access, on a worker thread inside
+    an application context
+    """
+
+    loop = asyncio.get_running_loop()
+
+    return await loop.run_in_executor(
+        None, functools.partial(_in_app_context, func, *args)
+    )
+
+
+async def slice_chunks(chunks, start, stop):
+    """
+    Yield only the bytes from offset `start` up to `stop` of an asynchronous
+    chunk stream
+    """
+
+    position = 0
+    async for chunk in chunks:
+        end = position + len(chunk)
+        if end > start:
+            yield chunk[max(start - position, 0) : stop - position]
+        position = end
+        if position >= stop:
+            return
+
+
+async def _chunks(first_chunk, replies):
+    yield first_chunk
+    async for reply in replies:
+        yield reply.chunk
+
+
+def _in_app_context(func, *args):
+    with app.app_context():
+        return func(*args)
+
+
+def _find_copies(cid):
+    return [(file, node_of(ffs), ffs.token) for file, ffs in file_copies(cid)]
+
+
+def _open_writer(upload_id, offset, checksum):
+    upload = Uploads.query.get(upload_id)
+    if upload is None:
+        return None
+
+    return ChunkWriter(upload, offset, checksum)
+
+
+def _finish_writer(writer, disconnected, root_path):
+    writer.finish(disconnected)
+    upload = writer.upload
+    forget_lock(upload)
+
+    headers = {"Upload-Offset": str(upload.offset)}
+    if upload.job_id is not None:
+        urls = app.url_map.bind("localhost", script_name=root_path or "/")
+        headers["Upload-Job"] = urls.build(
+            "pygate.api_job", {"job_id": upload.job_id}
+        )
+    else:
+        headers["Upload-Expires"] = http_date(expires_at(upload))
+
+    return headers
@@ -0,0 +1,191 @@
+"""
+Keep running totals of the files stored per FFS and uploaded per day,
+updated in the transaction that records the files, so usage is reported
+without scanning the files table
+"""
+
+from collections import defaultdict
+from datetime import date, timedelta
+import click
+from sqlalchemy import bindparam, func, text
+from pygate import app, db
+from pygate.models import DailyUsage, Ffs, FfsUsage, Files
+
+GIB = 1024 ** 3
+
+# Add to the totals, creating them on first use. SQLite (3.24 and later) and
+# PostgreSQL share this syntax.
+ADD_FFS_USAGE = text(
+    "INSERT INTO {0} (ffs_id, files, bytes) VALUES (:ffs_id, :files, :bytes) "
+    "ON CONFLICT (ffs_id) DO UPDATE SET files = {0}.files + excluded.files, "
+    "bytes = {0}.bytes + excluded.bytes".format(FfsUsage.__tablename__)
+)
+ADD_DAILY_USAGE = text(
+    "INSERT INTO {0} (day, ffs_id, files, bytes) "
+    "VALUES (:day, :ffs_id, :files, :bytes) "
+    "ON CONFLICT (day, ffs_id) DO UPDATE SET files = {0}.files + excluded.files, "
+    "bytes = {0}.bytes + excluded.bytes".format(DailyUsage.__tablename__)
+).bindparams(bindparam("day", type_=db.Date()))
+
+
+def count_uploads(uploads):
+    """
+    Add (ffs_id, upload_date, file_size) uploads to the totals within the
+    current transaction, so they are committed with the files themselves
+    """
+
+    per_ffs = defaultdict(lambda: [0, 0])
+    per_day = defaultdict(lambda: [0, 0])
+    for ffs_id, upload_date, file_size in uploads:
+        for totals in (per_ffs[ffs_id], per_day[upload_date.date(), ffs_id]):
+            totals[0] += 1
+            totals[1] += file_size or 0
+
+    if not per_ffs:
+        return
+
+    # Sorted, so that concurrent transactions lock the rows in the same order
+    db.session.execute(
+        ADD_FFS_USAGE,
+        [
+            {"ffs_id": ffs_id, "files": files, "bytes": size}
+            for ffs_id, (files, size) in sorted(per_ffs.items())
+        ],
+    )
+    db.session.execute(
+        ADD_DAILY_USAGE,
+        [
+            {"day": day, "ffs_id": ffs_id, "files": files, "bytes": size}
+            for (day, ffs_id), (files, size) in sorted(per_day.items())
+        ],
+    )
+
+
+def rebuild_usage():
+    """
+    Recompute the totals from the files table, for databases whose files
+    were recorded before the totals were kept. Returns the number of files.
+    """
+
+    day = func.date(Files.upload_date)
+    per_day = (
+        db.session.query(
+            day, Files.ffs_id, func.count(Files.id), func.sum(Files.file_size)
+        )
+        .filter(Files.upload_date.isnot(None))
+        .group_by(day, Files.ffs_id)
+        .all()
+    )
+
+    try:
+        DailyUsage.query.delete(synchronize_session=False)
+        FfsUsage.query.delete(synchronize_session=False)
+
+        per_ffs = defaultdict(lambda: [0, 0])
+        rows = []
+        for upload_day, ffs_id, files, size in per_day:
+            if isinstance(upload_day, str):
+                # SQLite has no date type
+                upload_day = date.fromisoformat(upload_day)
+            rows.append(
+                {
+                    "day": upload_day,
+                    "ffs_id": ffs_id,
+                    "files": files,
+                    "bytes": int(size or 0),
+                }
+            )
+            per_ffs[ffs_id][0] += files
+            per_ffs[ffs_id][1] += int(size or 0)
+
+        db.session.bulk_insert_mappings(DailyUsage, rows)
+        db.session.bulk_insert_mappings(
+            FfsUsage,
+            [
+                {"ffs_id": ffs_id, "files": files, "bytes": size}
+                for ffs_id, (files, size) in per_ffs.items()
+            ],
+        )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return sum(files for files, _ in per_ffs.values())
+
+
+def estimated_cost(size):
+    """
+    Return the monthly cost of storing `size` bytes at
+    STORAGE_PRICE_PER_GIB_MONTH, or None if no price is configured
+    """
+
+    price = app.config["STORAGE_PRICE_PER_GIB_MONTH"]
+    if price is None:
+        return None
+
+    return size / GIB * price
+
+
+def usage_summary(days=None):
+    """
+    Describe the files stored in total and per FFS, and the uploads of each
+    of the last `days` days, for the analytics page and JSON API
+    """
+
+    days = days or app.config["ANALYTICS_DAYS"]
+    since = date.today() - timedelta(days=days - 1)
+
+    per_ffs = [
+        {
+            "ffs_id": ffs_id,
+            "default": bool(default),
+            "node": node,
+            "files": files,
+            "bytes": size,
+            "estimated_cost": estimated_cost(size),
+        }
+        for ffs_id, default, node, files, size in db.session.query(
+            Ffs.ffs_id, Ffs.default, Ffs.node, FfsUsage.files, FfsUsage.bytes
+        )
+        .join(FfsUsage, FfsUsage.ffs_id == Ffs.id)
+        .order_by(FfsUsage.bytes.desc())
+    ]
+
+    uploaded = {
+        upload_day: (int(files), int(size))
+        for upload_day, files, size in db.session.query(
+            DailyUsage.day, func.sum(DailyUsage.files), func.sum(DailyUsage.bytes)
+        )
+        .filter(DailyUsage.day >= since)
+        .group_by(DailyUsage.day)
+    }
+    # Days without uploads are listed too, so the series has no gaps
+    daily = []
+    for offset in range(days):
+        upload_day = since + timedelta(days=offset)
+        files, size = uploaded.get(upload_day, (0, 0))
+        daily.append({"day": str(upload_day), "files": files, "bytes": size})
+
+    total_files = sum(row["files"] for row in per_ffs)
+    total_bytes = sum(row["bytes"] for row in per_ffs)
+
+    return {
+        "files": total_files,
+        "bytes": total_bytes,
+        "estimated_cost": estimated_cost(total_bytes),
+        "days": days,
+        "files_per_day": sum(row["files"] for row in daily) / days,
+        "bytes_per_day": sum(row["bytes"] for row in daily) / days,
+        "ffses": per_ffs,
+        "daily": daily,
+    }
+
+
+@app.cli.command("rebuild-usage")
+def rebuild_usage_command():
+    """
+    Recompute the storage usage totals from the files table
+    """
+
+    click.echo("Counted {} files".format(rebuild_usage()))
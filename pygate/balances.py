@@ -0,0 +1,152 @@
+"""
+Fetch wallet addresses and balances concurrently and cache them for a while
+"""
+
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from pygate import app
+from pygate.powergate import get_pool, node_of
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# Cached values keyed by ("addrs", token) or ("balance", address), each
+# stored as (value, refreshed datetime, expiry on the monotonic clock)
+_entries = {}
+_inflight = {}
+_lock = threading.Lock()
+
+
+def _get_executor():
+    """
+    Create the pool of threads making Powergate calls on first use
+    """
+
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=app.config["WALLET_WORKERS"],
+                thread_name_prefix="pygate-wallets",
+            )
+
+    return _executor
+
+
+def _fetch_addresses(node, token):
+    with get_pool(node).client() as powergate:
+        addresses = powergate.ffs.addrs_list(token)
+
+    return [(address.name, address.addr, address.type) for address in addresses.addrs]
+
+
+def _fetch_balance(address):
+    # Any node can tell the balance of an address
+    with get_pool().client() as powergate:
+        balance = powergate.wallet.balance(address)
+
+    return str(balance.balance)
+
+
+def _refresh(key, fetch, ttl):
+    # Fetch a value and store it in the cache, letting errors propagate to
+    # whoever waits on the future
+    try:
+        value = fetch()
+        refreshed = datetime.now().replace(microsecond=0)
+        with _lock:
+            _entries[key] = (value, refreshed, time.monotonic() + ttl)
+        return value, refreshed
+    finally:
+        with _lock:
+            _inflight.pop(key, None)
+
+
+def _lookup(key, fetch, ttl):
+    """
+    Return a future of (value, refreshed) for a cache key. Cached values are
+    returned straight away, and expired ones are refreshed in the background
+    while the old value is still served. Missing values are fetched, once,
+    on the thread pool.
+    """
+
+    with _lock:
+        entry = _entries.get(key)
+        inflight = _inflight.get(key)
+
+        if entry is None and inflight is not None:
+            return inflight
+
+        if entry is None or (entry[2] <= time.monotonic() and inflight is None):
+            inflight = _get_executor().submit(_refresh, key, fetch, ttl)
+            _inflight[key] = inflight
+
+    if entry is None:
+        return inflight
+
+    cached = Future()
+    cached.set_result(entry[:2])
+
+    return cached
+
+
+def list_wallets(ffses):
+    """
+    Return the wallets of all given FFSes with their balance and the time the
+    balance was last refreshed, plus the FFSes whose wallets could not be
+    listed. Balances that could not be fetched are reported as None.
+    """
+
+    address_ttl = app.config["WALLET_ADDRESSES_TTL"]
+    balance_ttl = app.config["WALLET_BALANCE_TTL"]
+
+    address_lists = [
+        (
+            ffs,
+            _lookup(
+                ("addrs", ffs.token),
+                lambda node=node_of(ffs), token=ffs.token: _fetch_addresses(
+                    node, token
+                ),
+                address_ttl,
+            ),
+        )
+        for ffs in ffses
+    ]
+
+    wallets = []
+    failed = []
+    for ffs, future in address_lists:
+        try:
+            addresses, _ = future.result()
+        except Exception as e:
+            failed.append((ffs, e))
+            continue
+
+        for name, address, address_type in addresses:
+            balance = _lookup(
+                ("balance", address),
+                lambda address=address: _fetch_balance(address),
+                balance_ttl,
+            )
+            wallets.append(
+                {
+                    "ffs": ffs.ffs_id,
+                    "name": name,
+                    "address": address,
+                    "type": address_type,
+                    "balance": balance,
+                }
+            )
+
+    # Wait for the balances only once all of them have been requested
+    for wallet in wallets:
+        try:
+            wallet["balance"], wallet["refreshed"] = wallet["balance"].result()
+        except Exception:
+            wallet["balance"], wallet["refreshed"] = None, None
+
+    return wallets, failed
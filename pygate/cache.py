@@ -0,0 +1,355 @@
+"""
+Keep retrieved files in a content-addressed local cache keyed by CID, shared
+by the worker processes of a deployment
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from werkzeug.utils import secure_filename
+from pygate import app
+from pygate.lifecycle import shard_directory
+from pygate.workers import worker_alive, worker_id
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, where there is one process
+    fcntl = None
+
+PARTIAL_SUFFIX = ".part"
+INDEX_FILE = ".index"
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class RetrievalCache(object):
+    """
+    Store retrieved files under their CID, in subdirectories picked by a hash
+    of it, within a byte budget. Once over `max_bytes` the least recently
+    used ones are evicted until the cache is within `low_bytes`. CIDs are
+    immutable, so a cached file never has to be revalidated against
+    Powergate.
+
+    The files on disk are the index, so every worker process sees the same
+    cache: the size of the cache is kept in an index file, changed under an
+    exclusive lock on it, and a file is pinned against eviction with a
+    shared lock on the file itself until it has been opened for reading.
+    Files are written to a partial file of the worker and renamed into place
+    once complete. Only one request of a process at a time fetches a given
+    CID while the others wait.
+
+    Files used in the last `min_age` seconds are not evicted, for front-end
+    servers that open the file only after the request has unpinned it.
+    """
+
+    def __init__(self, directory, max_bytes, low_bytes=None, min_age=0):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.low_bytes = max_bytes if low_bytes is None else min(low_bytes, max_bytes)
+        self.min_age = min_age
+        self._lock = threading.Lock()
+        self._index_lock = threading.Lock()
+        self._pins = {}
+        self._fetches = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._load()
+
+    def path(self, cid):
+        return os.path.join(shard_directory(self.directory, cid), secure_filename(cid))
+
+    def get(self, cid, wait=0):
+        """
+        Return the path of a cached CID and pin it until release() is called.
+        If another request of this process is fetching the CID, wait up to
+        `wait` seconds for it to finish. Returns None on a miss.
+        """
+
+        deadline = time.monotonic() + wait
+        path = self.path(cid)
+
+        while True:
+            pin = _pin(path)
+            if pin is not None:
+                break
+
+            with self._lock:
+                fetch = self._fetches.get(cid)
+                if fetch is None:
+                    self.misses += 1
+                    return None
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not fetch.wait(remaining):
+                with self._lock:
+                    self.misses += 1
+                return None
+
+        with self._lock:
+            self._pins.setdefault(cid, []).append(pin)
+            self.hits += 1
+
+        try:
+            # The recency of use decides what is evicted first
+            os.utime(pin.fileno())
+        except OSError:
+            pass
+
+        return path
+
+    def release(self, cid):
+        """
+        Unpin a CID returned by get() once its file has been opened
+        """
+
+        with self._lock:
+            pins = self._pins.get(cid)
+            pin = pins.pop() if pins else None
+            if not pins:
+                self._pins.pop(cid, None)
+
+        if pin is not None:
+            pin.close()
+
+    def claim(self, cid, size=None):
+        """
+        Claim the fetch of a CID that is not cached. Returns False if another
+        request of this process is already fetching it or it could never fit
+        in the cache.
+        """
+
+        if size is not None and size > self.max_bytes:
+            return False
+
+        with self._lock:
+            if cid in self._fetches or os.path.exists(self.path(cid)):
+                return False
+            self._fetches[cid] = threading.Event()
+
+        return True
+
+    def abandon(self, cid):
+        """
+        Give up a claimed fetch and wake up the requests waiting on it
+        """
+
+        with self._lock:
+            fetch = self._fetches.pop(cid, None)
+
+        if fetch is not None:
+            fetch.set()
+
+    def fill(self, cid, chunks):
+        """
+        Pass the chunks of a claimed CID through while writing them to the
+        cache. The file only becomes visible once all chunks were written.
+        """
+
+        path = self.path(cid)
+        partial_path = "{}.{}{}".format(path, worker_id(), PARTIAL_SUFFIX)
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(partial_path, "wb") as out_file:
+                for chunk in chunks:
+                    out_file.write(chunk)
+                    yield chunk
+
+            size = os.path.getsize(partial_path)
+            with self._index() as index:
+                # Another worker may have cached the same CID meanwhile
+                try:
+                    replaced = os.path.getsize(path)
+                except OSError:
+                    replaced = None
+                os.replace(partial_path, path)
+                index["bytes"] += size - (replaced or 0)
+                if replaced is None:
+                    index["files"] += 1
+                self._evict(index)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            self.abandon(cid)
+
+    def stats(self):
+        """
+        Report the size of the cache and the hit, miss and eviction counters
+        of this process
+        """
+
+        with self._index() as index:
+            size = index["bytes"]
+            files = index["files"]
+
+        with self._lock:
+            return {
+                "directory": self.directory,
+                "max_bytes": self.max_bytes,
+                "low_bytes": self.low_bytes,
+                "bytes": size,
+                "files": files,
+                "pinned": len(self._pins),
+                "fetching": len(self._fetches),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "evicted_bytes": self.evicted_bytes,
+            }
+
+    @contextmanager
+    def _index(self):
+        # Hold the exclusive lock on the index file, yielding the size of the
+        # cache it records to be changed and written back
+        index_path = os.path.join(self.directory, INDEX_FILE)
+        with self._index_lock, open(index_path, "a+") as index_file:
+            if fcntl is not None:
+                fcntl.flock(index_file, fcntl.LOCK_EX)
+            index_file.seek(0)
+            try:
+                index = json.loads(index_file.read())
+            except ValueError:
+                index = None
+            if index is None:
+                index = _totals(self._scan())
+            before = dict(index)
+
+            yield index
+
+            if index != before:
+                index_file.seek(0)
+                index_file.truncate()
+                index_file.write(json.dumps(index))
+                index_file.flush()
+
+    def _scan(self):
+        # List the cached files on disk as (mtime, path, size), least
+        # recently used first
+        found = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name == INDEX_FILE or name.endswith(PARTIAL_SUFFIX):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                found.append((stat.st_mtime, path, stat.st_size))
+        found.sort()
+
+        return found
+
+    def _load(self):
+        # Drop the partial files of workers that are gone, and the files
+        # that downloads used to be written to straight in the directory,
+        # which are named after the file rather than its CID and so could
+        # never be hit. Then count the cache again, as files may have been
+        # removed by hand.
+        with self._index() as index:
+            for root, _, names in os.walk(self.directory):
+                for name in names:
+                    path = os.path.join(root, name)
+                    if name.endswith(PARTIAL_SUFFIX):
+                        worker = name[: -len(PARTIAL_SUFFIX)].partition(".")[2]
+                        if not worker_alive(worker):
+                            os.remove(path)
+                    elif root == self.directory and name != INDEX_FILE:
+                        os.remove(path)
+
+            found = self._scan()
+            index.update(_totals(found))
+            self._evict(index, found)
+
+    def _evict(self, index, found=None):
+        # Drop the least recently used files that are not pinned, down to the
+        # low watermark so that every new file does not evict another. Runs
+        # under the lock of the index.
+        if index["bytes"] <= self.max_bytes:
+            return
+
+        if found is None:
+            found = self._scan()
+        used_since = time.time() - self.min_age
+        for mtime, path, size in found:
+            if index["bytes"] <= self.low_bytes or mtime > used_since:
+                break
+            if _remove_unpinned(path):
+                index["bytes"] -= size
+                index["files"] -= 1
+                with self._lock:
+                    self.evictions += 1
+                    self.evicted_bytes += size
+
+
+def _totals(found):
+    return {"bytes": sum(size for _, _, size in found), "files": len(found)}
+
+
+def _pin(path):
+    """
+    Open a cached file and take a shared lock on it, which eviction waits
+    for. Returns the open file, or None if it is not cached.
+    """
+
+    try:
+        pin = open(path, "rb")
+    except OSError:
+        return None
+
+    if fcntl is not None:
+        fcntl.flock(pin, fcntl.LOCK_SH)
+    if os.fstat(pin.fileno()).st_nlink == 0:
+        # Evicted between opening and locking it
+        pin.close()
+        return None
+
+    return pin
+
+
+def _remove_unpinned(path):
+    """
+    Delete a cached file unless it is pinned, returning whether it was
+    """
+
+    try:
+        with open(path, "rb") as cached:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(cached, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return False
+            os.remove(path)
+    except FileNotFoundError:
+        return False
+
+    return True
+
+
+def get_cache():
+    """
+    Return the retrieval cache of this process, creating it on first use
+    """
+
+    global _cache
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = RetrievalCache(
+                app.config["DOWNLOADDIR"],
+                app.config["DOWNLOAD_CACHE_MAX_BYTES"],
+                app.config["DOWNLOAD_CACHE_LOW_BYTES"],
+                # The front-end server reads the file after the request ends
+                app.config["DOWNLOAD_CACHE_SENDFILE_SECONDS"]
+                if app.config["USE_X_SENDFILE"]
+                else 0,
+            )
+
+    return _cache
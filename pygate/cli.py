@@ -0,0 +1,207 @@
+"""
+Provide the `pygate-webapp` command, launching the Pygate application with
+one or more worker processes
+"""
+
+import click
+from pygate import create_app
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:  # fall back to the Werkzeug server
+    BaseApplication = None
+
+
+def get_version():
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:
+        return "development"
+
+    try:
+        return version("pygate-webapp")
+    except PackageNotFoundError:
+        return "development"
+
+
+def print_version(ctx, param, value):
+    # Looked up only when asked for, as reading the package metadata is slow
+    if not value or ctx.resilient_parsing:
+        return
+
+    click.echo("pygate-webapp, version {}".format(get_version()))
+    ctx.exit()
+
+
+def warm_templates():
+    """
+    Compile every template once so the first requests do not have to
+    """
+
+    app = create_app()
+    for name in app.jinja_env.list_templates(extensions=["html"]):
+        app.jinja_env.get_template(name)
+
+
+def warm_powergate():
+    """
+    Open a channel to every Powergate node and check that it answers, so
+    the first request finds a connected client in the pool
+    """
+
+    from pygate.powergate import get_pool, nodes
+
+    for address in nodes():
+        pool = get_pool(address)
+        try:
+            with pool.client() as client:
+                client.health.check()
+        except Exception as e:
+            pool.mark_down()
+            click.echo(
+                "Warning: Powergate at {} is not reachable: {!r}".format(address, e),
+                err=True,
+            )
+
+
+def start_worker():
+    """
+    Get a worker process ready to take traffic: connect to Powergate and
+    start the background work the primary worker runs
+    """
+
+    app = create_app()
+    with app.app_context():
+        warm_powergate()
+        app.try_trigger_before_first_request_functions()
+
+
+if BaseApplication is not None:
+
+    class GunicornApplication(BaseApplication):
+        """
+        Serve the application from gunicorn worker processes forked from a
+        process that has already loaded it
+        """
+
+        def __init__(self, application, options):
+            self.application = application
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+
+def serve_gunicorn(bind, workers, threads, asgi):
+    from pygate import db
+
+    app = create_app()
+    if asgi:
+        from pygate.aio import AsyncApplication
+
+        application = AsyncApplication(app)
+        worker_class = "uvicorn.workers.UvicornWorker"
+    else:
+        application = app
+        worker_class = "gthread"
+
+    options = {
+        "bind": bind,
+        "workers": workers,
+        "worker_class": worker_class,
+        "threads": threads,
+        "preload_app": True,
+        # Connections opened while loading must not be shared by workers
+        "post_fork": lambda server, worker: db.engine.dispose(),
+        "post_worker_init": lambda worker: start_worker(),
+    }
+    GunicornApplication(application, options).run()
+
+
+def serve_werkzeug(bind):
+    from werkzeug.serving import run_simple
+
+    host, _, port = bind.rpartition(":")
+    start_worker()
+    run_simple(host or "127.0.0.1", int(port), create_app(), threaded=True)
+
+
+@click.command(context_settings={"help_option_names": ["-h", "--help"]})
+@click.option(
+    "--version",
+    is_flag=True,
+    expose_value=False,
+    is_eager=True,
+    callback=print_version,
+    help="Show the version and exit.",
+)
+@click.option(
+    "-p",
+    "--powergate",
+    metavar="ADDRESS[,ADDRESS...]",
+    help="Address of the Powergate server, or comma separated addresses of "
+    "several nodes (default: POWERGATE_ADDRESSES).",
+)
+@click.option(
+    "-b",
+    "--bind",
+    default="127.0.0.1:5000",
+    show_default=True,
+    help="Address and port to serve the application on.",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of worker processes.",
+)
+@click.option(
+    "--threads",
+    type=click.IntRange(min=1),
+    default=8,
+    show_default=True,
+    help="Threads handling requests in each worker process.",
+)
+@click.option(
+    "--asgi",
+    is_flag=True,
+    help="Serve the ASGI application from uvicorn workers.",
+)
+def main(powergate, bind, workers, threads, asgi):
+    """
+    Serve the Pygate webapp from gunicorn when it is installed, or else from
+    a single process of the threaded Werkzeug server.
+    """
+
+    # Loaded only now, so that --version and --help answer straight away
+    app = create_app()
+
+    from pygate.database import create_database
+
+    if powergate:
+        addresses = [address.strip() for address in powergate.split(",")]
+        addresses = [address for address in addresses if address]
+        app.config["POWERGATE_ADDRESSES"] = addresses
+        app.config["POWERGATE_ADDRESS"] = addresses[0]
+
+    if BaseApplication is None and (asgi or workers > 1):
+        raise click.UsageError(
+            "--asgi and --workers need gunicorn (and uvicorn for --asgi) to be "
+            "installed"
+        )
+
+    with app.app_context():
+        create_database()
+    warm_templates()
+
+    if BaseApplication is not None:
+        serve_gunicorn(bind, workers, threads, asgi)
+    else:
+        serve_werkzeug(bind)
@@ -0,0 +1,89 @@
+"""
+Tune database connections and create the application database
+"""
+
+import sqlite3
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine import Engine
+from pygate import app, db
+from pygate.models import create_log_search_index
+
+
+@event.listens_for(Engine, "connect")
+def configure_sqlite(dbapi_connection, connection_record):
+    """
+    Switch SQLite databases to write-ahead logging, so readers never block
+    the writer, and make connections wait for locks instead of failing
+    """
+
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+
+    cursor = dbapi_connection.cursor()
+    cursor.execute(
+        "PRAGMA busy_timeout = {}".format(int(app.config["SQLITE_BUSY_TIMEOUT"] * 1000))
+    )
+    cursor.execute("PRAGMA journal_mode = WAL")
+    # Safe with WAL: a power loss may only lose the last transactions
+    cursor.execute("PRAGMA synchronous = NORMAL")
+    cursor.execute("PRAGMA temp_store = MEMORY")
+    cursor.execute("PRAGMA cache_size = -{}".format(app.config["SQLITE_CACHE_KB"]))
+    cursor.close()
+
+
+def create_database():
+    """
+    Create the tables of the application database that do not exist yet and
+    upgrade those created by an earlier version
+    """
+
+    db.create_all()
+
+    with db.engine.begin() as connection:
+        upgrade_tables(connection)
+        # Databases created before the logs had a full-text index get one
+        create_log_search_index(connection)
+
+
+def upgrade_tables(connection):
+    """
+    Add the columns and indexes of the models that the existing tables lack.
+    New columns are nullable whatever the model says, as existing rows have
+    no value for them, and are filled with the model's default if it has a
+    fixed one. Returns the added columns as "table.column".
+    """
+
+    inspector = inspect(connection)
+    preparer = connection.dialect.identifier_preparer
+    tables = set(inspector.get_table_names())
+    added = []
+
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            connection.execute(
+                text(
+                    "ALTER TABLE {} ADD COLUMN {} {}".format(
+                        preparer.format_table(table),
+                        preparer.format_column(column),
+                        column.type.compile(dialect=connection.dialect),
+                    )
+                )
+            )
+            if column.default is not None and column.default.is_scalar:
+                connection.execute(
+                    table.update().values({column.name: column.default.arg})
+                )
+            added.append("{}.{}".format(table.name, column.name))
+
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(connection)
+
+    return added
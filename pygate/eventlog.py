@@ -0,0 +1,116 @@
+"""
+Queue log entries in memory and write them to the log table in batches
+"""
+
+import atexit
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from pygate import app, db
+from pygate.models import Logs
+
+_pending = deque()
+_condition = threading.Condition()
+_writer_lock = threading.Lock()
+_flusher = None
+
+
+def log_event(event, timestamp=None):
+    """
+    Queue a log entry to be written with the next batch. When the queue is
+    full the caller writes the queued entries itself, so entries are never
+    dropped but callers slow down while the database falls behind.
+    """
+
+    if timestamp is None:
+        timestamp = datetime.now().replace(microsecond=0)
+
+    with _condition:
+        _pending.append({"timestamp": timestamp, "event": event[:255]})
+        _start_flusher()
+        backlog = len(_pending)
+        if backlog >= app.config["LOG_BATCH_SIZE"]:
+            _condition.notify()
+
+    if backlog >= app.config["LOG_QUEUE_SIZE"]:
+        try:
+            flush()
+        except Exception:
+            # The flusher thread keeps retrying the queued entries
+            pass
+
+
+def flush():
+    """
+    Write all queued log entries now, raising if the database write fails.
+    Entries of a failed write stay queued.
+    """
+
+    while _write_batch(app.config["LOG_BATCH_SIZE"]):
+        pass
+
+
+def _write_batch(size):
+    # Write up to `size` queued entries in one transaction and return how
+    # many were written. Failed batches are put back at the front of the queue.
+    with _writer_lock:
+        with _condition:
+            batch = [_pending.popleft() for _ in range(min(size, len(_pending)))]
+
+        if not batch:
+            return 0
+
+        try:
+            # Use a connection of its own so the write never touches the
+            # session of the request or job that is logging
+            with db.engine.begin() as connection:
+                connection.execute(Logs.__table__.insert(), batch)
+        except Exception:
+            with _condition:
+                _pending.extendleft(reversed(batch))
+            raise
+
+    return len(batch)
+
+
+def _start_flusher():
+    # Start the background flusher on first use; called holding _condition
+    global _flusher
+
+    if _flusher is None:
+        _flusher = threading.Thread(
+            target=_run_flusher, name="pygate-eventlog", daemon=True
+        )
+        _flusher.start()
+
+
+def _run_flusher():
+    """
+    Write queued entries whenever a batch is full or the flush interval has
+    passed, backing off while the database cannot be written to
+    """
+
+    failures = 0
+
+    while True:
+        with _condition:
+            _condition.wait_for(
+                lambda: len(_pending) >= app.config["LOG_BATCH_SIZE"],
+                timeout=app.config["LOG_FLUSH_INTERVAL"],
+            )
+
+        try:
+            flush()
+            failures = 0
+        except Exception:
+            failures += 1
+            time.sleep(min(2 ** failures, app.config["LOG_RETRY_MAX_DELAY"]))
+
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        flush()
+    except Exception:
+        pass
@@ -0,0 +1,330 @@
+"""
+Read and change FFS storage configs as typed values cached per FFS token
+"""
+
+import json
+import threading
+import time
+from datetime import datetime
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Tuple
+from pygate import app, db
+from pygate.powergate import get_powergate, node_of
+
+_configs = {}
+_configs_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class HotConfig:
+    """
+    Settings for storing data in the hot layer (IPFS)
+    """
+
+    enabled: bool = False
+    allow_unfreeze: bool = False
+    add_timeout: int = 0
+
+
+@dataclass(frozen=True)
+class ColdConfig:
+    """
+    Settings for storing data in the cold layer (Filecoin deals)
+    """
+
+    enabled: bool = False
+    rep_factor: int = 0
+    deal_min_duration: int = 0
+    excluded_miners: Tuple[str, ...] = ()
+    trusted_miners: Tuple[str, ...] = ()
+    country_codes: Tuple[str, ...] = ()
+    renew_enabled: bool = False
+    renew_threshold: int = 0
+    addr: str = ""
+    max_price: int = 0
+
+
+@dataclass(frozen=True)
+class StorageConfig:
+    """
+    The storage config of a FFS
+    """
+
+    hot: HotConfig = field(default_factory=HotConfig)
+    cold: ColdConfig = field(default_factory=ColdConfig)
+    repairable: bool = False
+
+    @classmethod
+    def from_proto(cls, config):
+        """
+        Read a StorageConfig protobuf message field by field
+        """
+
+        filecoin = config.cold.filecoin
+
+        return cls(
+            hot=HotConfig(
+                enabled=config.hot.enabled,
+                allow_unfreeze=config.hot.allow_unfreeze,
+                add_timeout=config.hot.ipfs.add_timeout,
+            ),
+            cold=ColdConfig(
+                enabled=config.cold.enabled,
+                rep_factor=filecoin.rep_factor,
+                deal_min_duration=filecoin.deal_min_duration,
+                excluded_miners=tuple(filecoin.excluded_miners),
+                trusted_miners=tuple(filecoin.trusted_miners),
+                country_codes=tuple(filecoin.country_codes),
+                renew_enabled=filecoin.renew.enabled,
+                renew_threshold=filecoin.renew.threshold,
+                addr=filecoin.addr,
+                max_price=filecoin.max_price,
+            ),
+            repairable=config.repairable,
+        )
+
+    @classmethod
+    def from_form(cls, form, wallet):
+        """
+        Build a config from a submitted FfsConfigForm for the given wallet
+        """
+
+        return cls(
+            hot=HotConfig(
+                enabled=form.hot_enabled.data,
+                allow_unfreeze=form.allow_unfreeze.data,
+                add_timeout=form.add_timeout.data or 0,
+            ),
+            cold=ColdConfig(
+                enabled=form.cold_enabled.data,
+                rep_factor=form.rep_factor.data or 0,
+                deal_min_duration=form.deal_min_duration.data or 0,
+                excluded_miners=split_list(form.excluded_miners.data),
+                trusted_miners=split_list(form.trusted_miners.data),
+                country_codes=split_list(form.country_codes.data),
+                renew_enabled=form.renew_enabled.data,
+                renew_threshold=form.renew_threshold.data or 0,
+                addr=wallet,
+                max_price=form.max_price.data or 0,
+            ),
+            repairable=form.repairable.data,
+        )
+
+    def fill_form(self, form):
+        """
+        Set the fields of a FfsConfigForm from this config
+        """
+
+        form.hot_enabled.data = self.hot.enabled
+        form.allow_unfreeze.data = self.hot.allow_unfreeze
+        form.add_timeout.data = self.hot.add_timeout
+        form.cold_enabled.data = self.cold.enabled
+        form.rep_factor.data = self.cold.rep_factor
+        form.deal_min_duration.data = self.cold.deal_min_duration
+        form.excluded_miners.data = ",".join(self.cold.excluded_miners)
+        form.trusted_miners.data = ",".join(self.cold.trusted_miners)
+        form.country_codes.data = ",".join(self.cold.country_codes)
+        form.renew_enabled.data = self.cold.renew_enabled
+        form.renew_threshold.data = self.cold.renew_threshold
+        form.max_price.data = self.cold.max_price
+        form.repairable.data = self.repairable
+
+    def to_json(self):
+        """
+        Serialize the config in the JSON form Powergate accepts
+        """
+
+        return json.dumps(
+            {
+                "hot": {
+                    "enabled": self.hot.enabled,
+                    "allowUnfreeze": self.hot.allow_unfreeze,
+                    "ipfs": {"addTimeout": self.hot.add_timeout},
+                },
+                "cold": {
+                    "enabled": self.cold.enabled,
+                    "filecoin": {
+                        "repFactor": self.cold.rep_factor,
+                        "dealMinDuration": self.cold.deal_min_duration,
+                        "excludedMiners": list(self.cold.excluded_miners),
+                        "trustedMiners": list(self.cold.trusted_miners),
+                        "countryCodes": list(self.cold.country_codes),
+                        "renew": {
+                            "enabled": self.cold.renew_enabled,
+                            "threshold": self.cold.renew_threshold,
+                        },
+                        "addr": self.cold.addr,
+                        "maxPrice": self.cold.max_price,
+                    },
+                },
+                "repairable": self.repairable,
+            }
+        )
+
+
+def split_list(value):
+    """
+    Split a comma separated form value into a tuple of its non-empty items
+    """
+
+    if not value:
+        return ()
+
+    return tuple(item.strip() for item in value.split(",") if item.strip())
+
+
+def get_default_config(ffs):
+    """
+    Return the default storage config of a FFS, fetching it from its
+    Powergate node only when it is not cached, its cached copy has expired
+    or any worker process changed it since it was fetched
+    """
+
+    token = ffs.token
+    now = time.monotonic()
+    fetched = datetime.now()
+
+    with _configs_lock:
+        cached = _configs.get(token)
+    if (
+        cached is not None
+        and cached[1] > now
+        and (ffs.config_changed is None or ffs.config_changed < cached[2])
+    ):
+        return cached[0]
+
+    method = default_config_method()
+    reply = call_ffs(
+        get_powergate(node_of(ffs)), "ffs.default_config", method, method[1](), token
+    )
+    # The reply has the config as its only field, whose name differs
+    # between Powergate releases
+    config = StorageConfig.from_proto(getattr(reply, method[3]))
+
+    with _configs_lock:
+        _configs[token] = (config, now + app.config["FFS_CONFIG_CACHE_TTL"], fetched)
+
+    return config
+
+
+def set_default_config(ffs, config):
+    """
+    Change the default storage config of a FFS and drop its cached copy,
+    recording the change for the other worker processes to drop theirs
+    """
+
+    from google.protobuf.json_format import Parse
+
+    method = set_default_config_method()
+    request = method[1]()
+    Parse(config.to_json(), getattr(request, method[3]), ignore_unknown_fields=True)
+
+    try:
+        call_ffs(
+            get_powergate(node_of(ffs)),
+            "ffs.set_default_config",
+            method,
+            request,
+            ffs.token,
+        )
+    finally:
+        with _configs_lock:
+            _configs.pop(ffs.token, None)
+
+    ffs.config_changed = datetime.now()
+    db.session.commit()
+
+
+def ffs_method(*names):
+    """
+    Look up a call of the Powergate FFS service by the first of `names` it
+    has, returning its path, its request and reply types and the name of
+    the first field of its request, or of its reply if the request has
+    none. Powergate renamed the storage config calls and some of their
+    fields between releases.
+    """
+
+    from pygate_grpc import ffs as ffs_client
+
+    service = ffs_client.ffs_rpc_pb2.DESCRIPTOR.services_by_name["RPCService"]
+    method = next(
+        service.methods_by_name[name]
+        for name in names
+        if name in service.methods_by_name
+    )
+    fields = method.input_type.fields or method.output_type.fields
+
+    return (
+        "/{}/{}".format(service.full_name, method.name),
+        getattr(ffs_client.ffs_rpc_pb2, method.input_type.name),
+        getattr(ffs_client.ffs_rpc_pb2, method.output_type.name),
+        fields[0].name if fields else None,
+    )
+
+
+@lru_cache(maxsize=None)
+def default_config_method():
+    """
+    The call reading the default storage config of a FFS, named
+    DefaultConfig before Powergate renamed it to DefaultStorageConfig
+    """
+
+    return ffs_method("DefaultStorageConfig", "DefaultConfig")
+
+
+@lru_cache(maxsize=None)
+def set_default_config_method():
+    """
+    The call changing the default storage config of a FFS, named
+    SetDefaultConfig before Powergate renamed it to SetDefaultStorageConfig
+    """
+
+    return ffs_method("SetDefaultStorageConfig", "SetDefaultConfig")
+
+
+@lru_cache(maxsize=None)
+def push_method():
+    """
+    The call pushing a CID with a storage config, named PushConfig before
+    Powergate renamed it to PushStorageConfig
+    """
+
+    return ffs_method("PushStorageConfig", "PushConfig")
+
+
+def call_ffs(powergate, key, method, request, token):
+    """
+    Make a call looked up by ffs_method over the channel of a Powergate
+    client, timed under `key`, for the FFS with `token`
+    """
+
+    from pygate_grpc import ffs as ffs_client
+
+    path, request_type, reply_type, _ = method
+    call = powergate.channel.unary_unary(
+        path,
+        request_serializer=request_type.SerializeToString,
+        response_deserializer=reply_type.FromString,
+    )
+
+    return powergate.call(key, call, request, metadata=((ffs_client.TOKEN_KEY, token),))
+
+
+def push_config(powergate, cid, token, config_json):
+    """
+    Push a CID again with a pooled Powergate client, replacing the storage
+    config it was pushed with by `config_json` (as made by
+    StorageConfig.to_json). Returns the reply with the id of the new
+    storage job.
+    """
+
+    from google.protobuf.json_format import Parse
+
+    method = push_method()
+    request = method[1](
+        cid=cid, has_config=True, override_config=True, has_override_config=True
+    )
+    Parse(config_json, request.config, ignore_unknown_fields=True)
+
+    return call_ffs(powergate, "ffs.push", method, request, token)
@@ -1,19 +1,53 @@
 import os
-from datetime import datetime
-from flask import flash
-from pygate_grpc.client import PowerGateClient
-from pygate_grpc.ffs import get_file_bytes, bytes_to_chunks, chunks_to_bytes
-from google.protobuf.json_format import MessageToDict
+import json
+import hashlib
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_, func
+from sqlalchemy.orm import joinedload
 from pygate import app, db
-from pygate.models import Ffs, Logs, Files
+from pygate.models import (
+    Ffs,
+    Files,
+    Logs,
+    LogSearch,
+    has_log_search_index,
+)
+from pygate.analytics import count_uploads
+from pygate.eventlog import log_event
+from pygate.metrics import record_file_io, timed_chunks
+from pygate.powergate import (
+    available_nodes,
+    get_powergate,
+    get_shared_powergate,
+    node_of,
+    place_ffs,
+)
+from pygate.staging import mapped_chunks, stage_chunks
+from pygate.watcher import QUEUED, SUCCESS, wake_watcher
+
+CHUNK_SIZE = 1024 * 1024  # 1MB
+
+# Serializes the creation of a default FFS between concurrent upload workers
+_default_ffs_lock = threading.Lock()
 
 
 def create_ffs(default=False):
     """
-    Create a new Powergate Filecoin Filesystem (FFS)
+    Create a new Powergate Filecoin Filesystem (FFS) on the Powergate node
+    picked by place_ffs
     """
 
-    powergate = PowerGateClient(app.config["POWERGATE_ADDRESS"])
+    # Count the FFSes of every node, including those created before nodes
+    # were recorded
+    loads = {}
+    rows = db.session.query(Ffs.node, func.count(Ffs.id)).group_by(Ffs.node)
+    for ffs_node, count in rows:
+        address = ffs_node or app.config["POWERGATE_ADDRESS"]
+        loads[address] = loads.get(address, 0) + count
+    node = place_ffs(loads)
+    powergate = get_powergate(node)
 
     if default == True:
         default_ffs = Ffs.query.filter_by(default=True).first()
@@ -24,94 +58,528 @@ def create_ffs(default=False):
     ffs = powergate.ffs.create()
     creation_date = datetime.now().replace(microsecond=0)
     filecoin_file_system = Ffs(
-        ffs_id=ffs.id, token=ffs.token, creation_date=creation_date, default=default,
+        ffs_id=ffs.id,
+        token=ffs.token,
+        creation_date=creation_date,
+        default=default,
+        node=node,
     )
     db.session.add(filecoin_file_system)
+    db.session.commit()
 
     # Record new FFS creation in log table
-    event = Logs(
-        timestamp=creation_date,
-        event="Created new Filecoin FileSystem (FFS): " + ffs.id,
+    log_event(
+        "Created new Filecoin FileSystem (FFS): " + ffs.id + " on " + node,
+        creation_date,
     )
-    db.session.add(event)
-    db.session.commit()
 
     # Record creation of new FFS wallet in log table
     address = powergate.ffs.addrs_list(ffs.token)
-    obj = MessageToDict(address)
-    wallet = obj["addrs"][0]["addr"]
-    event = Logs(timestamp=creation_date, event="Created new Wallet: " + wallet,)
-    db.session.add(event)
-    db.session.commit()
+    wallet = address.addrs[0].addr
+    log_event("Created new Wallet: " + wallet, creation_date)
 
     new_ffs = Ffs.query.filter_by(ffs_id=ffs.id).first()
 
     return new_ffs
 
 
-def push_to_filecoin(upload_path, file_name):
+def save_upload(upload, upload_path, file_name):
+    """
+    Save an uploaded file while hashing it, returning its SHA-256 hex digest
+    """
 
-    # Push file to Filecoin via Powergate
-    powergate = PowerGateClient(app.config["POWERGATE_ADDRESS"])
+    digest = hashlib.sha256()
+    size = 0
+    started = time.perf_counter()
+    with open(os.path.join(upload_path, file_name), "wb") as out_file:
+        while True:
+            chunk = upload.stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            out_file.write(chunk)
+            size += len(chunk)
+    record_file_io("upload_write", time.perf_counter() - started, size)
+
+    return digest.hexdigest()
 
-    # Retrieve information for default Filecoin FileSystem (FFS)
-    ffs = Ffs.query.filter_by(default=True).first()
 
-    if ffs is None:
-        # No FFS exists yet so create one
-        ffs = create_ffs(default=True)
+def push_to_filecoin(upload_path, file_name, content_hash=None):
+    """
+    Stage a saved upload in the hot set of the default FFS, push it to
+    Filecoin and record it in the files table. Errors are logged and then
+    re-raised for the caller to report.
+    """
+
+    file_upload, stored = stage_upload(upload_path, file_name, content_hash)
+    record_uploads([(file_upload, stored)])
+
+    return file_upload
+
+
+def stage_upload(upload_path, file_name, content_hash=None, progress=None):
+    """
+    Stage a saved upload in the hot set of the default FFS and push it to
+    Filecoin without recording it. Returns the unsaved Files row of the
+    upload and the stored file it duplicates, or None. Errors are logged and
+    then re-raised for the caller to report.
+
+    If the content hash of the upload is known and DEDUPLICATE_UPLOADS is set,
+    content whose storage job succeeded is not staged again but takes the
+    CID and FFS of the stored copy. `progress` is called with the number of bytes
+    staged so far as they are sent.
+    """
+
+    if content_hash is not None and app.config["DEDUPLICATE_UPLOADS"]:
+        # Copies still being stored, or whose storage failed, may never
+        # be retrievable
+        stored = Files.query.filter_by(
+            content_hash=content_hash, storage_status=SUCCESS
+        ).first()
+        if stored is not None:
+            file_upload = Files(
+                file_path=upload_path,
+                file_name=file_name,
+                upload_date=None,
+                file_size=stored.file_size,
+                CID=stored.CID,
+                ffs_id=stored.ffs_id,
+                content_hash=stored.content_hash,
+                storage_job_id=stored.storage_job_id,
+                storage_status=stored.storage_status,
+                storage_error=stored.storage_error,
+            )
+            return file_upload, stored
+
+    # Map the uploaded file into memory and send it from there
+    file_iterator = timed_chunks(
+        "stage_read", mapped_chunks(os.path.join(upload_path, file_name))
+    )
 
     try:
-        # Create an iterator of the uploaded file using the helper function
-        file_iterator = get_file_bytes(os.path.join(upload_path, file_name))
-
-        # Convert the iterator into request and then add to the hot set (IPFS)
-        file_hash = powergate.ffs.stage(bytes_to_chunks(file_iterator), ffs.token)
-
-        # Push the file to Filecoin
-        powergate.ffs.push(file_hash.cid, ffs.token)
-        """TODO: DELETE CACHED COPIES OF FILE UPLOADS """
-
-        # Note the upload date and file size
-        upload_date = datetime.now().replace(microsecond=0)
-        file_size = os.path.getsize(os.path.join(upload_path, file_name))
-
-        # Save file information to database
-        file_upload = Files(
-            file_path=upload_path,
-            file_name=file_name,
-            upload_date=upload_date,
-            file_size=file_size,
-            CID=file_hash.cid,
-            ffs_id=ffs.id,
+        ffs = get_default_ffs()
+        cid, job_id, counter = stage_stream(file_iterator, ffs, progress)
+    except Exception as e:
+        # Update log table with error
+        log_event("Upload ERROR: " + file_name + " " + str(e))
+        raise
+
+    file_upload = Files(
+        file_path=upload_path,
+        file_name=file_name,
+        upload_date=None,
+        file_size=counter.count,
+        CID=cid,
+        ffs_id=ffs.id,
+        content_hash=counter.hexdigest(),
+        storage_job_id=job_id,
+        storage_status=QUEUED,
+    )
+
+    return file_upload, None
+
+
+def record_uploads(uploads):
+    """
+    Save the Files rows of pushed uploads together with their log entries
+    and the usage totals in a single transaction. `uploads` pairs each
+    unsaved row with the stored file it duplicates, or None.
+    """
+
+    upload_date = datetime.now().replace(microsecond=0)
+
+    try:
+        for file_upload, stored in uploads:
+            file_upload.upload_date = upload_date
+            if file_upload.storage_job_id is not None:
+                file_upload.storage_updated = upload_date
+            db.session.add(file_upload)
+            # Written with the files rather than queued by log_event, so the
+            # log never mentions an upload that was not recorded
+            db.session.add(Logs(upload_date, upload_event(file_upload, stored)))
+        count_uploads(
+            (file_upload.ffs_id, upload_date, file_upload.file_size)
+            for file_upload, _ in uploads
         )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    wake_watcher()
+
 
-        # Record file upload in log table
-        event = Logs(
-            timestamp=upload_date,
-            event="Uploaded "
-            + file_name
+def upload_event(file_upload, stored=None):
+    """
+    Return the log entry recording an upload
+    """
+
+    if stored is not None:
+        return (
+            "Uploaded "
+            + file_upload.file_name
             + " (CID: "
-            + file_hash.cid
-            + ") to Filecoin.",
+            + file_upload.CID
+            + "), identical to stored file "
+            + stored.file_name
+            + "."
         )
-        db.session.add(file_upload)
-        db.session.add(event)
-        db.session.commit()
 
-    except Exception as e:
-        # Output error message if pushing to Filecoin fails
-        flash("'{}' failed to upload to Filecoin. {}".format(file_name, e))
+    return (
+        "Uploaded "
+        + file_upload.file_name
+        + " (CID: "
+        + file_upload.CID
+        + ") to Filecoin."
+    )
+
+
+def push_stream_to_filecoin(file_iterator, file_name, upload_path=None):
+    """
+    Stage a stream of bytes in the hot set of the default FFS as it is read,
+    push it to Filecoin and record it in the files table under `file_name`.
+    Errors are logged and then re-raised for the caller to report.
+    """
 
+    try:
+        ffs = get_default_ffs()
+        cid, job_id, counter = stage_stream(file_iterator, ffs)
+    except Exception as e:
         # Update log table with error
-        event = Logs(
-            timestamp=datetime.now().replace(microsecond=0),
-            event="Upload ERROR: " + file_name + " " + str(e),
-        )
-        db.session.add(event)
-        db.session.commit()
+        log_event("Upload ERROR: " + file_name + " " + str(e))
 
         """TODO: RESPOND TO SPECIFIC STATUS CODE DETAILS
         (how to isolate these? e.g. 'status_code.details = ...')"""
+        raise
+
+    # Save file information to database
+    file_upload = Files(
+        file_path=upload_path,
+        file_name=file_name,
+        upload_date=None,
+        file_size=counter.count,
+        CID=cid,
+        ffs_id=ffs.id,
+        content_hash=counter.hexdigest(),
+        storage_job_id=job_id,
+        storage_status=QUEUED,
+    )
+    record_uploads([(file_upload, None)])
+
+    return file_upload
+
+
+def get_default_ffs():
+    """
+    Return the default FFS, creating it if there is none yet
+    """
+
+    # Retrieve information for default Filecoin FileSystem (FFS)
+    with _default_ffs_lock:
+        ffs = Ffs.query.filter_by(default=True).first()
+
+        if ffs is None:
+            # No FFS exists yet so create one
+            ffs = create_ffs(default=True)
+
+    return ffs
+
+
+def stage_stream(file_iterator, ffs, progress=None):
+    """
+    Stage a stream of bytes in the hot set of a FFS as it is read and push
+    it to Filecoin. Returns the CID, the id of the storage job pushing it and
+    the ByteCounter of the stream.
+    """
+
+    # Push file to Filecoin via the Powergate node of the FFS
+    powergate = get_shared_powergate(node_of(ffs))
+
+    # Count and hash the bytes on their way through instead of reading
+    # them again
+    counter = ByteCounter(file_iterator, progress)
+
+    # Add the chunks to the hot set (IPFS) as they are read
+    file_hash = stage_chunks(powergate, counter, ffs.token)
+
+    # Push the file to Filecoin, keeping the storage job to follow its deals
+    job = powergate.ffs.push(file_hash.cid, ffs.token)
+
+    return file_hash.cid, job.job_id, counter
+
+
+class ByteCounter(object):
+    """
+    Iterate over a stream of byte chunks while counting their total length
+    and computing their SHA-256 digest, reporting the count to `progress`
+    after each chunk if given
+    """
+
+    def __init__(self, chunks, progress=None):
+        self.chunks = chunks
+        self.progress = progress
+        self.count = 0
+        self.digest = hashlib.sha256()
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.count += len(chunk)
+            self.digest.update(chunk)
+            if self.progress is not None:
+                self.progress(self.count)
+            yield chunk
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+# Columns of the files table that can be sorted, keyed by their position
+# in the files.html table. Each has a composite (column, id) index.
+FILE_SORT_COLUMNS = {
+    0: Files.file_name,
+    2: Files.upload_date,
+    3: Files.CID,
+}
+
+# Prefixes of upload dates that the file search matches, longest first, with
+# the period each stands for. Years and months are of varying length.
+DATE_PREFIXES = (
+    ("%Y-%m-%d %H:%M:%S", timedelta(seconds=1)),
+    ("%Y-%m-%d %H:%M", timedelta(minutes=1)),
+    ("%Y-%m-%d %H", timedelta(hours=1)),
+    ("%Y-%m-%d", timedelta(days=1)),
+    ("%Y-%m", None),
+    ("%Y", None),
+)
+
 
-    return ()
+def list_files(
+    length=10, start=0, search="", sort_column=2, descending=True, after=None
+):
+    """
+    Return one page of stored files plus the total and filtered row counts.
+
+    Pages are fetched with keyset pagination when the cursor of the previous
+    page is passed in `after`, falling back to an offset otherwise (e.g. when
+    jumping straight to the last page). The returned cursor points at the last
+    row of the page and can be used to fetch the next one.
+    """
+
+    column = FILE_SORT_COLUMNS.get(sort_column, Files.upload_date)
+
+    # Load the parent FFS of each file in the same query
+    query = Files.query.options(joinedload("Ffs"))
+
+    if search:
+        # Prefix matches keep the lookups on the file name and CID indexes
+        prefix = escape_like(search) + "%"
+        conditions = [
+            Files.file_name.like(prefix, escape="\\"),
+            Files.CID.like(prefix, escape="\\"),
+        ]
+        # Dates are matched on the column itself, so its index can be used
+        bounds = date_bounds(search)
+        if bounds is not None:
+            conditions.append(
+                and_(Files.upload_date >= bounds[0], Files.upload_date < bounds[1])
+            )
+        query = query.filter(or_(*conditions))
+
+    total = db.session.query(func.count(Files.id)).scalar()
+    filtered = query.count() if search else total
+
+    page, cursor = keyset_page(
+        query, column, Files.id, length, start, descending, after
+    )
+
+    return page, total, filtered, cursor
+
+
+def escape_like(text):
+    """
+    Escape the wildcards of LIKE patterns in `text`, to be matched literally
+    with escape="\\"
+    """
+
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def date_bounds(search):
+    """
+    Return the first moment and the end of the period that a date and time
+    written as a prefix of "YYYY-MM-DD HH:MM:SS" stands for, such as
+    "2020-09" for September 2020, or None if `search` is not one
+    """
+
+    for date_format, period in DATE_PREFIXES:
+        try:
+            start = datetime.strptime(search, date_format)
+        except ValueError:
+            continue
+        # Only zero-padded fields, as dates are written
+        if start.strftime(date_format) != search:
+            continue
+
+        if date_format == "%Y":
+            return start, start.replace(year=start.year + 1)
+        if date_format == "%Y-%m":
+            return start, (start + timedelta(days=31)).replace(day=1)
+        return start, start + period
+
+    return None
+
+
+def keyset_page(query, column, id_column, length, start, descending, after):
+    """
+    Return one page of a query sorted on (column, id) and the cursor of its
+    last row. With the cursor of the previous page in `after` the page is
+    found by seeking the (column, id) index, otherwise by an offset.
+    """
+
+    if after is not None:
+        value, last_id = decode_cursor(after, column)
+        if descending:
+            query = query.filter(
+                or_(column < value, and_(column == value, id_column < last_id))
+            )
+        else:
+            query = query.filter(
+                or_(column > value, and_(column == value, id_column > last_id))
+            )
+
+    if descending:
+        query = query.order_by(column.desc(), id_column.desc())
+    else:
+        query = query.order_by(column.asc(), id_column.asc())
+
+    if after is None and start > 0:
+        query = query.offset(start)
+
+    page = query.limit(length).all()
+
+    cursor = encode_cursor(page[-1], column) if page else None
+
+    return page, cursor
+
+
+def encode_cursor(row, column):
+    """
+    Serialize the sort value and id of a row into an opaque cursor
+    """
+
+    value = getattr(row, column.key)
+    if isinstance(value, datetime):
+        value = value.isoformat()
+
+    return json.dumps([value, row.id])
+
+
+def decode_cursor(cursor, column):
+    """
+    Parse a cursor created by encode_cursor back into its sort value and id
+    """
+
+    value, last_id = json.loads(cursor)
+    if isinstance(column.type, db.DateTime):
+        value = datetime.fromisoformat(value)
+
+    return value, int(last_id)
+
+
+def slice_chunks(chunks, start, stop):
+    """
+    Yield only the bytes from offset `start` up to `stop` of a chunk stream
+    """
+
+    position = 0
+    for chunk in chunks:
+        end = position + len(chunk)
+        if end > start:
+            yield chunk[max(start - position, 0) : stop - position]
+        position = end
+        if position >= stop:
+            return
+
+
+def file_copies(cid):
+    """
+    Return the stored (file, FFS) pairs with a CID, those on available
+    Powergate nodes first, so that a download can fail over to a copy on
+    another node
+    """
+
+    copies = (
+        db.session.query(Files, Ffs)
+        .join(Ffs, Files.ffs_id == Ffs.id)
+        .filter(Files.CID == cid)
+        .order_by(Files.id)
+        .all()
+    )
+    available = set(available_nodes())
+
+    return sorted(copies, key=lambda copy: node_of(copy[1]) not in available)
+
+
+def log_download(file):
+    """
+    Update log table with download information
+    """
+
+    log_event(
+        "Downloaded " + file.file_name + " (CID: " + file.CID + ") from Filecoin."
+    )
+
+
+def list_logs(
+    length=10,
+    start=0,
+    search="",
+    since=None,
+    until=None,
+    descending=True,
+    after=None,
+):
+    """
+    Return one page of log entries sorted by timestamp plus the total and
+    filtered entry counts, optionally limited to a time range and to entries
+    containing all words of `search`. Paging works as in list_files().
+    """
+
+    query = Logs.query
+
+    if since is not None:
+        query = query.filter(Logs.timestamp >= since)
+    if until is not None:
+        query = query.filter(Logs.timestamp < until)
+    if search:
+        query = query.filter(log_search_condition(search))
+
+    total = db.session.query(func.count(Logs.id)).scalar()
+    filtered = query.count() if (search or since or until) else total
+
+    page, cursor = keyset_page(
+        query, Logs.timestamp, Logs.id, length, start, descending, after
+    )
+
+    return page, total, filtered, cursor
+
+
+def log_search_condition(search):
+    """
+    Match log entries containing every word of `search`, using the full-text
+    index on SQLite and a substring match on other databases
+    """
+
+    words = search.split()
+
+    if has_log_search_index():
+        # Quote each word so FTS5 query syntax in the input is taken literally
+        match = " ".join('"{}"*'.format(word.replace('"', '""')) for word in words)
+        matches = db.session.query(LogSearch.c.rowid).filter(
+            LogSearch.c.logs_fts.match(match)
+        )
+        return Logs.id.in_(matches)
+
+    return and_(
+        *[Logs.event.like("%" + escape_like(word) + "%", escape="\\") for word in words]
+    )
@@ -0,0 +1,629 @@
+"""
+Import existing files in bulk from a local directory tree or a manifest of
+paths and CIDs, staging and pushing them with a pool of workers and
+recording progress so an interrupted import resumes where it stopped
+"""
+
+import csv
+import itertools
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import click
+from sqlalchemy import or_
+from pygate import app, db
+from pygate.models import Ffs, Files, ImportItems, ImportRuns, Logs
+from pygate.analytics import count_uploads
+from pygate.eventlog import log_event
+from pygate.helpers import ByteCounter, get_default_ffs
+from pygate.powergate import get_shared_powergate, node_of
+from pygate.staging import mapped_chunks, stage_chunks
+from pygate.watcher import QUEUED as STORAGE_QUEUED, wake_watcher
+from pygate.workers import worker_id, worker_alive
+
+# Kinds of import source
+DIRECTORY = "directory"
+MANIFEST = "manifest"
+
+# Run statuses
+SCANNING = "scanning"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Item statuses (and DONE, FAILED)
+PENDING = "pending"
+SKIPPED = "skipped"
+
+MANIFEST_EXTENSIONS = (".csv", ".jsonl", ".ndjson")
+
+# Ids of the runs being imported by this process
+_running = set()
+_running_lock = threading.Lock()
+
+
+class ImportRunError(Exception):
+    """
+    Raised for an import source that cannot be read or a run that cannot
+    be started
+    """
+
+
+def source_kind(source):
+    if os.path.isdir(source):
+        return DIRECTORY
+    if os.path.isfile(source) and source.lower().endswith(MANIFEST_EXTENSIONS):
+        return MANIFEST
+
+    raise ImportRunError(
+        "{} is neither a directory nor a .csv or .jsonl manifest".format(source)
+    )
+
+
+def import_root(source):
+    """
+    Return the directory the files of an import must lie in once symbolic
+    links are resolved: IMPORT_ROOT when the source is inside it, otherwise
+    (for imports started from the command line) the directory imported or
+    the directory of the manifest
+    """
+
+    source = os.path.realpath(source)
+    root = app.config["IMPORT_ROOT"]
+    if root:
+        root = os.path.realpath(root)
+        if os.path.commonpath([root, source]) == root:
+            return root
+
+    return source if os.path.isdir(source) else os.path.dirname(source)
+
+
+def check_contained(path, root):
+    """
+    Raise ImportRunError unless `path` lies inside `root` once symbolic
+    links and ".." are resolved
+    """
+
+    if os.path.commonpath([root, os.path.realpath(path)]) != root:
+        raise ImportRunError("{} is outside of {}".format(path, root))
+
+
+def walk_directory(root, contained_in=None):
+    """
+    Yield an item for every file under `root` in the order of walk_key, so
+    that a scan can be resumed after the last file it found. Files that are
+    symbolic links to a file outside of `contained_in` become failed items.
+    """
+
+    contained_in = contained_in or os.path.realpath(root)
+
+    for directory, subdirectories, file_names in os.walk(root):
+        subdirectories.sort()
+        for file_name in sorted(file_names):
+            path = os.path.join(directory, file_name)
+            if not os.path.isfile(path):
+                continue
+            name = os.path.relpath(path, root).replace(os.sep, "/")
+            item = {
+                "path": path,
+                "file_name": name if len(name) <= 255 else file_name[:255],
+            }
+            try:
+                check_contained(path, contained_in)
+            except ImportRunError as e:
+                item.update(status=FAILED, error=str(e)[:255])
+            else:
+                item["file_size"] = os.path.getsize(path)
+            yield item
+
+
+def walk_key(name):
+    """
+    Sort key of a file path relative to the root of walk_directory, in the
+    order it yields them: the files of a directory by name, then those of
+    each of its subdirectories by name
+    """
+
+    parts = name.split(os.sep)
+
+    return [(1, part) for part in parts[:-1]] + [(0, parts[-1])]
+
+
+def read_manifest(manifest, contained_in=None):
+    """
+    Yield an item for every line of a CSV (with a header) or JSON lines
+    manifest. Each line names a `path` to stage, relative to the manifest,
+    or an existing `cid` to push, optionally with a `name` and `size`.
+    Lines that cannot be read, and paths outside of `contained_in` (the
+    directory of the manifest by default), become failed items.
+    """
+
+    base = os.path.dirname(os.path.abspath(manifest))
+    contained_in = contained_in or os.path.realpath(base)
+
+    with open(manifest, newline="") as in_file:
+        if manifest.lower().endswith(".csv"):
+            lines = csv.DictReader(in_file)
+        else:
+            lines = in_file
+
+        for number, line in enumerate(lines, 1):
+            try:
+                if not isinstance(line, dict):
+                    if not line.strip():
+                        continue
+                    line = json.loads(line)
+                yield _manifest_item(line, base, contained_in)
+            except (ValueError, TypeError, AttributeError, ImportRunError) as e:
+                yield {
+                    "status": FAILED,
+                    "error": "Line {}: {}".format(number, e)[:255],
+                }
+
+
+def _manifest_item(line, base, contained_in):
+    path = (line.get("path") or "").strip()
+    cid = (line.get("cid") or line.get("CID") or "").strip()
+    if bool(path) == bool(cid):
+        raise ValueError("give either a path or a cid")
+
+    size = line.get("size")
+    item = {
+        "file_name": str(line.get("name") or "")[:255],
+        "file_size": int(size) if size not in (None, "") else None,
+    }
+
+    if cid:
+        item["CID"] = cid
+        item["file_name"] = item["file_name"] or cid
+    else:
+        path = os.path.normpath(os.path.join(base, path))
+        check_contained(path, contained_in)
+        item["path"] = path
+        item["file_name"] = item["file_name"] or os.path.basename(path)[:255]
+
+    return item
+
+
+def create_run(source):
+    """
+    Record a new import of a directory tree or manifest into the default
+    FFS. Its items are found when it is run.
+    """
+
+    source = os.path.abspath(source)
+    kind = source_kind(source)
+
+    run = ImportRuns(
+        source=source,
+        kind=kind,
+        status=SCANNING,
+        ffs_id=get_default_ffs().id,
+        created=datetime.now().replace(microsecond=0),
+    )
+    db.session.add(run)
+    db.session.commit()
+    log_event("Started import {} of {}".format(run.id, source))
+
+    return run
+
+
+def run_import(run_id, workers=None, retry_failed=False, report=None):
+    """
+    Find the items of an import, if that is not finished yet, then stage
+    and push its pending items. Progress is recorded every
+    IMPORT_BATCH_SIZE items, so a run that is interrupted picks up from its
+    last batch. `report` is called with the run after every batch.
+    """
+
+    with _running_lock:
+        if run_id in _running:
+            raise ImportRunError("Import {} is already running".format(run_id))
+        _running.add(run_id)
+
+    try:
+        run = claim_run(run_id)
+    except Exception:
+        with _running_lock:
+            _running.discard(run_id)
+        raise
+
+    try:
+        if retry_failed:
+            # Lines of a manifest that could not be read fail again anyway
+            retried = (
+                ImportItems.query.filter_by(run_id=run.id, status=FAILED)
+                .filter(or_(ImportItems.path.isnot(None), ImportItems.CID.isnot(None)))
+                .update({"status": PENDING, "error": None}, synchronize_session=False)
+            )
+            run.failed -= retried
+            db.session.commit()
+
+        if run.status == SCANNING:
+            scan(run)
+            run.status = RUNNING
+            db.session.commit()
+
+        workers = workers or app.config["IMPORT_WORKERS"]
+        with ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="pygate-import"
+        ) as executor:
+            while import_batch(run, executor):
+                if report is not None:
+                    report(run)
+
+        run.status = DONE
+        run.updated = datetime.now().replace(microsecond=0)
+        db.session.commit()
+        log_event(
+            "Finished import {}: {} imported, {} skipped, {} failed".format(
+                run.id, run.done, run.skipped, run.failed
+            )
+        )
+    except Exception as e:
+        db.session.rollback()
+        run = ImportRuns.query.get(run_id)
+        if run is not None:
+            run.status = FAILED
+            run.error = str(e)[:255]
+            db.session.commit()
+        log_event("Import ERROR: {} {}".format(run_id, e))
+        raise
+    finally:
+        with _running_lock:
+            _running.discard(run_id)
+
+    return run
+
+
+def running_elsewhere(run):
+    """
+    Whether another live process is running an import
+    """
+
+    return (
+        run.status in (SCANNING, RUNNING)
+        and run.worker not in (None, worker_id())
+        and worker_alive(run.worker)
+    )
+
+
+def claim_run(run_id):
+    """
+    Take over a run for this process, unless another live process runs it
+    """
+
+    run = ImportRuns.query.get(run_id)
+    if run is None:
+        raise ImportRunError("There is no import {}".format(run_id))
+    if running_elsewhere(run):
+        raise ImportRunError(
+            "Import {} is running in process {}".format(run_id, run.worker)
+        )
+
+    if run.status in (DONE, FAILED):
+        # Scan the source again for files added after the last one found,
+        # or lines added to a manifest, and those missed by a scan that
+        # failed
+        run.status = SCANNING
+    run.worker = worker_id()
+    run.error = None
+    db.session.commit()
+
+    return run
+
+
+def scan(run):
+    """
+    Record the items of a run in bulk, skipping those found by an earlier
+    scan
+    """
+
+    batch = []
+    for item in _new_items(run):
+        item.setdefault("status", PENDING)
+        item["run_id"] = run.id
+        batch.append(item)
+        if len(batch) >= app.config["IMPORT_BATCH_SIZE"]:
+            _save_items(run, batch)
+            batch = []
+    _save_items(run, batch)
+
+
+def _new_items(run):
+    # Items of a directory are skipped up to the last file found, so files
+    # added or removed since do not shift the checkpoint. The lines of a
+    # manifest keep their position, so those found are skipped by count.
+    root = import_root(run.source)
+    last = (
+        ImportItems.query.filter_by(run_id=run.id)
+        .order_by(ImportItems.id.desc())
+        .first()
+    )
+
+    if run.kind == DIRECTORY:
+        items = walk_directory(run.source, root)
+        if last is None or last.path is None:
+            return items
+
+        checkpoint = walk_key(os.path.relpath(last.path, run.source))
+        return (
+            item
+            for item in items
+            if walk_key(os.path.relpath(item["path"], run.source)) > checkpoint
+        )
+
+    found = ImportItems.query.filter_by(run_id=run.id).count()
+
+    return itertools.islice(read_manifest(run.source, root), found, None)
+
+
+def _save_items(run, items):
+    failed = sum(1 for item in items if item["status"] == FAILED)
+    db.session.bulk_insert_mappings(ImportItems, items)
+    run.total = ImportItems.query.filter_by(run_id=run.id).count()
+    run.failed += failed
+    run.updated = datetime.now().replace(microsecond=0)
+    db.session.commit()
+
+
+def import_batch(run, executor):
+    """
+    Stage and push the next batch of pending items of a run, then record
+    them, their files and log entries in one transaction. Returns how many
+    items were handled.
+    """
+
+    items = (
+        ImportItems.query.filter_by(run_id=run.id, status=PENDING)
+        .order_by(ImportItems.id)
+        .limit(app.config["IMPORT_BATCH_SIZE"])
+        .all()
+    )
+    if not items:
+        return 0
+
+    ffs = Ffs.query.get(run.ffs_id)
+    node = node_of(ffs)
+
+    # Existing CIDs that are already recorded are not pushed again
+    cids = [item.CID for item in items if item.CID]
+    known = set()
+    if cids:
+        known = {
+            cid for (cid,) in db.session.query(Files.CID).filter(Files.CID.in_(cids))
+        }
+
+    root = import_root(run.source)
+    work = []
+    updates = []
+    for item in items:
+        if item.CID in known:
+            updates.append({"id": item.id, "status": SKIPPED})
+            continue
+        try:
+            if item.path is not None:
+                # Checked again, as links may have changed since the scan
+                check_contained(item.path, root)
+        except ImportRunError as e:
+            updates.append({"id": item.id, "status": FAILED, "error": str(e)[:255]})
+        else:
+            work.append(
+                (
+                    item,
+                    executor.submit(
+                        import_item, node, item.path, item.CID, ffs.token
+                    ),
+                )
+            )
+
+    now = datetime.now().replace(microsecond=0)
+    files = []
+    for item, future in work:
+        try:
+            cid, size, content_hash, job_id = future.result()
+        except Exception as e:
+            updates.append({"id": item.id, "status": FAILED, "error": str(e)[:255]})
+            continue
+
+        file_upload = Files(
+            file_path=item.path and os.path.dirname(item.path)[:255],
+            file_name=item.file_name,
+            upload_date=now,
+            file_size=size if size is not None else item.file_size,
+            CID=cid,
+            ffs_id=run.ffs_id,
+            content_hash=content_hash,
+            storage_job_id=job_id,
+            storage_status=STORAGE_QUEUED,
+        )
+        file_upload.storage_updated = now
+        files.append((item, file_upload))
+
+    try:
+        if files:
+            # Inserted row by row, so each item gets the id of its own file
+            # even when several items share a CID
+            db.session.add_all(file_upload for _, file_upload in files)
+            db.session.flush()
+            db.session.bulk_insert_mappings(
+                Logs,
+                [
+                    {
+                        "timestamp": now,
+                        "event": "Imported {} (CID: {}) to Filecoin.".format(
+                            file_upload.file_name, file_upload.CID
+                        )[:255],
+                    }
+                    for _, file_upload in files
+                ],
+            )
+            count_uploads(
+                (file_upload.ffs_id, now, file_upload.file_size)
+                for _, file_upload in files
+            )
+            updates += [
+                {"id": item.id, "status": DONE, "file_id": file_upload.id}
+                for item, file_upload in files
+            ]
+        db.session.bulk_update_mappings(ImportItems, updates)
+
+        run.done += len(files)
+        run.skipped += sum(1 for update in updates if update["status"] == SKIPPED)
+        run.failed += sum(1 for update in updates if update["status"] == FAILED)
+        run.bytes_imported += sum(
+            file_upload.file_size or 0 for _, file_upload in files
+        )
+        run.updated = now
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    if files:
+        wake_watcher()
+
+    return len(items)
+
+
+def import_item(node, path, cid, token):
+    """
+    Stage a file and push it to Filecoin, or push an existing CID, through
+    the Powergate node of the FFS. Runs on a worker thread without database
+    access. Returns the CID, size, content hash and storage job id.
+    """
+
+    powergate = get_shared_powergate(node)
+    if path is None:
+        job = powergate.ffs.push(cid, token)
+        return cid, None, None, job.job_id
+
+    # Fail on a missing file here rather than inside the gRPC stream
+    os.stat(path)
+    counter = ByteCounter(mapped_chunks(path))
+    reply = stage_chunks(powergate, counter, token)
+    job = powergate.ffs.push(reply.cid, token)
+
+    return reply.cid, counter.count, counter.hexdigest(), job.job_id
+
+
+def run_to_dict(run, failures=0):
+    """
+    Describe an import run for the JSON API, with up to `failures` of its
+    failed items
+    """
+
+    result = {
+        "id": run.id,
+        "source": run.source,
+        "kind": run.kind,
+        "status": run.status,
+        "error": run.error,
+        "total": run.total,
+        "done": run.done,
+        "failed": run.failed,
+        "skipped": run.skipped,
+        "pending": max(run.total - run.done - run.failed - run.skipped, 0),
+        "bytes_imported": run.bytes_imported,
+        "created": str(run.created),
+        "updated": str(run.updated),
+    }
+
+    if failures:
+        items = (
+            ImportItems.query.filter_by(run_id=run.id, status=FAILED)
+            .order_by(ImportItems.id)
+            .limit(failures)
+        )
+        result["failures"] = [
+            {"path": item.path, "CID": item.CID, "error": item.error}
+            for item in items
+        ]
+
+    return result
+
+
+def start_import(run_id, retry_failed=False):
+    """
+    Run an import from a background thread
+    """
+
+    threading.Thread(
+        target=_run_import_logged,
+        args=(run_id, retry_failed),
+        name="pygate-import-run",
+        daemon=True,
+    ).start()
+
+
+def _run_import_logged(run_id, retry_failed):
+    with app.app_context():
+        try:
+            run_import(run_id, retry_failed=retry_failed)
+        except Exception:
+            # run_import has logged the error and marked the run failed
+            pass
+
+
+def resume_imports():
+    """
+    Restart in the background the imports whose process stopped before
+    they finished
+    """
+
+    runs = ImportRuns.query.filter(ImportRuns.status.in_([SCANNING, RUNNING])).all()
+    resumed = 0
+    for run in runs:
+        if run.worker is None or not worker_alive(run.worker):
+            start_import(run.id)
+            resumed += 1
+
+    return resumed
+
+
+@app.cli.command("import")
+@click.argument("source", required=False)
+@click.option("--resume", "run_id", type=int, help="Resume the import with this id.")
+@click.option(
+    "--retry-failed",
+    is_flag=True,
+    help="Try the failed items of a resumed import again.",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Files staged at once (default: IMPORT_WORKERS).",
+)
+def import_command(source, run_id, retry_failed, workers):
+    """
+    Import a directory tree, or a .csv or .jsonl manifest of paths and CIDs,
+    into the default FFS
+    """
+
+    if (source is None) == (run_id is None):
+        raise click.UsageError("Give a SOURCE to import or --resume an import")
+
+    try:
+        if run_id is None:
+            run_id = create_run(source).id
+            click.echo("Import {} of {}".format(run_id, source))
+
+        def report(run):
+            click.echo(
+                "{} of {} imported, {} skipped, {} failed".format(
+                    run.done, run.total, run.skipped, run.failed
+                )
+            )
+
+        run = run_import(run_id, workers, retry_failed, report)
+    except ImportRunError as e:
+        raise click.ClickException(str(e))
+
+    click.echo(
+        "Import {} finished: {} imported, {} skipped, {} failed".format(
+            run.id, run.done, run.skipped, run.failed
+        )
+    )
@@ -0,0 +1,509 @@
+"""
+Push uploads to Filecoin from a local pool of background workers
+"""
+
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from werkzeug.utils import secure_filename
+from pygate import app, db
+from pygate.models import Files, Jobs
+from pygate.helpers import save_upload, stage_upload, record_uploads
+from pygate.eventlog import log_event
+from pygate.lifecycle import (
+    PUSHED as COPY_PUSHED,
+    FAILED as COPY_FAILED,
+    new_upload_directory,
+    track_copies,
+    update_copy,
+)
+from pygate.watcher import QUEUED as STORAGE_QUEUED
+from pygate.workers import worker_id, worker_alive
+
+QUEUED = "queued"
+RUNNING = "running"
+PUSHED = "pushed"
+DONE = "done"
+FAILED = "failed"
+
+_executor = None
+_executor_lock = threading.Lock()
+_space = None
+
+# Wakes up anyone waiting on a status change of a job run in this process,
+# counting the changes so that none is missed between a query and a wait
+_status_changed = threading.Condition()
+_changes = 0
+
+
+class UploadSpace(object):
+    """
+    Count the bytes of saved uploads that are waiting to be pushed against a
+    limit, making new uploads wait until earlier ones are pushed
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def reserve(self, size, timeout=None):
+        """
+        Reserve space for an upload of `size` bytes, waiting up to `timeout`
+        seconds for it. Returns False if the space did not come free in time.
+        An upload larger than the limit is let through when nothing else is
+        waiting. Without a timeout the space is taken straight away.
+        """
+
+        with self._condition:
+            if timeout is not None and not self._condition.wait_for(
+                lambda: self.used == 0 or self.used + size <= self.limit, timeout
+            ):
+                return False
+            self.used += size
+
+        return True
+
+    def release(self, size):
+        with self._condition:
+            self.used = max(self.used - size, 0)
+            self._condition.notify_all()
+
+
+def _get_executor():
+    """
+    Create the worker pool on first use
+    """
+
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=app.config["PUSH_WORKERS"],
+                thread_name_prefix="pygate-push",
+            )
+
+    return _executor
+
+
+def get_upload_space():
+    """
+    Return the UploadSpace of this process, creating it on first use
+    """
+
+    global _space
+
+    with _executor_lock:
+        if _space is None:
+            _space = UploadSpace(app.config["UPLOAD_PENDING_BYTES_MAX"])
+
+    return _space
+
+
+def new_batch_id():
+    return uuid.uuid4().hex
+
+
+def submit_uploads(uploads, upload_path, batch_id=None):
+    """
+    Save uploaded files and queue them to be pushed as one batch, recording
+    each file as soon as it has been pushed. Returns the batch id, its new
+    jobs and the names of the files that were turned away because too many
+    uploads are still waiting to be pushed.
+    """
+
+    batch_id = batch_id or new_batch_id()
+    space = get_upload_space()
+    saved = []
+    skipped = []
+
+    for upload in uploads:
+        file_name = secure_filename(upload.filename)
+        if not file_name:
+            continue
+
+        # Werkzeug spools uploads, so their size is known before saving
+        upload.stream.seek(0, os.SEEK_END)
+        file_size = upload.stream.tell()
+        upload.stream.seek(0)
+
+        # Only the first file waits: the space taken by the files saved
+        # before it cannot come free until this request has queued them
+        wait = 0 if saved else app.config["UPLOAD_SPACE_WAIT"]
+        if skipped or not space.reserve(file_size, wait):
+            skipped.append(file_name)
+            continue
+
+        # Each upload gets a directory of its own, so files of the same name
+        # never overwrite each other before they are pushed
+        directory = None
+        try:
+            directory = new_upload_directory(upload_path)
+            """TODO: ENCRYPT FILE"""
+            # Save the uploaded file, hashing it on the way
+            content_hash = save_upload(upload, directory, file_name)
+        except Exception:
+            # None of the batch is queued yet, so give up every file of it
+            space.release(file_size + sum(size for _, _, _, size in saved))
+            directories = [saved_directory for saved_directory, _, _, _ in saved]
+            for saved_directory in directories + [directory]:
+                if saved_directory is not None:
+                    shutil.rmtree(saved_directory, ignore_errors=True)
+            raise
+
+        saved.append((directory, file_name, content_hash, file_size))
+
+    # Every job of the batch exists before any of them runs, so the batch
+    # cannot look finished while files are still being added to it
+    jobs = [
+        Jobs(
+            file_path=directory,
+            file_name=file_name,
+            status=QUEUED,
+            created=datetime.now().replace(microsecond=0),
+            content_hash=content_hash,
+            batch_id=batch_id,
+            file_size=file_size,
+            worker=worker_id(),
+        )
+        for directory, file_name, content_hash, file_size in saved
+    ]
+    db.session.add_all(jobs)
+    track_copies(jobs)
+    db.session.commit()
+
+    for job in jobs:
+        _get_executor().submit(_run_job, job.id)
+
+    return batch_id, jobs, skipped
+
+
+def enqueue_push(upload_path, file_name, content_hash=None, file_size=None):
+    """
+    Record a job for a saved upload and hand it to the worker pool as a
+    batch of its own. Returns the new job straight away.
+    """
+
+    if file_size is None:
+        file_size = os.path.getsize(os.path.join(upload_path, file_name))
+    get_upload_space().reserve(file_size)
+
+    job = Jobs(
+        file_path=upload_path,
+        file_name=file_name,
+        status=QUEUED,
+        created=datetime.now().replace(microsecond=0),
+        content_hash=content_hash,
+        batch_id=new_batch_id(),
+        file_size=file_size,
+        worker=worker_id(),
+    )
+    db.session.add(job)
+    track_copies([job])
+    db.session.commit()
+
+    _get_executor().submit(_run_job, job.id)
+
+    return job
+
+
+def run_job_inline(file_name, work, batch_id=None):
+    """
+    Record a job for work that has to run in the current thread, such as
+    staging a package built from the streams of a request, and run it.
+    `work` is called without arguments and returns the new Files row.
+    """
+
+    job = Jobs(
+        file_path=None,
+        file_name=file_name,
+        status=RUNNING,
+        created=datetime.now().replace(microsecond=0),
+        batch_id=batch_id or new_batch_id(),
+        worker=worker_id(),
+    )
+    db.session.add(job)
+    db.session.commit()
+
+    try:
+        file_upload = work()
+    except Exception as e:
+        _set_status(job, FAILED, str(e))
+    else:
+        job.CID = file_upload.CID
+        job.file_size = job.bytes_staged = file_upload.file_size
+        _set_status(job, DONE)
+
+    return job
+
+
+def resume_jobs():
+    """
+    Requeue the jobs that were still pending when the application stopped,
+    and record the files that were pushed but not yet recorded. Jobs of
+    worker processes that are still running are left to them.
+    """
+
+    pending = [
+        job
+        for job in Jobs.query.filter(Jobs.status.in_([QUEUED, RUNNING]))
+        if job.worker is None or not worker_alive(job.worker)
+    ]
+
+    for job in pending:
+        get_upload_space().reserve(job.file_size or 0)
+        _get_executor().submit(_run_job, job.id)
+
+    pushed = db.session.query(Jobs.id).filter(Jobs.status == PUSHED).all()
+    for (job_id,) in pushed:
+        _get_executor().submit(_run_record_job, job_id)
+
+    return len(pending)
+
+
+def retry_jobs(job_ids):
+    """
+    Queue the failed jobs among `job_ids` to stage and push their saved
+    uploads again. Returns the number of jobs queued.
+    """
+
+    jobs = Jobs.query.filter(
+        Jobs.id.in_(job_ids), Jobs.status == FAILED, Jobs.file_path.isnot(None)
+    ).all()
+
+    for job in jobs:
+        job.worker = None
+        _set_status(job, QUEUED)
+        get_upload_space().reserve(job.file_size or 0)
+        _get_executor().submit(_run_job, job.id)
+
+    return len(jobs)
+
+
+def wait_for_change(job_id, status, timeout=15):
+    """
+    Block until the job leaves the given status or the timeout passes, then
+    return the job as currently stored. Jobs run by another process are only
+    seen when the timeout passes.
+    """
+
+    deadline = time.monotonic() + timeout
+    while True:
+        with _status_changed:
+            seen = _changes
+
+        # Queried without the lock, so a slow query holds up nobody else
+        remaining = deadline - time.monotonic()
+        if _current_status(job_id) != status or remaining <= 0:
+            break
+
+        with _status_changed:
+            _status_changed.wait_for(lambda: _changes != seen, remaining)
+
+    return Jobs.query.get(job_id)
+
+
+def batch_progress(batch_id):
+    """
+    Describe the jobs of a batch and the progress of the batch as a whole
+    for the JSON API, or return None if there is no such batch
+    """
+
+    jobs = Jobs.query.filter_by(batch_id=batch_id).order_by(Jobs.id).all()
+    if not jobs:
+        return None
+
+    return {
+        "batch_id": batch_id,
+        "finished": all(job.status in (DONE, FAILED) for job in jobs),
+        "file_size": sum(job.file_size or 0 for job in jobs),
+        "bytes_staged": sum(job.bytes_staged or 0 for job in jobs),
+        "jobs": [job_to_dict(job) for job in jobs],
+    }
+
+
+def job_to_dict(job):
+    """
+    Describe a job for the JSON API
+    """
+
+    return {
+        "id": job.id,
+        "batch_id": job.batch_id,
+        "file_name": job.file_name,
+        "file_size": job.file_size,
+        "bytes_staged": job.bytes_staged,
+        "status": job.status,
+        "error": job.error,
+        "CID": job.CID,
+        "created": str(job.created),
+        "updated": str(job.updated),
+    }
+
+
+def record_job(job):
+    """
+    Record the file of a pushed job, its log entry and the usage totals in
+    one transaction as soon as it has been pushed. Files of a batch are not
+    held back to be recorded together: a crash before the last file of a
+    batch was pushed would otherwise lose the files already pushed. Does
+    nothing after another worker has recorded it.
+    """
+
+    # Claim the job; a worker that claims nothing lost the race to record it
+    now = datetime.now().replace(microsecond=0)
+    claimed = Jobs.query.filter_by(id=job.id, status=PUSHED).update(
+        {"status": DONE, "updated": now}, synchronize_session=False
+    )
+    if not claimed:
+        db.session.rollback()
+        return
+
+    file_upload = Files(
+        file_path=job.file_path,
+        file_name=job.file_name,
+        upload_date=None,
+        file_size=job.file_size,
+        CID=job.CID,
+        ffs_id=job.ffs_id,
+        content_hash=job.content_hash,
+        storage_job_id=job.storage_job_id,
+        storage_status=STORAGE_QUEUED,
+    )
+    duplicate = Files.query.get(job.duplicate_of) if job.duplicate_of else None
+    if duplicate is not None:
+        # A duplicate shares the storage job, and so the deals, of its copy
+        file_upload.storage_job_id = duplicate.storage_job_id
+        file_upload.storage_status = duplicate.storage_status
+        file_upload.storage_error = duplicate.storage_error
+    record_uploads([(file_upload, duplicate)])
+
+    _notify_status_changed()
+
+
+def _current_status(job_id):
+    db.session.expire_all()
+    job = Jobs.query.get(job_id)
+
+    return job.status if job is not None else None
+
+
+def _set_status(job, status, error=None):
+    job.status = status
+    job.error = error[:255] if error else None
+    job.updated = datetime.now().replace(microsecond=0)
+    db.session.commit()
+
+    _notify_status_changed()
+
+
+def _notify_status_changed():
+    global _changes
+
+    with _status_changed:
+        _changes += 1
+        _status_changed.notify_all()
+
+
+def _progress_recorder(job_id):
+    """
+    Return a callback that stores the bytes staged for a job, at most once
+    every UPLOAD_PROGRESS_INTERVAL seconds
+    """
+
+    interval = app.config["UPLOAD_PROGRESS_INTERVAL"]
+    last = [time.monotonic()]
+
+    def record(count):
+        now = time.monotonic()
+        if now - last[0] < interval:
+            return
+        last[0] = now
+
+        # Use a connection of its own so the update never touches the
+        # session of the job
+        with db.engine.begin() as connection:
+            connection.execute(
+                Jobs.__table__.update()
+                .where(Jobs.__table__.c.id == job_id)
+                .values(bytes_staged=count)
+            )
+
+    return record
+
+
+def _run_job(job_id):
+    """
+    Stage and push the upload of a job inside its own application context,
+    then record its file
+    """
+
+    with app.app_context():
+        job = Jobs.query.get(job_id)
+        if job is None or job.status not in (QUEUED, RUNNING):
+            return
+
+        reserved = job.file_size or 0
+        try:
+            if job.file_path is None:
+                # Inline jobs have no saved upload to start over from
+                _set_status(job, FAILED, "Interrupted before it completed")
+                return
+
+            if job.batch_id is None:
+                # Queued before uploads were grouped into batches
+                job.batch_id = new_batch_id()
+            job.worker = worker_id()
+            _set_status(job, RUNNING)
+
+            try:
+                file_upload, stored = stage_upload(
+                    job.file_path,
+                    job.file_name,
+                    job.content_hash,
+                    progress=_progress_recorder(job.id),
+                )
+            except Exception as e:
+                # stage_upload has already logged the error
+                db.session.rollback()
+                update_copy(job, COPY_FAILED)
+                _set_status(job, FAILED, str(e))
+            else:
+                job.CID = file_upload.CID
+                job.ffs_id = file_upload.ffs_id
+                job.storage_job_id = file_upload.storage_job_id
+                job.file_size = file_upload.file_size
+                job.content_hash = file_upload.content_hash
+                if stored is None:
+                    job.bytes_staged = file_upload.file_size
+                else:
+                    job.duplicate_of = stored.id
+                update_copy(job, COPY_PUSHED)
+                _set_status(job, PUSHED)
+        finally:
+            get_upload_space().release(reserved)
+
+        if job.status == PUSHED:
+            _record_job_logged(job)
+
+
+def _run_record_job(job_id):
+    with app.app_context():
+        job = Jobs.query.get(job_id)
+        if job is not None:
+            _record_job_logged(job)
+
+
+def _record_job_logged(job):
+    # A job whose file fails to be recorded stays pushed and is retried when
+    # the jobs are next resumed
+    try:
+        record_job(job)
+    except Exception as e:
+        db.session.rollback()
+        log_event("Upload ERROR: recording " + job.file_name + " " + str(e))
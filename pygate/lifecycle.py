@@ -0,0 +1,437 @@
+"""
+Track the local copies of uploads from when they are saved until they are
+safely stored, and delete them then, keeping UPLOADDIR within a quota and
+spread over hashed subdirectories
+"""
+
+import hashlib
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+import click
+from sqlalchemy import func
+from pygate import app, db
+from pygate.models import Files, Jobs, StagedFiles
+from pygate.eventlog import log_event
+from pygate.watcher import SUCCESS as STORAGE_SUCCESS
+
+# States of a local copy
+SAVED = "saved"
+PUSHED = "pushed"
+CONFIRMED = "confirmed"
+FAILED = "failed"
+# Failed every retry. Never stored anywhere, so kept for the operator.
+STRANDED = "stranded"
+DELETED = "deleted"
+
+# States whose copies UPLOAD_DELETE_AFTER lets go of
+DELETE_AFTER = {"pushed": (PUSHED, CONFIRMED), "confirmed": (CONFIRMED,), None: ()}
+
+# The order copies are deleted in to get back under the quota. Copies that
+# are not stored yet, or whose storage failed, are the only copy of a file.
+QUOTA_ORDER = (CONFIRMED, PUSHED)
+
+BATCH_SIZE = 500
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+def shard_directory(root, key):
+    """
+    Return the subdirectory of `root` for `key`, two levels of 256
+    directories each picked by a hash of the key
+    """
+
+    digest = hashlib.sha256(key.encode()).hexdigest()
+
+    return os.path.join(root, digest[:2], digest[2:4])
+
+
+def new_upload_directory(root=None):
+    """
+    Create a directory of its own for an upload in a shard of UPLOADDIR (or
+    `root`), so uploads with the same name never overwrite each other
+    """
+
+    key = uuid.uuid4().hex
+    path = os.path.join(shard_directory(root or app.config["UPLOADDIR"], key), key)
+    os.makedirs(path)
+
+    return path
+
+
+def track_copies(jobs):
+    """
+    Add to the session the saved copies of the uploads of newly added jobs,
+    to be committed with them
+    """
+
+    db.session.flush()
+    now = datetime.now().replace(microsecond=0)
+    db.session.add_all(
+        StagedFiles(
+            path=job.file_path,
+            file_name=job.file_name,
+            size=job.file_size,
+            state=SAVED,
+            job_id=job.id,
+            created=now,
+        )
+        for job in jobs
+    )
+
+
+def update_copy(job, state):
+    """
+    Add to the session the new state of the saved copy of a job's upload,
+    with the storage job whose success confirms it
+    """
+
+    StagedFiles.query.filter_by(job_id=job.id).update(
+        {
+            "state": state,
+            "storage_job_id": job.storage_job_id,
+            "updated": datetime.now().replace(microsecond=0),
+        },
+        synchronize_session=False,
+    )
+
+
+def adopt_copies():
+    """
+    Start tracking the saved uploads of jobs recorded before copies were
+    tracked, which are still on disk
+    """
+
+    states = {"queued": SAVED, "running": SAVED, "pushed": PUSHED, "done": PUSHED}
+    adopted = 0
+    last_id = 0
+    while True:
+        jobs = (
+            Jobs.query.outerjoin(StagedFiles, StagedFiles.job_id == Jobs.id)
+            .filter(
+                Jobs.id > last_id,
+                Jobs.file_path.isnot(None),
+                StagedFiles.id.is_(None),
+            )
+            .order_by(Jobs.id)
+            .limit(BATCH_SIZE)
+            .all()
+        )
+        if not jobs:
+            break
+        last_id = jobs[-1].id
+
+        now = datetime.now().replace(microsecond=0)
+        rows = [
+            {
+                "path": job.file_path,
+                "file_name": job.file_name,
+                "size": job.file_size,
+                "state": states.get(job.status, FAILED),
+                "job_id": job.id,
+                "storage_job_id": job.storage_job_id,
+                "created": job.created or now,
+                "updated": now,
+            }
+            for job in jobs
+            if os.path.isfile(os.path.join(job.file_path, job.file_name))
+        ]
+        db.session.bulk_insert_mappings(StagedFiles, rows)
+        db.session.commit()
+        adopted += len(rows)
+
+    return adopted
+
+
+def confirm_copies():
+    """
+    Mark the pushed copies whose storage job has succeeded as confirmed
+    """
+
+    succeeded = db.session.query(Files.storage_job_id).filter(
+        Files.storage_status == STORAGE_SUCCESS
+    )
+    confirmed = StagedFiles.query.filter(
+        StagedFiles.state == PUSHED, StagedFiles.storage_job_id.in_(succeeded)
+    ).update(
+        {"state": CONFIRMED, "updated": datetime.now().replace(microsecond=0)},
+        synchronize_session=False,
+    )
+    db.session.commit()
+
+    return confirmed
+
+
+def stored_bytes():
+    """
+    Return the size of the copies still on disk
+    """
+
+    size = (
+        db.session.query(func.sum(StagedFiles.size))
+        .filter(StagedFiles.state != DELETED)
+        .scalar()
+    )
+
+    return int(size or 0)
+
+
+def retry_failed_copies():
+    """
+    Queue again the failed uploads whose copies have retries left, once
+    UPLOAD_RETRY_DELAY seconds have passed since they failed. Returns the
+    number of uploads queued.
+    """
+
+    # Imported here, as the jobs module tracks its copies with this one
+    from pygate.jobs import FAILED as JOB_FAILED, retry_jobs
+
+    now = datetime.now().replace(microsecond=0)
+    due = now - timedelta(seconds=app.config["UPLOAD_RETRY_DELAY"])
+    retried = 0
+    while True:
+        copies = (
+            StagedFiles.query.join(Jobs, Jobs.id == StagedFiles.job_id)
+            .filter(
+                StagedFiles.state == FAILED,
+                StagedFiles.retries < app.config["UPLOAD_RETRIES"],
+                StagedFiles.updated <= due,
+                Jobs.status == JOB_FAILED,
+                Jobs.file_path.isnot(None),
+            )
+            .order_by(StagedFiles.id)
+            .limit(BATCH_SIZE)
+            .all()
+        )
+        if not copies:
+            break
+
+        for copy in copies:
+            copy.state = SAVED
+            copy.retries += 1
+            copy.updated = now
+        db.session.commit()
+        retried += retry_jobs([copy.job_id for copy in copies])
+
+    return retried
+
+
+def strand_failed_copies():
+    """
+    Set aside the failed copies that have no retries left, logging where
+    each is kept so the operator can upload it again. Returns the number of
+    copies set aside.
+    """
+
+    stranded = 0
+    while True:
+        copies = (
+            StagedFiles.query.filter(
+                StagedFiles.state == FAILED,
+                StagedFiles.retries >= app.config["UPLOAD_RETRIES"],
+            )
+            .order_by(StagedFiles.id)
+            .limit(BATCH_SIZE)
+            .all()
+        )
+        if not copies:
+            break
+
+        now = datetime.now().replace(microsecond=0)
+        for copy in copies:
+            copy.state = STRANDED
+            copy.updated = now
+            log_event(
+                "Upload of {} failed {} retries, kept at {}".format(
+                    copy.file_name, copy.retries, copy.path
+                )
+            )
+        db.session.commit()
+        stranded += len(copies)
+
+    return stranded
+
+
+def delete_copies(states, limit=None):
+    """
+    Delete the copies in `states`, oldest first, until `limit` bytes have
+    been freed if given. Returns the number of copies and bytes deleted.
+    """
+
+    deleted = 0
+    freed = 0
+    for state in states:
+        while limit is None or freed < limit:
+            query = StagedFiles.query.filter_by(state=state)
+            copies = query.order_by(StagedFiles.id).limit(BATCH_SIZE).all()
+            if not copies:
+                break
+
+            for copy in copies:
+                remove_copy(copy)
+                copy.state = DELETED
+                copy.updated = datetime.now().replace(microsecond=0)
+                deleted += 1
+                freed += copy.size or 0
+                if limit is not None and freed >= limit:
+                    break
+            db.session.commit()
+
+    return deleted, freed
+
+
+def prune_deleted():
+    """
+    Forget the copies deleted more than UPLOAD_DELETED_KEEP_DAYS days ago,
+    clearing the saved path of their jobs so that they are not adopted
+    again. Returns the number of copies forgotten.
+    """
+
+    before = datetime.now() - timedelta(days=app.config["UPLOAD_DELETED_KEEP_DAYS"])
+    pruned = 0
+    while True:
+        copies = (
+            db.session.query(StagedFiles.id, StagedFiles.job_id)
+            .filter(StagedFiles.state == DELETED, StagedFiles.updated < before)
+            .order_by(StagedFiles.id)
+            .limit(BATCH_SIZE)
+            .all()
+        )
+        if not copies:
+            break
+
+        Jobs.query.filter(Jobs.id.in_([job_id for _, job_id in copies])).update(
+            {"file_path": None}, synchronize_session=False
+        )
+        StagedFiles.query.filter(
+            StagedFiles.id.in_([copy_id for copy_id, _ in copies])
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        pruned += len(copies)
+
+    return pruned
+
+
+def remove_copy(copy):
+    """
+    Remove the file of a copy and the directories left empty by it. Files
+    saved straight into UPLOADDIR, before uploads had directories of their
+    own, are kept while another upload of the same name waits to be pushed.
+    """
+
+    root = os.path.abspath(app.config["UPLOADDIR"])
+    directory = os.path.abspath(copy.path)
+    if directory == root:
+        waiting = StagedFiles.query.filter(
+            StagedFiles.path == copy.path,
+            StagedFiles.file_name == copy.file_name,
+            StagedFiles.state == SAVED,
+        ).count()
+        if waiting:
+            return
+
+    try:
+        os.remove(os.path.join(directory, copy.file_name))
+    except FileNotFoundError:
+        pass
+
+    # Compact the tree, up to but not including UPLOADDIR
+    while directory.startswith(root + os.sep):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            break
+        directory = os.path.dirname(directory)
+
+
+def sweep():
+    """
+    Confirm the copies whose storage succeeded, retry the failed ones, set
+    aside those that failed every retry and delete those that
+    UPLOAD_DELETE_AFTER allows, then delete more stored copies while the
+    copies take up more than UPLOAD_QUOTA_HIGH_BYTES, until they are within
+    UPLOAD_QUOTA_LOW_BYTES. Returns the number of copies and bytes deleted.
+    """
+
+    confirm_copies()
+    retried = retry_failed_copies()
+    if retried:
+        log_event("Retrying {} failed uploads".format(retried))
+    strand_failed_copies()
+
+    deleted, freed = delete_copies(DELETE_AFTER[app.config["UPLOAD_DELETE_AFTER"]])
+
+    used = stored_bytes()
+    if used > app.config["UPLOAD_QUOTA_HIGH_BYTES"]:
+        over = used - app.config["UPLOAD_QUOTA_LOW_BYTES"]
+        more, more_freed = delete_copies(QUOTA_ORDER, limit=over)
+        deleted += more
+        freed += more_freed
+        if more_freed < over:
+            log_event(
+                "Upload quota exceeded: {} bytes of uploads are kept until "
+                "they are stored".format(used - freed)
+            )
+
+    if deleted:
+        log_event("Deleted {} saved uploads ({} bytes)".format(deleted, freed))
+    prune_deleted()
+
+    return deleted, freed
+
+
+def start_sweeper():
+    """
+    Start deleting the saved uploads that are safely stored from a
+    background thread, every UPLOAD_SWEEP_INTERVAL seconds
+    """
+
+    global _sweeper
+
+    with _sweeper_lock:
+        if _sweeper is None:
+            _sweeper = threading.Thread(
+                target=_run_sweeper, name="pygate-sweeper", daemon=True
+            )
+            _sweeper.start()
+
+
+def _run_sweeper():
+    with app.app_context():
+        try:
+            adopt_copies()
+        except Exception as e:
+            db.session.rollback()
+            log_event("Upload sweep ERROR: " + str(e))
+
+    while True:
+        with app.app_context():
+            try:
+                sweep()
+            except Exception as e:
+                db.session.rollback()
+                log_event("Upload sweep ERROR: " + str(e))
+
+        time.sleep(app.config["UPLOAD_SWEEP_INTERVAL"])
+
+
+@app.cli.command("sweep-uploads")
+def sweep_uploads_command():
+    """
+    Delete the saved uploads that are safely stored or over the quota
+    """
+
+    adopted = adopt_copies()
+    if adopted:
+        click.echo("Tracking {} earlier uploads".format(adopted))
+
+    deleted, freed = sweep()
+    click.echo(
+        "Deleted {} saved uploads ({} bytes), {} bytes left".format(
+            deleted, freed, stored_bytes()
+        )
+    )
@@ -0,0 +1,433 @@
+"""
+Measure where requests spend their time (Powergate calls, SQL queries,
+template rendering and file I/O) as Prometheus metrics, and optionally
+profile slow requests. Metrics are kept per process: with several worker
+processes each one reports its own.
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from datetime import datetime
+from flask import g, request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from pygate import app
+
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_registry = []
+
+
+class Metric(object):
+    """
+    A named metric holding one value per combination of label values
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        if not self.labels and self.kind != "histogram":
+            # Reported from the start, as there is only the one value
+            self._values[()] = 0
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _label_text(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ""
+
+        return "{" + ",".join(
+            '{}="{}"'.format(name, _escape(value)) for name, value in pairs
+        ) + "}"
+
+    def samples(self):
+        """
+        Return the lines of the metric in the Prometheus text format
+        """
+
+        with self._lock:
+            values = sorted(self._values.items())
+
+        return [
+            "{}{} {}".format(self.name, self._label_text(key), _number(value))
+            for key, value in values
+        ]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket, then the count and sum of all values
+                counts = self._values[key] = [0] * len(self.buckets) + [0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the duration of a with block
+        """
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self._values.items())
+
+        lines = []
+        for key, counts in values:
+            for bound, count in zip(self.buckets, counts):
+                labels = self._label_text(key, [("le", _number(bound))])
+                lines.append("{}_bucket{} {}".format(self.name, labels, count))
+            lines.append(
+                "{}_bucket{} {}".format(
+                    self.name, self._label_text(key, [("le", "+Inf")]), counts[-2]
+                )
+            )
+            lines.append(
+                "{}_count{} {}".format(self.name, self._label_text(key), counts[-2])
+            )
+            lines.append(
+                "{}_sum{} {}".format(
+                    self.name, self._label_text(key), _number(counts[-1])
+                )
+            )
+
+        return lines
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render():
+    """
+    Return every metric in the Prometheus text exposition format
+    """
+
+    lines = []
+    for metric in _registry:
+        lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+        lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+        lines.extend(metric.samples())
+
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_SECONDS = Histogram(
+    "pygate_request_duration_seconds",
+    "Time taken to handle a request, including streaming its response",
+    ["endpoint", "method"],
+)
+REQUESTS = Counter(
+    "pygate_requests_total", "Requests handled", ["endpoint", "method", "status"]
+)
+REQUESTS_IN_FLIGHT = Gauge("pygate_requests_in_flight", "Requests being handled")
+
+POWERGATE_SECONDS = Histogram(
+    "pygate_powergate_call_duration_seconds",
+    "Time taken by Powergate calls; streaming calls until they return the stream",
+    ["method"],
+)
+POWERGATE_ERRORS = Counter(
+    "pygate_powergate_call_errors_total", "Powergate calls that raised", ["method"]
+)
+POWERGATE_IN_FLIGHT = Gauge(
+    "pygate_powergate_calls_in_flight", "Powergate calls in progress", ["method"]
+)
+
+DB_SECONDS = Histogram(
+    "pygate_db_query_duration_seconds",
+    "Time taken to execute SQL statements",
+    ["operation"],
+)
+DB_ERRORS = Counter(
+    "pygate_db_query_errors_total", "SQL statements that failed", ["operation"]
+)
+DB_IN_FLIGHT = Gauge("pygate_db_queries_in_flight", "SQL statements being executed")
+
+TEMPLATE_SECONDS = Histogram(
+    "pygate_template_render_duration_seconds",
+    "Time taken to render templates",
+    ["template"],
+)
+
+FILE_IO_SECONDS = Histogram(
+    "pygate_file_io_duration_seconds",
+    "Time spent reading or writing the bytes of files",
+    ["operation"],
+)
+FILE_IO_BYTES = Counter(
+    "pygate_file_io_bytes_total", "Bytes of files read or written", ["operation"]
+)
+
+PROFILES = Counter(
+    "pygate_profiles_written_total", "Profiles written for slow requests"
+)
+
+
+def record_file_io(operation, seconds, size):
+    FILE_IO_SECONDS.observe(seconds, operation=operation)
+    FILE_IO_BYTES.inc(size, operation=operation)
+
+
+def timed_chunks(operation, chunks):
+    """
+    Iterate over a stream of byte chunks, recording the time spent waiting
+    for them and their total size once the stream ends
+    """
+
+    seconds = 0.0
+    size = 0
+    chunks = iter(chunks)
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                seconds += time.perf_counter() - started
+            size += len(chunk)
+            yield chunk
+    finally:
+        record_file_io(operation, seconds, size)
+
+
+class TimedTemplate(Template):
+    """
+    A Jinja template recording how long it takes to render
+    """
+
+    def render(self, *args, **kwargs):
+        with TEMPLATE_SECONDS.time(template=self.name or "<string>"):
+            return super().render(*args, **kwargs)
+
+
+app.jinja_env.template_class = TimedTemplate
+
+
+def _operation(statement):
+    return statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    DB_IN_FLIGHT.inc()
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    DB_IN_FLIGHT.dec()
+    DB_SECONDS.observe(time.perf_counter() - started, operation=_operation(statement))
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    if context.cursor is not None and context.connection is not None:
+        started = context.connection.info.get("query_started")
+        if started:
+            started.pop()
+            DB_IN_FLIGHT.dec()
+    DB_ERRORS.inc(operation=_operation(context.statement or ""))
+
+
+class Sampler(object):
+    """
+    Sample the stacks of the threads handling profiled requests from a
+    thread of its own, counting each distinct stack
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._profiles = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self, thread_id):
+        with self._condition:
+            self._profiles[thread_id] = StackCounter()
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="pygate-profiler", daemon=True
+                )
+                self._thread.start()
+            self._condition.notify()
+
+    def stop(self, thread_id):
+        """
+        Stop sampling a thread and return the counts of its stacks
+        """
+
+        with self._condition:
+            return self._profiles.pop(thread_id, StackCounter())
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._profiles)
+            time.sleep(self.interval)
+
+            frames = sys._current_frames()
+            with self._condition:
+                for thread_id, stacks in self._profiles.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None and thread_id != own_id:
+                        stacks[fold_stack(frame)] += 1
+
+
+def fold_stack(frame):
+    """
+    Describe the stack of a frame in the folded format of flame graph tools,
+    from its outermost function to `frame`
+    """
+
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(
+            "{} ({}:{})".format(
+                code.co_name, os.path.basename(code.co_filename), code.co_firstlineno
+            ).replace(";", ":")
+        )
+        frame = frame.f_back
+
+    return ";".join(reversed(names))
+
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+
+def get_sampler():
+    global _sampler
+
+    with _sampler_lock:
+        if _sampler is None:
+            _sampler = Sampler(app.config["PROFILE_INTERVAL"])
+
+    return _sampler
+
+
+def write_profile(stacks, endpoint, seconds):
+    """
+    Write the sampled stacks of a request to PROFILE_DIR as a folded stacks
+    file, to be read by flamegraph.pl or speedscope
+    """
+
+    profile_dir = app.config["PROFILE_DIR"]
+    if not os.path.exists(profile_dir):
+        os.makedirs(profile_dir)
+
+    file_name = "{:%Y%m%d-%H%M%S-%f}-{}-{}ms.folded".format(
+        datetime.now(), endpoint, int(seconds * 1000)
+    )
+    with open(os.path.join(profile_dir, file_name), "w") as out_file:
+        for stack, count in stacks.most_common():
+            out_file.write("{} {}\n".format(stack, count))
+
+    PROFILES.inc()
+
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_started = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc()
+
+    if app.config["PROFILE_REQUESTS"]:
+        g.metrics_profiled = threading.get_ident()
+        get_sampler().start(g.metrics_profiled)
+
+
+@app.after_request
+def record_response_status(response):
+    g.metrics_status = response.status_code
+
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exception):
+    """
+    Record the request once its response has been sent, which for streamed
+    responses is when the stream ends
+    """
+
+    started = g.pop("metrics_started", None)
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+
+    endpoint = request.endpoint or "unmatched"
+    status = g.pop("metrics_status", 500 if exception is not None else 200)
+    REQUESTS_IN_FLIGHT.dec()
+    REQUEST_SECONDS.observe(seconds, endpoint=endpoint, method=request.method)
+    REQUESTS.inc(endpoint=endpoint, method=request.method, status=status)
+
+    thread_id = g.pop("metrics_profiled", None)
+    if thread_id is not None:
+        stacks = get_sampler().stop(thread_id)
+        if stacks and seconds >= app.config["PROFILE_SLOW_REQUEST_SECONDS"]:
+            write_profile(stacks, endpoint, seconds)
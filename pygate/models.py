@@ -2,6 +2,8 @@
 Define Pygate database models
 """
 
+from sqlalchemy import column, event, table, text
+from sqlalchemy.exc import OperationalError
 from pygate import db
 
 
@@ -15,13 +17,18 @@ class Ffs(db.Model):
     token = db.Column(db.String(36), index=True)
     creation_date = db.Column(db.DateTime())
     default = db.Column(db.Boolean)
+    node = db.Column(db.String(255), index=True)
+    # When this app last changed the default storage config, so that every
+    # worker process drops its cached copy
+    config_changed = db.Column(db.DateTime())
     files = db.relationship("Files", cascade="all,delete", backref="Ffs", lazy=True)
 
-    def __init__(self, ffs_id, token, creation_date, default):
+    def __init__(self, ffs_id, token, creation_date, default, node=None):
         self.ffs_id = ffs_id
         self.token = token
         self.creation_date = creation_date
         self.default = default
+        self.node = node
 
     def __repr__(self):
         return self.ffs_id
@@ -32,31 +39,92 @@ class Files(db.Model):
     Define the attributes for file uploads
     """
 
+    # Composite indexes back the keyset pagination of the files listing,
+    # one per sortable column with the primary key as tie-breaker
+    __table_args__ = (
+        db.Index("ix_files_file_name_id", "file_name", "id"),
+        db.Index("ix_files_upload_date_id", "upload_date", "id"),
+        db.Index("ix_files_cid_id", "CID", "id"),
+        db.Index("ix_files_ffs_id_id", "ffs_id", "id"),
+    )
+
     id = db.Column(db.Integer(), primary_key=True)
     file_path = db.Column(db.String(255))
-    file_name = db.Column(db.String(255), index=True)
+    file_name = db.Column(db.String(255))
     upload_date = db.Column(db.DateTime())
     file_size = db.Column(db.Integer())
-    CID = db.Column(db.String(64), index=True)
+    CID = db.Column(db.String(64))
+    content_hash = db.Column(db.String(64), index=True)
     ffs_id = db.Column(db.Integer(), db.ForeignKey(Ffs.id), nullable=False)
+    storage_job_id = db.Column(db.String(36), index=True)
+    storage_status = db.Column(db.String(16), index=True)
+    storage_error = db.Column(db.String(255))
+    storage_updated = db.Column(db.DateTime())
 
-    def __init__(self, file_path, file_name, upload_date, file_size, CID, ffs_id):
+    def __init__(
+        self,
+        file_path,
+        file_name,
+        upload_date,
+        file_size,
+        CID,
+        ffs_id,
+        content_hash=None,
+        storage_job_id=None,
+        storage_status=None,
+        storage_error=None,
+    ):
         self.file_path = file_path
         self.file_name = file_name
         self.upload_date = upload_date
         self.file_size = file_size
         self.CID = CID
         self.ffs_id = ffs_id
+        self.content_hash = content_hash
+        self.storage_job_id = storage_job_id
+        self.storage_status = storage_status
+        self.storage_error = storage_error
 
     def __repr__(self):
         return self.file_name
 
 
+class FfsUsage(db.Model):
+    """
+    Define the attributes for the running totals of the files stored under
+    each FFS
+    """
+
+    ffs_id = db.Column(db.Integer(), db.ForeignKey(Ffs.id), primary_key=True)
+    files = db.Column(db.Integer(), nullable=False, default=0)
+    bytes = db.Column(db.BigInteger(), nullable=False, default=0)
+
+    def __repr__(self):
+        return str(self.ffs_id)
+
+
+class DailyUsage(db.Model):
+    """
+    Define the attributes for the totals of the files uploaded to each FFS
+    per day
+    """
+
+    day = db.Column(db.Date(), primary_key=True)
+    ffs_id = db.Column(db.Integer(), db.ForeignKey(Ffs.id), primary_key=True)
+    files = db.Column(db.Integer(), nullable=False, default=0)
+    bytes = db.Column(db.BigInteger(), nullable=False, default=0)
+
+    def __repr__(self):
+        return str(self.day)
+
+
 class Logs(db.Model):
     """
     Define the attributes for log entries
     """
 
+    __table_args__ = (db.Index("ix_logs_timestamp_id", "timestamp", "id"),)
+
     id = db.Column(db.Integer(), primary_key=True)
     timestamp = db.Column(db.DateTime())
     event = db.Column(db.String(255))
@@ -67,3 +135,288 @@ class Logs(db.Model):
 
     def __repr__(self):
         return self.event
+
+
+# Full-text index over the event of each log entry, kept in step with the
+# logs table by triggers. Only available on SQLite builds with FTS5.
+LogSearch = table("logs_fts", column("rowid"), column("logs_fts"))
+
+LOG_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE logs_fts USING fts5("
+    "event, content='logs', content_rowid='id')",
+    "CREATE TRIGGER logs_fts_insert AFTER INSERT ON logs BEGIN "
+    "INSERT INTO logs_fts(rowid, event) VALUES (new.id, new.event); END",
+    "CREATE TRIGGER logs_fts_delete AFTER DELETE ON logs BEGIN "
+    "INSERT INTO logs_fts(logs_fts, rowid, event) "
+    "VALUES ('delete', old.id, old.event); END",
+    "INSERT INTO logs_fts(logs_fts) VALUES ('rebuild')",
+)
+
+_log_search_index = None
+
+
+def create_log_search_index(connection):
+    """
+    Create the full-text index of the logs table and index the existing
+    entries, if the database supports it and the index does not exist yet
+    """
+
+    global _log_search_index
+
+    if connection.dialect.name != "sqlite":
+        _log_search_index = False
+        return False
+
+    if connection.dialect.has_table(connection, "logs_fts"):
+        _log_search_index = True
+        return True
+
+    try:
+        for statement in LOG_SEARCH_DDL:
+            connection.execute(text(statement))
+    except OperationalError:
+        # This SQLite build has no FTS5, so searches fall back to LIKE
+        _log_search_index = False
+        return False
+
+    _log_search_index = True
+    return True
+
+
+def has_log_search_index():
+    """
+    Check once per process whether the full-text index of the logs exists
+    """
+
+    global _log_search_index
+
+    if _log_search_index is None:
+        engine = db.engine
+        _log_search_index = engine.dialect.name == "sqlite" and engine.has_table(
+            "logs_fts"
+        )
+
+    return _log_search_index
+
+
+@event.listens_for(Logs.__table__, "after_create")
+def _create_log_search_index(target, connection, **kw):
+    create_log_search_index(connection)
+
+
+class Jobs(db.Model):
+    """
+    Define the attributes for background jobs pushing uploads to Filecoin
+    """
+
+    id = db.Column(db.Integer(), primary_key=True)
+    batch_id = db.Column(db.String(32), index=True)
+    file_path = db.Column(db.String(255))
+    file_name = db.Column(db.String(255))
+    file_size = db.Column(db.Integer())
+    bytes_staged = db.Column(db.Integer(), default=0)
+    content_hash = db.Column(db.String(64))
+    status = db.Column(db.String(16), index=True)
+    error = db.Column(db.String(255))
+    CID = db.Column(db.String(64))
+    ffs_id = db.Column(db.Integer(), db.ForeignKey(Ffs.id))
+    storage_job_id = db.Column(db.String(36))
+    duplicate_of = db.Column(db.Integer(), db.ForeignKey(Files.id))
+    worker = db.Column(db.String(255))
+    created = db.Column(db.DateTime())
+    updated = db.Column(db.DateTime())
+
+    def __init__(
+        self,
+        file_path,
+        file_name,
+        status,
+        created,
+        content_hash=None,
+        batch_id=None,
+        file_size=None,
+        worker=None,
+    ):
+        self.file_path = file_path
+        self.file_name = file_name
+        self.status = status
+        self.created = created
+        self.updated = created
+        self.content_hash = content_hash
+        self.batch_id = batch_id
+        self.file_size = file_size
+        self.bytes_staged = 0
+        self.worker = worker
+
+    def __repr__(self):
+        return self.file_name
+
+
+class StagedFiles(db.Model):
+    """
+    Define the attributes for the local copies of uploads, kept until they
+    are safely stored
+    """
+
+    __table_args__ = (db.Index("ix_staged_files_state_id", "state", "id"),)
+
+    id = db.Column(db.Integer(), primary_key=True)
+    path = db.Column(db.String(1024))
+    file_name = db.Column(db.String(255))
+    size = db.Column(db.BigInteger())
+    state = db.Column(db.String(16))
+    job_id = db.Column(db.Integer(), db.ForeignKey(Jobs.id), index=True)
+    storage_job_id = db.Column(db.String(36), index=True)
+    retries = db.Column(db.Integer(), default=0)
+    created = db.Column(db.DateTime())
+    updated = db.Column(db.DateTime())
+
+    def __init__(self, path, file_name, size, state, job_id, created):
+        self.path = path
+        self.file_name = file_name
+        self.size = size
+        self.state = state
+        self.job_id = job_id
+        self.retries = 0
+        self.created = created
+        self.updated = created
+
+    def __repr__(self):
+        return self.file_name
+
+
+class ImportRuns(db.Model):
+    """
+    Define the attributes for bulk imports of a directory tree or manifest
+    """
+
+    id = db.Column(db.Integer(), primary_key=True)
+    source = db.Column(db.String(1024))
+    kind = db.Column(db.String(16))
+    status = db.Column(db.String(16), index=True)
+    error = db.Column(db.String(255))
+    ffs_id = db.Column(db.Integer(), db.ForeignKey(Ffs.id))
+    total = db.Column(db.Integer(), default=0)
+    done = db.Column(db.Integer(), default=0)
+    failed = db.Column(db.Integer(), default=0)
+    skipped = db.Column(db.Integer(), default=0)
+    bytes_imported = db.Column(db.BigInteger(), default=0)
+    worker = db.Column(db.String(255))
+    created = db.Column(db.DateTime())
+    updated = db.Column(db.DateTime())
+
+    def __init__(self, source, kind, status, ffs_id, created, worker=None):
+        self.source = source
+        self.kind = kind
+        self.status = status
+        self.ffs_id = ffs_id
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0
+        self.bytes_imported = 0
+        self.worker = worker
+        self.created = created
+        self.updated = created
+
+    def __repr__(self):
+        return self.source
+
+
+class ImportItems(db.Model):
+    """
+    Define the attributes for the files and CIDs of a bulk import, in the
+    order they were found in its source
+    """
+
+    __table_args__ = (db.Index("ix_import_items_run_id_status", "run_id", "status"),)
+
+    id = db.Column(db.Integer(), primary_key=True)
+    run_id = db.Column(db.Integer(), db.ForeignKey(ImportRuns.id), nullable=False)
+    path = db.Column(db.String(1024))
+    CID = db.Column(db.String(64))
+    file_name = db.Column(db.String(255))
+    file_size = db.Column(db.BigInteger())
+    status = db.Column(db.String(16))
+    error = db.Column(db.String(255))
+    file_id = db.Column(db.Integer(), db.ForeignKey(Files.id))
+
+    def __repr__(self):
+        return self.file_name
+
+
+class ConfigRuns(db.Model):
+    """
+    Define the attributes for pushing every file of a FFS again with a
+    changed storage config
+    """
+
+    id = db.Column(db.Integer(), primary_key=True)
+    ffs_id = db.Column(db.Integer(), db.ForeignKey(Ffs.id), index=True)
+    config = db.Column(db.Text())
+    status = db.Column(db.String(16), index=True)
+    error = db.Column(db.String(255))
+    last_file_id = db.Column(db.Integer(), default=0)
+    total = db.Column(db.Integer(), default=0)
+    done = db.Column(db.Integer(), default=0)
+    failed = db.Column(db.Integer(), default=0)
+    worker = db.Column(db.String(255))
+    created = db.Column(db.DateTime())
+    updated = db.Column(db.DateTime())
+
+    def __init__(self, ffs_id, config, status, total, created, worker=None):
+        self.ffs_id = ffs_id
+        self.config = config
+        self.status = status
+        self.last_file_id = 0
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.worker = worker
+        self.created = created
+        self.updated = created
+
+    def __repr__(self):
+        return str(self.id)
+
+
+class ConfigFailures(db.Model):
+    """
+    Define the attributes for files that could not be pushed again by a
+    config run
+    """
+
+    id = db.Column(db.Integer(), primary_key=True)
+    run_id = db.Column(
+        db.Integer(), db.ForeignKey(ConfigRuns.id), index=True, nullable=False
+    )
+    file_id = db.Column(db.Integer(), db.ForeignKey(Files.id), nullable=False)
+    error = db.Column(db.String(255))
+
+    def __repr__(self):
+        return str(self.file_id)
+
+
+class Uploads(db.Model):
+    """
+    Define the attributes for resumable uploads sent in chunks
+    """
+
+    id = db.Column(db.String(32), primary_key=True)
+    file_name = db.Column(db.String(255))
+    length = db.Column(db.BigInteger())
+    offset = db.Column(db.BigInteger())
+    job_id = db.Column(db.Integer(), db.ForeignKey(Jobs.id))
+    created = db.Column(db.DateTime())
+    updated = db.Column(db.DateTime(), index=True)
+
+    def __init__(self, id, file_name, length, created):
+        self.id = id
+        self.file_name = file_name
+        self.length = length
+        self.offset = 0
+        self.created = created
+        self.updated = created
+
+    def __repr__(self):
+        return self.file_name
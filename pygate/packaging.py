@@ -0,0 +1,167 @@
+"""
+Build compressed packages of uploads as a stream that can be staged directly
+"""
+
+import os
+import queue
+import tarfile
+import threading
+import time
+from pygate import app
+from pygate.helpers import push_stream_to_filecoin
+
+try:
+    import zstandard
+except ImportError:  # zstd packages are optional
+    zstandard = None
+
+CHUNK_SIZE = 1024 * 1024  # 1MB
+
+# File name extension of a package for each PACKAGE_COMPRESSION setting
+EXTENSIONS = {"": ".tar", "gz": ".tar.gz", "zstd": ".tar.zst"}
+
+
+class PackagePipe(object):
+    """
+    A bounded queue of chunks with a file-like write side for the thread
+    building the archive and an iterator side for the code staging it
+    """
+
+    def __init__(self, max_chunks):
+        self._chunks = queue.Queue(maxsize=max_chunks)
+        self._buffer = bytearray()
+        self._cancelled = threading.Event()
+        self.error = None
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= CHUNK_SIZE:
+            self._put(bytes(self._buffer[:CHUNK_SIZE]))
+            del self._buffer[:CHUNK_SIZE]
+
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self, error=None):
+        """
+        Mark the end of the archive, passing on the error that ended it early
+        """
+
+        if self._cancelled.is_set():
+            return
+
+        self.error = error
+        if self._buffer and error is None:
+            self._put(bytes(self._buffer))
+        self._buffer = bytearray()
+        self._put(None)
+
+    def cancel(self):
+        """
+        Stop the writing thread when nobody reads the chunks any more
+        """
+
+        self._cancelled.set()
+
+    def __iter__(self):
+        try:
+            while True:
+                chunk = self._chunks.get()
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            self.cancel()
+
+        if self.error is not None:
+            raise self.error
+
+    def _put(self, chunk):
+        # Block while the queue is full, unless reading has been abandoned
+        while True:
+            if self._cancelled.is_set():
+                raise IOError("Package stream was abandoned by its reader")
+            try:
+                self._chunks.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+
+def package_name(name, compression):
+    """
+    Return the file name of a package for the configured compression
+    """
+
+    if compression not in EXTENSIONS:
+        raise ValueError("Unknown package compression '{}'".format(compression))
+
+    return name + EXTENSIONS[compression]
+
+
+def stream_package(uploads, compression):
+    """
+    Return a PackagePipe to iterate over the bytes of a tar archive of the
+    uploaded (file name, stream) pairs, compressed as configured. The archive
+    is built by a separate thread that reads every upload stream once, and at
+    most PACKAGE_BUFFER_CHUNKS chunks are held in memory at any time. Call
+    cancel() on the pipe if it is not read to the end.
+    """
+
+    if compression == "zstd" and zstandard is None:
+        raise ValueError("zstd packages need the zstandard package installed")
+    package_name("", compression)
+
+    pipe = PackagePipe(app.config["PACKAGE_BUFFER_CHUNKS"])
+    writer = threading.Thread(
+        target=_write_archive,
+        args=(uploads, pipe, compression),
+        name="pygate-package",
+        daemon=True,
+    )
+    writer.start()
+
+    return pipe
+
+
+def push_package(uploads, file_name):
+    """
+    Stage a package of the uploaded (file name, stream) pairs while it is
+    being built, push it to Filecoin and record it as `file_name`
+    """
+
+    pipe = stream_package(uploads, app.config["PACKAGE_COMPRESSION"])
+    try:
+        return push_stream_to_filecoin(pipe, file_name)
+    finally:
+        pipe.cancel()
+
+
+def _write_archive(uploads, pipe, compression):
+    try:
+        if compression == "zstd":
+            out_file = zstandard.ZstdCompressor().stream_writer(pipe)
+            mode = "w|"
+        else:
+            out_file = pipe
+            mode = "w|" + compression
+
+        with tarfile.open(fileobj=out_file, mode=mode) as tarball:
+            for file_name, stream in uploads:
+                # Uploads are spooled by Werkzeug, so their size can be read
+                # without going over their content
+                stream.seek(0, os.SEEK_END)
+                info = tarfile.TarInfo(file_name)
+                info.size = stream.tell()
+                info.mtime = time.time()
+                stream.seek(0)
+                tarball.addfile(info, stream)
+
+        if compression == "zstd":
+            out_file.flush(zstandard.FLUSH_FRAME)
+    except Exception as e:
+        pipe.close(e)
+    else:
+        pipe.close()
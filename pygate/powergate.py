@@ -0,0 +1,481 @@
+"""
+Share a bounded pool of long-lived Powergate clients across requests, one
+pool per Powergate node, and route calls to the node owning each FFS.
+Transfers and pushes, which may take minutes, share one more client per
+node instead of holding a pooled one.
+"""
+
+import hashlib
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from flask import g
+from pygate import app
+from pygate.metrics import POWERGATE_ERRORS, POWERGATE_IN_FLIGHT, POWERGATE_SECONDS
+
+# Services of the Powergate client whose calls are timed
+SERVICES = ("health", "faults", "deals", "ffs", "wallet", "net")
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no Powergate client became free within the checkout timeout
+    """
+
+
+class CallStats(object):
+    """
+    Running latency figures for one Powergate method
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds, failed):
+        self.calls += 1
+        self.errors += int(failed)
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "total_seconds": round(self.total_seconds, 6),
+            "mean_seconds": round(self.total_seconds / self.calls, 6)
+            if self.calls
+            else 0.0,
+            "max_seconds": round(self.max_seconds, 6),
+        }
+
+
+class _TimedService(object):
+    """
+    Proxy to a Powergate service client that times each method call and
+    flags the pooled client as broken when Powergate is unreachable
+    """
+
+    def __init__(self, name, service, pooled):
+        self._name = name
+        self._service = service
+        self._pooled = pooled
+
+    def __getattr__(self, attr):
+        method = getattr(self._service, attr)
+        if not callable(method):
+            return method
+
+        key = self._name + "." + attr
+        pooled = self._pooled
+
+        def timed(*args, **kwargs):
+            return pooled.call(key, method, *args, **kwargs)
+
+        return timed
+
+
+class PooledClient(object):
+    """
+    A long-lived Powergate client handed out by a PowerGatePool
+    """
+
+    def __init__(self, pool):
+        # The gRPC modules take a while to load; commands and requests that
+        # never reach Powergate do without them
+        import grpc
+        from pygate_grpc.client import PowerGateClient
+
+        self.pool = pool
+        self.channel = grpc.insecure_channel(pool.address)
+        self.client = PowerGateClient(pool.address)
+        self.broken = False
+        self.last_checked = time.monotonic()
+
+        for name in SERVICES:
+            service = getattr(self.client, name)
+            # Every service calls over the one channel of the client, so
+            # closing it closes them all
+            service.client = type(service.client)(self.channel)
+            setattr(self, name, _TimedService(name, service, self))
+
+    def close(self):
+        self.channel.close()
+
+    def call(self, key, method, *args, **kwargs):
+        """
+        Call a Powergate method, recording its latency under `key` and
+        flagging the client as broken when Powergate is unreachable
+        """
+
+        started = time.perf_counter()
+        failed = False
+        POWERGATE_IN_FLIGHT.inc(method=key)
+        try:
+            return method(*args, **kwargs)
+        except Exception as e:
+            failed = True
+            POWERGATE_ERRORS.inc(method=key)
+            if _is_unavailable(e):
+                self.broken = True
+                self.pool.mark_down()
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            POWERGATE_IN_FLIGHT.dec(method=key)
+            POWERGATE_SECONDS.observe(seconds, method=key)
+            self.pool.record_call(key, seconds, failed)
+
+
+class PowerGatePool(object):
+    """
+    Hand out up to `size` Powergate clients for one Powergate address,
+    opening their gRPC channels once and health-checking them on checkout.
+    A node found unreachable is reported as unavailable for
+    `retry_interval` seconds.
+    """
+
+    def __init__(
+        self, address, size, timeout, health_check_interval, retry_interval
+    ):
+        self.address = address
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.retry_interval = retry_interval
+        self._down_until = 0.0
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_seconds = 0.0
+        self._reconnects = 0
+        self._health_failures = 0
+        self._calls = {}
+        self._shared = None
+        self._shared_lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Check out a client, opening a new one while the pool is below its size
+        and waiting for one to be released otherwise
+        """
+
+        try:
+            pooled = self._idle.get_nowait()
+        except queue.Empty:
+            pooled = None
+            with self._lock:
+                if self._created < self.size:
+                    self._created += 1
+                    create = True
+                else:
+                    create = False
+
+            if create:
+                try:
+                    pooled = PooledClient(self)
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                started = time.perf_counter()
+                try:
+                    pooled = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise PoolTimeout(
+                        "No Powergate client for {} became free in {}s".format(
+                            self.address, self.timeout
+                        )
+                    )
+                finally:
+                    with self._lock:
+                        self._waits += 1
+                        self._wait_seconds += time.perf_counter() - started
+
+        if time.monotonic() - pooled.last_checked > self.health_check_interval:
+            pooled = self._check(pooled)
+
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+
+        return pooled
+
+    def release(self, pooled):
+        """
+        Return a client to the pool, reconnecting it first if a call found
+        Powergate unreachable
+        """
+
+        with self._lock:
+            self._in_use -= 1
+
+        if pooled.broken:
+            pooled = self._reconnect(pooled)
+
+        self._idle.put(pooled)
+
+    def shared(self):
+        """
+        Return the client shared by calls that may take minutes, such as file
+        transfers and pushes, so they never hold up checkouts. gRPC
+        multiplexes concurrent calls over its channel, so it is never checked
+        out; it is replaced once a call finds Powergate unreachable.
+        """
+
+        with self._shared_lock:
+            if self._shared is not None and self._shared.broken:
+                with self._lock:
+                    self._reconnects += 1
+                self._shared.close()
+                self._shared = None
+            if self._shared is None:
+                self._shared = PooledClient(self)
+
+            return self._shared
+
+    @contextmanager
+    def client(self):
+        """
+        Check out a client for the duration of a with block
+        """
+
+        pooled = self.acquire()
+        try:
+            yield pooled
+        finally:
+            self.release(pooled)
+
+    @property
+    def available(self):
+        """
+        Whether the node has not been found unreachable recently
+        """
+
+        return time.monotonic() >= self._down_until
+
+    def mark_down(self):
+        with self._lock:
+            self._down_until = time.monotonic() + self.retry_interval
+
+    def mark_up(self):
+        with self._lock:
+            self._down_until = 0.0
+
+    def record_call(self, method, seconds, failed):
+        with self._lock:
+            stats = self._calls.get(method)
+            if stats is None:
+                stats = self._calls[method] = CallStats()
+            stats.record(seconds, failed)
+
+    def stats(self):
+        """
+        Report channel usage and per-method call latency
+        """
+
+        with self._lock:
+            return {
+                "address": self.address,
+                "available": time.monotonic() >= self._down_until,
+                "size": self.size,
+                "open": self._created,
+                "shared": self._shared is not None,
+                "in_use": self._in_use,
+                "idle": self._idle.qsize(),
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "wait_seconds": round(self._wait_seconds, 6),
+                "reconnects": self._reconnects,
+                "health_check_failures": self._health_failures,
+                "calls": {
+                    method: stats.to_dict()
+                    for method, stats in sorted(self._calls.items())
+                },
+            }
+
+    def _check(self, pooled):
+        # Replace the client if Powergate does not answer its health check
+        try:
+            pooled.client.health.check()
+        except Exception:
+            with self._lock:
+                self._health_failures += 1
+            self.mark_down()
+            return self._reconnect(pooled)
+
+        pooled.last_checked = time.monotonic()
+        self.mark_up()
+
+        return pooled
+
+    def _reconnect(self, pooled):
+        # Replace a client, closing its channel. If no new client can be
+        # opened its slot is given up, so a later checkout opens one again.
+        with self._lock:
+            self._reconnects += 1
+        pooled.close()
+
+        replaced = None
+        try:
+            replaced = PooledClient(self)
+        finally:
+            if replaced is None:
+                with self._lock:
+                    self._created -= 1
+
+        return replaced
+
+
+def get_pool(address=None):
+    """
+    Return the process-wide pool for a Powergate address, creating it on
+    first use. Defaults to the first available node, for calls that any
+    node can answer.
+    """
+
+    address = address or available_nodes()[0]
+
+    with _pools_lock:
+        pool = _pools.get(address)
+        if pool is None:
+            pool = _pools[address] = PowerGatePool(
+                address,
+                size=app.config["POWERGATE_POOL_SIZE"],
+                timeout=app.config["POWERGATE_POOL_TIMEOUT"],
+                health_check_interval=app.config["POWERGATE_HEALTH_CHECK_INTERVAL"],
+                retry_interval=app.config["POWERGATE_NODE_RETRY_INTERVAL"],
+            )
+
+    return pool
+
+
+def get_powergate(address=None):
+    """
+    Return the Powergate client for a node checked out for the current
+    application context, checking one out on first use. It goes back to
+    the pool when the context ends. Defaults to the first available node.
+    """
+
+    pool = get_pool(address)
+    if "powergates" not in g:
+        g.powergates = {}
+    if pool.address not in g.powergates:
+        g.powergates[pool.address] = pool.acquire()
+
+    return g.powergates[pool.address]
+
+
+def get_shared_powergate(address=None):
+    """
+    Return the shared Powergate client of a node, for transfers and pushes
+    that would hold a pooled client for too long. Defaults to the first
+    available node.
+    """
+
+    return get_pool(address).shared()
+
+
+def node_of(ffs):
+    """
+    Return the address of the Powergate node owning a FFS. FFSes created
+    before nodes were recorded belong to POWERGATE_ADDRESS.
+    """
+
+    return ffs.node or app.config["POWERGATE_ADDRESS"]
+
+
+def nodes():
+    """
+    Return the addresses of every Powergate node, the owner of FFSes
+    created before nodes were recorded first
+    """
+
+    addresses = list(app.config["POWERGATE_ADDRESSES"])
+    if app.config["POWERGATE_ADDRESS"] not in addresses:
+        addresses.insert(0, app.config["POWERGATE_ADDRESS"])
+
+    return addresses
+
+
+def available_nodes():
+    """
+    Return the nodes that have not been found unreachable recently, in the
+    configured order, or every node if none is available
+    """
+
+    addresses = nodes()
+    with _pools_lock:
+        available = [
+            address
+            for address in addresses
+            if address not in _pools or _pools[address].available
+        ]
+
+    return available or addresses
+
+
+def place_ffs(loads):
+    """
+    Pick the node for a new FFS among the available nodes, given the number
+    of FFSes each node owns. POWERGATE_PLACEMENT "least_loaded" picks the
+    node owning the fewest (the first in the configured order on a tie),
+    "hash" spreads them by rendezvous hashing of the number of FFSes
+    created so far.
+    """
+
+    candidates = available_nodes()
+
+    if app.config["POWERGATE_PLACEMENT"] == "hash":
+        key = str(sum(loads.values()))
+
+        def score(address):
+            digest = hashlib.sha256((address + "/" + key).encode()).digest()
+            return digest[:8]
+
+        return max(candidates, key=score)
+
+    return min(candidates, key=lambda address: loads.get(address, 0))
+
+
+@app.teardown_appcontext
+def release_powergate(exception):
+    pooled_clients = g.pop("powergates", {})
+
+    for pooled in pooled_clients.values():
+        pooled.pool.release(pooled)
+
+
+def pool_stats():
+    """
+    Report the statistics of every Powergate pool in this process
+    """
+
+    with _pools_lock:
+        pools = list(_pools.values())
+
+    return [pool.stats() for pool in pools]
+
+
+def _is_unavailable(error):
+    import grpc
+    from pygate_grpc.exceptions import GRPCNotAvailableException
+
+    if isinstance(error, GRPCNotAvailableException):
+        return True
+
+    return (
+        isinstance(error, grpc.RpcError)
+        and callable(getattr(error, "code", None))
+        and error.code() == grpc.StatusCode.UNAVAILABLE
+    )
@@ -0,0 +1,348 @@
+"""
+Push every file of a FFS again after its storage config changed, in the
+background and in batches that are recorded as they finish, so that a run
+interrupted by a restart resumes where it stopped
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from sqlalchemy import func
+from pygate import app, db
+from pygate.models import ConfigFailures, ConfigRuns, Ffs, Files
+from pygate.eventlog import log_event
+from pygate.ffs_config import push_config
+from pygate.powergate import get_shared_powergate, node_of
+from pygate.watcher import QUEUED as STORAGE_QUEUED, wake_watcher
+from pygate.workers import worker_id, worker_alive
+
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+# Replaced by a later change of the same FFS config
+SUPERSEDED = "superseded"
+
+# Ids of the runs being pushed by this process
+_running = set()
+_running_lock = threading.Lock()
+
+
+class ConfigRunError(Exception):
+    """
+    Raised for a config run that cannot be started
+    """
+
+
+def create_config_run(ffs, config_json):
+    """
+    Record that every file of a FFS is to be pushed again with a new
+    config, replacing the earlier runs of the FFS
+    """
+
+    now = datetime.now().replace(microsecond=0)
+    # Finished runs too, so that retrying their failures cannot push an
+    # older config over this one
+    ConfigRuns.query.filter(
+        ConfigRuns.ffs_id == ffs.id, ConfigRuns.status != SUPERSEDED
+    ).update({"status": SUPERSEDED, "updated": now}, synchronize_session=False)
+
+    # A FFS without files has nothing to push, so its run is done already
+    total = Files.query.filter_by(ffs_id=ffs.id).count()
+    run = ConfigRuns(
+        ffs_id=ffs.id,
+        config=config_json,
+        status=RUNNING if total else DONE,
+        total=total,
+        created=now,
+    )
+    db.session.add(run)
+    db.session.commit()
+
+    return run
+
+
+def running_elsewhere(run):
+    """
+    Whether another live process is pushing the files of a run
+    """
+
+    return (
+        run.status == RUNNING
+        and run.worker not in (None, worker_id())
+        and worker_alive(run.worker)
+    )
+
+
+def run_config_push(run_id, workers=None, retry_failed=False):
+    """
+    Push the files of a run that have not been pushed yet, in batches of
+    CONFIG_PUSH_BATCH_SIZE ordered by id. Stops early if the run is
+    superseded by a newer config.
+    """
+
+    with _running_lock:
+        if run_id in _running:
+            raise ConfigRunError("Config run {} is already running".format(run_id))
+        _running.add(run_id)
+
+    try:
+        run = ConfigRuns.query.get(run_id)
+        if run is None:
+            raise ConfigRunError("There is no config run {}".format(run_id))
+        if run.status == SUPERSEDED:
+            raise ConfigRunError("Config run {} was superseded".format(run_id))
+        if running_elsewhere(run):
+            raise ConfigRunError(
+                "Config run {} is running in process {}".format(run_id, run.worker)
+            )
+
+        run.status = RUNNING
+        run.worker = worker_id()
+        run.error = None
+        db.session.commit()
+        ffs = Ffs.query.get(run.ffs_id)
+
+        workers = workers or app.config["CONFIG_PUSH_WORKERS"]
+        with ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="pygate-config-push"
+        ) as executor:
+            if retry_failed:
+                # Only the failures recorded before, not those of the retry
+                last_failure = (
+                    db.session.query(func.max(ConfigFailures.id))
+                    .filter_by(run_id=run.id)
+                    .scalar()
+                    or 0
+                )
+                after = 0
+                while after is not None:
+                    after = push_failed_batch(
+                        run, ffs, executor, after, last_failure
+                    )
+            while push_batch(run, ffs, executor):
+                pass
+
+        db.session.refresh(run)
+        if run.status == RUNNING:
+            run.status = DONE
+            run.updated = datetime.now().replace(microsecond=0)
+            db.session.commit()
+            log_event(
+                "Pushed {} files of FFS {} with its new config, {} failed".format(
+                    run.done, run.ffs_id, run.failed
+                )
+            )
+    except ConfigRunError:
+        raise
+    except Exception as e:
+        db.session.rollback()
+        ConfigRuns.query.filter_by(id=run_id, status=RUNNING).update(
+            {"status": FAILED, "error": str(e)[:255]}, synchronize_session=False
+        )
+        db.session.commit()
+        log_event("Config push ERROR: {} {}".format(run_id, e))
+        raise
+    finally:
+        with _running_lock:
+            _running.discard(run_id)
+
+    return run
+
+
+def push_batch(run, ffs, executor):
+    """
+    Push the next batch of files after the run's checkpoint and record
+    them. Returns how many files were pushed, or 0 once every file has been
+    or the run was superseded.
+    """
+
+    files = (
+        db.session.query(Files.id, Files.CID)
+        .filter(Files.ffs_id == run.ffs_id, Files.id > run.last_file_id)
+        .order_by(Files.id)
+        .limit(app.config["CONFIG_PUSH_BATCH_SIZE"])
+        .all()
+    )
+    if not files:
+        return 0
+
+    if not record_batch(run, ffs, executor, files, last_file_id=files[-1].id):
+        return 0
+
+    return len(files)
+
+
+def push_failed_batch(run, ffs, executor, after, last_failure):
+    """
+    Push the files that failed earlier in the run again, taking the next
+    batch of failures with ids after `after` up to `last_failure`. Returns
+    the id of the last failure of the batch, or None once there are none.
+    """
+
+    failures = (
+        db.session.query(ConfigFailures.id, Files.id, Files.CID)
+        .join(Files, Files.id == ConfigFailures.file_id)
+        .filter(
+            ConfigFailures.run_id == run.id,
+            ConfigFailures.id > after,
+            ConfigFailures.id <= last_failure,
+        )
+        .order_by(ConfigFailures.id)
+        .limit(app.config["CONFIG_PUSH_BATCH_SIZE"])
+        .all()
+    )
+    if not failures:
+        return None
+
+    ConfigFailures.query.filter(
+        ConfigFailures.id.in_([failure[0] for failure in failures])
+    ).delete(synchronize_session=False)
+    run.failed -= len(failures)
+    files = [(file_id, cid) for _, file_id, cid in failures]
+    if not record_batch(run, ffs, executor, files):
+        return None
+
+    return failures[-1][0]
+
+
+def record_batch(run, ffs, executor, files, last_file_id=None):
+    """
+    Push a batch of (id, CID) files from the thread pool, then store their
+    new storage jobs, their failures and the checkpoint of the run in one
+    transaction. Returns False without recording anything if the run was
+    superseded meanwhile.
+    """
+
+    node = node_of(ffs)
+    pushes = [
+        (file_id, executor.submit(push_file, node, cid, ffs.token, run.config))
+        for file_id, cid in files
+    ]
+
+    now = datetime.now().replace(microsecond=0)
+    jobs = []
+    failures = []
+    for file_id, future in pushes:
+        try:
+            job_id = future.result()
+        except Exception as e:
+            failures.append(
+                {"run_id": run.id, "file_id": file_id, "error": str(e)[:255]}
+            )
+            continue
+        jobs.append(
+            {
+                "id": file_id,
+                "storage_job_id": job_id,
+                "storage_status": STORAGE_QUEUED,
+                "storage_error": None,
+                "storage_updated": now,
+            }
+        )
+
+    # Leave the files to the run that superseded this one
+    status = db.session.query(ConfigRuns.status).filter_by(id=run.id).scalar()
+    if status != RUNNING:
+        db.session.rollback()
+        return False
+
+    try:
+        db.session.bulk_update_mappings(Files, jobs)
+        db.session.bulk_insert_mappings(ConfigFailures, failures)
+        if last_file_id is not None:
+            run.last_file_id = last_file_id
+        run.done += len(jobs)
+        run.failed += len(failures)
+        run.updated = now
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    if jobs:
+        wake_watcher()
+
+    return True
+
+
+def push_file(node, cid, token, config_json):
+    """
+    Push a CID with a config to the Powergate node of its FFS from a worker
+    thread, returning the id of its new storage job
+    """
+
+    powergate = get_shared_powergate(node)
+
+    return push_config(powergate, cid, token, config_json).job_id
+
+
+def config_run_to_dict(run, failures=0):
+    """
+    Describe a config run for the JSON API, with up to `failures` of the
+    files it failed to push
+    """
+
+    result = {
+        "id": run.id,
+        "ffs_id": run.ffs_id,
+        "status": run.status,
+        "error": run.error,
+        "total": run.total,
+        "done": run.done,
+        "failed": run.failed,
+        "created": str(run.created),
+        "updated": str(run.updated),
+    }
+
+    if failures:
+        rows = (
+            db.session.query(Files.CID, Files.file_name, ConfigFailures.error)
+            .join(Files, Files.id == ConfigFailures.file_id)
+            .filter(ConfigFailures.run_id == run.id)
+            .order_by(ConfigFailures.id)
+            .limit(failures)
+        )
+        result["failures"] = [
+            {"CID": cid, "file_name": file_name, "error": error}
+            for cid, file_name, error in rows
+        ]
+
+    return result
+
+
+def start_config_run(run_id, retry_failed=False):
+    """
+    Push the files of a config run from a background thread
+    """
+
+    threading.Thread(
+        target=_run_config_push_logged,
+        args=(run_id, retry_failed),
+        name="pygate-config-run",
+        daemon=True,
+    ).start()
+
+
+def _run_config_push_logged(run_id, retry_failed):
+    with app.app_context():
+        try:
+            run_config_push(run_id, retry_failed=retry_failed)
+        except Exception:
+            # run_config_push has logged the error and marked the run failed
+            pass
+
+
+def resume_config_runs():
+    """
+    Restart in the background the config runs whose process stopped before
+    they finished
+    """
+
+    runs = ConfigRuns.query.filter_by(status=RUNNING).all()
+    resumed = 0
+    for run in runs:
+        if run.worker is None or not worker_alive(run.worker):
+            start_config_run(run.id)
+            resumed += 1
+
+    return resumed
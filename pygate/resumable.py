@@ -0,0 +1,341 @@
+"""
+Receive large uploads in resumable chunks, following the tus protocol
+(https://tus.io/protocols/resumable-upload.html), and queue them to be pushed
+to Filecoin once complete
+"""
+
+import base64
+import binascii
+import hashlib
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+from werkzeug.exceptions import ClientDisconnected
+from werkzeug.utils import secure_filename
+from pygate import app, db
+from pygate.models import Uploads
+from pygate.jobs import enqueue_push
+from pygate.lifecycle import new_upload_directory
+
+TUS_VERSION = "1.0.0"
+TUS_EXTENSIONS = "creation,checksum,termination,expiration"
+CHECKSUM_ALGORITHMS = {"sha256": hashlib.sha256}
+
+CHUNK_SIZE = 1024 * 1024  # 1MB
+
+# Digest of the bytes received so far for each upload written by this
+# process, as (offset, hash), so the content hash is known on completion
+# without reading the whole file again
+_digests = {}
+
+# One lock per upload, so chunks of the same upload are never written at once
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    """
+    A chunk or upload request that cannot be accepted, with the HTTP status
+    to answer it with
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_metadata(header):
+    """
+    Decode an Upload-Metadata header into a dictionary of strings
+    """
+
+    metadata = {}
+    for pair in (header or "").split(","):
+        if not pair.strip():
+            continue
+        key, _, value = pair.strip().partition(" ")
+        try:
+            metadata[key] = base64.b64decode(value, validate=True).decode("utf-8")
+        except (binascii.Error, UnicodeDecodeError):
+            raise UploadError(400, "Invalid Upload-Metadata value for " + key)
+
+    return metadata
+
+
+def part_path(upload):
+    """
+    Return the path of the file the chunks of an upload are written to
+    """
+
+    return os.path.join(app.config["UPLOADDIR"], upload.id + ".part")
+
+
+def upload_offset(upload):
+    """
+    Return the number of bytes of an upload that are safely stored. Never
+    more than the partial file holds, should it have lost its last writes.
+    """
+
+    if upload.offset >= upload.length:
+        return upload.offset
+
+    try:
+        return min(upload.offset, os.path.getsize(part_path(upload)))
+    except OSError:
+        return 0
+
+
+def expires_at(upload):
+    """
+    Return when an unfinished upload will be removed
+    """
+
+    hours = app.config["RESUMABLE_UPLOAD_EXPIRY_HOURS"]
+
+    return upload.updated + timedelta(hours=hours)
+
+
+def create_upload(file_name, length):
+    """
+    Start a resumable upload of `length` bytes to be saved as `file_name`
+    """
+
+    file_name = secure_filename(file_name or "")
+    if not file_name:
+        raise UploadError(400, "A filename must be given in Upload-Metadata")
+
+    max_size = app.config["RESUMABLE_UPLOAD_MAX_SIZE"]
+    if length < 0 or (max_size is not None and length > max_size):
+        raise UploadError(413, "Upload-Length is out of range")
+
+    expire_uploads()
+
+    upload_path = app.config["UPLOADDIR"]
+    if not os.path.exists(upload_path):
+        os.makedirs(upload_path)
+
+    upload = Uploads(
+        id=uuid.uuid4().hex,
+        file_name=file_name,
+        length=length,
+        created=datetime.now().replace(microsecond=0),
+    )
+    open(part_path(upload), "wb").close()
+    db.session.add(upload)
+    db.session.commit()
+
+    if length == 0:
+        complete_upload(upload)
+
+    return upload
+
+
+def write_chunk(upload, offset, stream, checksum=None):
+    """
+    Append the bytes of `stream` to an upload at `offset`, which must be the
+    number of bytes received so far. If `checksum` ("<algorithm> <base64
+    digest>") is given the chunk is kept only if it matches; otherwise the
+    bytes received before a dropped connection are kept, so the client can
+    resume from there. The upload is queued to be pushed once complete.
+    """
+
+    with upload_lock(upload.id):
+        writer = ChunkWriter(upload, offset, checksum)
+        disconnected = False
+        try:
+            while True:
+                data = stream.read(min(CHUNK_SIZE, writer.remaining + 1))
+                if not data:
+                    break
+                writer.write(data)
+        except ClientDisconnected:
+            disconnected = True
+        except Exception:
+            writer.abort()
+            raise
+
+        writer.finish(disconnected)
+
+    forget_lock(upload)
+
+    return upload
+
+
+class ChunkWriter(object):
+    """
+    Write one chunk of an upload to its partial file as its bytes arrive.
+    Create it holding the lock of the upload and call finish() or abort()
+    before releasing the lock.
+    """
+
+    def __init__(self, upload, offset, checksum=None):
+        self.checksum = None
+        if checksum is not None:
+            algorithm, _, expected = checksum.partition(" ")
+            if algorithm not in CHECKSUM_ALGORITHMS:
+                raise UploadError(400, "Unsupported checksum algorithm " + algorithm)
+            try:
+                self.expected = base64.b64decode(expected, validate=True)
+            except binascii.Error:
+                raise UploadError(400, "Invalid Upload-Checksum digest")
+            self.checksum = CHECKSUM_ALGORITHMS[algorithm]()
+
+        db.session.refresh(upload)
+        if upload.job_id is not None or offset != upload_offset(upload):
+            raise UploadError(409, "Upload-Offset does not match the upload")
+
+        self.upload = upload
+        self.offset = offset
+        self.remaining = upload.length - offset
+        self.received = 0
+
+        previous = _digests.get(upload.id)
+        if previous is not None and previous[0] == offset:
+            self.digest = previous[1].copy()
+        elif offset == 0:
+            self.digest = hashlib.sha256()
+        else:
+            self.digest = None
+
+        self.part_file = open(part_path(upload), "r+b")
+        self.part_file.seek(offset)
+        self.part_file.truncate()
+
+    def write(self, data):
+        if len(data) > self.remaining:
+            self.abort()
+            raise UploadError(413, "Chunk runs past Upload-Length")
+
+        self.part_file.write(data)
+        self.received += len(data)
+        self.remaining -= len(data)
+        if self.checksum is not None:
+            self.checksum.update(data)
+        if self.digest is not None:
+            self.digest.update(data)
+
+    def abort(self):
+        """
+        Drop the bytes of the chunk received so far
+        """
+
+        if not self.part_file.closed:
+            self.part_file.truncate(self.offset)
+            self.part_file.close()
+
+    def finish(self, disconnected=False):
+        """
+        Keep the bytes received, or drop them if the chunk does not match its
+        checksum, and queue the upload to be pushed once it is complete
+        """
+
+        if self.checksum is not None and (
+            disconnected or self.checksum.digest() != self.expected
+        ):
+            # A chunk is only kept whole once its checksum has been verified
+            self.abort()
+            raise UploadError(460, "Upload-Checksum does not match the chunk")
+        self.part_file.close()
+
+        # Loaded again in case the chunk was written from another thread
+        upload = self.upload = Uploads.query.get(self.upload.id)
+        upload.offset = self.offset + self.received
+        upload.updated = datetime.now().replace(microsecond=0)
+        db.session.commit()
+
+        if self.digest is not None:
+            _digests[upload.id] = (upload.offset, self.digest)
+        else:
+            _digests.pop(upload.id, None)
+
+        if upload.offset == upload.length:
+            complete_upload(upload)
+
+
+def complete_upload(upload):
+    """
+    Move a complete upload into a directory of its own in UPLOADDIR under
+    its file name and queue it to be pushed to Filecoin
+    """
+
+    upload_path = new_upload_directory()
+    os.replace(part_path(upload), os.path.join(upload_path, upload.file_name))
+
+    content_hash = None
+    digest = _digests.pop(upload.id, None)
+    if digest is not None and digest[0] == upload.length:
+        content_hash = digest[1].hexdigest()
+    elif upload.length == 0:
+        content_hash = hashlib.sha256().hexdigest()
+
+    job = enqueue_push(upload_path, upload.file_name, content_hash, upload.length)
+    upload.job_id = job.id
+    db.session.commit()
+
+    return job
+
+
+def delete_upload(upload):
+    """
+    Abandon an unfinished upload and remove what was received of it
+    """
+
+    with upload_lock(upload.id):
+        if upload.job_id is not None:
+            raise UploadError(409, "The upload is already complete")
+
+        _remove_part(upload)
+        db.session.delete(upload)
+        db.session.commit()
+
+    with _locks_lock:
+        _locks.pop(upload.id, None)
+
+
+def expire_uploads():
+    """
+    Remove the unfinished uploads that have received nothing for
+    RESUMABLE_UPLOAD_EXPIRY_HOURS
+    """
+
+    cutoff = datetime.now() - timedelta(
+        hours=app.config["RESUMABLE_UPLOAD_EXPIRY_HOURS"]
+    )
+    expired = Uploads.query.filter(
+        Uploads.job_id.is_(None), Uploads.updated < cutoff
+    ).all()
+
+    for upload in expired:
+        _remove_part(upload)
+        db.session.delete(upload)
+    db.session.commit()
+
+    return len(expired)
+
+
+def _remove_part(upload):
+    _digests.pop(upload.id, None)
+    try:
+        os.remove(part_path(upload))
+    except FileNotFoundError:
+        pass
+
+
+def upload_lock(upload_id):
+    """
+    Return the lock held while a chunk of an upload is being written
+    """
+
+    with _locks_lock:
+        return _locks.setdefault(upload_id, threading.Lock())
+
+
+def forget_lock(upload):
+    """
+    Drop the lock of an upload that takes no more chunks
+    """
+
+    if upload.job_id is not None:
+        with _locks_lock:
+            _locks.pop(upload.id, None)
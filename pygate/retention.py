@@ -0,0 +1,128 @@
+"""
+Archive old log entries to compressed files and remove them from the database
+"""
+
+import gzip
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+import click
+from pygate import app, db
+from pygate.models import Logs
+from pygate.eventlog import log_event
+
+_retention = None
+_retention_lock = threading.Lock()
+
+
+def archive_logs(before, batch_size=1000):
+    """
+    Move the log entries older than `before` to gzipped JSON lines files in
+    LOG_ARCHIVE_DIR, one file per month, and return how many were moved.
+    Entries are removed from the database only once they are written out.
+    """
+
+    directory = app.config["LOG_ARCHIVE_DIR"]
+    os.makedirs(directory, exist_ok=True)
+
+    archived = 0
+    while True:
+        batch = (
+            Logs.query.filter(Logs.timestamp < before)
+            .order_by(Logs.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not batch:
+            break
+
+        months = {}
+        for entry in batch:
+            months.setdefault(entry.timestamp.strftime("%Y-%m"), []).append(entry)
+
+        for month, entries in months.items():
+            # Each append adds a gzip member, which readers see as one stream
+            path = os.path.join(directory, "logs-{}.jsonl.gz".format(month))
+            with gzip.open(path, "at") as archive:
+                for entry in entries:
+                    archive.write(
+                        json.dumps(
+                            {
+                                "id": entry.id,
+                                "timestamp": entry.timestamp.isoformat(),
+                                "event": entry.event,
+                            }
+                        )
+                        + "\n"
+                    )
+
+        # The batch holds every old entry up to its last id
+        Logs.query.filter(Logs.timestamp < before, Logs.id <= batch[-1].id).delete(
+            synchronize_session=False
+        )
+        db.session.commit()
+        archived += len(batch)
+
+    if archived:
+        log_event(
+            "Archived {} log entries from before {} to {}".format(
+                archived, before, directory
+            )
+        )
+
+    return archived
+
+
+def start_retention():
+    """
+    Archive log entries older than LOG_RETENTION_DAYS every
+    LOG_RETENTION_INTERVAL seconds from a background thread. Does nothing
+    when no retention period is configured.
+    """
+
+    global _retention
+
+    if not app.config["LOG_RETENTION_DAYS"]:
+        return
+
+    with _retention_lock:
+        if _retention is None:
+            _retention = threading.Thread(
+                target=_run_retention, name="pygate-retention", daemon=True
+            )
+            _retention.start()
+
+
+def _run_retention():
+    while True:
+        cutoff = datetime.now() - timedelta(days=app.config["LOG_RETENTION_DAYS"])
+        with app.app_context():
+            try:
+                archive_logs(cutoff)
+            except Exception as e:
+                db.session.rollback()
+                log_event("Log archive ERROR: " + str(e))
+
+        time.sleep(app.config["LOG_RETENTION_INTERVAL"])
+
+
+@app.cli.command("archive-logs")
+@click.option(
+    "--days",
+    type=int,
+    default=None,
+    help="Archive entries older than this many days (default: LOG_RETENTION_DAYS)",
+)
+def archive_logs_command(days):
+    """
+    Archive old log entries to compressed files
+    """
+
+    days = days if days is not None else app.config["LOG_RETENTION_DAYS"]
+    if not days:
+        raise click.UsageError("Give --days or set LOG_RETENTION_DAYS")
+
+    archived = archive_logs(datetime.now() - timedelta(days=days))
+    click.echo("Archived {} log entries".format(archived))
@@ -4,28 +4,155 @@ Define the web application's relative routes and the business logic for each
 
 import os
 import json
+import itertools
 from datetime import datetime
-import tarfile
 from flask import (
+    Blueprint,
     render_template,
     redirect,
     url_for,
     flash,
     request,
     send_file,
-    safe_join,
+    jsonify,
+    abort,
+    Response,
+    stream_with_context,
 )
+from werkzeug.http import http_date
 from werkzeug.utils import secure_filename
-from google.protobuf.json_format import MessageToDict
-from pygate_grpc.client import PowerGateClient
 from pygate import app, db
-from pygate.models import Files, Ffs, Logs
+from pygate.models import Ffs, Jobs, Uploads, ImportRuns, ConfigRuns
 from pygate.forms import UploadForm, NewFfsForm, FfsConfigForm
-from pygate.helpers import create_ffs, push_to_filecoin
+from pygate.helpers import (
+    create_ffs,
+    file_copies,
+    list_files,
+    list_logs,
+    log_download,
+    slice_chunks,
+)
+from pygate.analytics import usage_summary
+from pygate.cache import get_cache
+from pygate.eventlog import log_event, flush as flush_events
+from pygate.metrics import timed_chunks, render as render_metrics
+from pygate.imports import (
+    ImportRunError,
+    create_run,
+    start_import,
+    resume_imports,
+    running_elsewhere,
+    run_to_dict,
+)
+from pygate.reapply import (
+    create_config_run,
+    start_config_run,
+    resume_config_runs,
+    config_run_to_dict,
+    running_elsewhere as config_running_elsewhere,
+    SUPERSEDED,
+)
+from pygate.lifecycle import start_sweeper
+from pygate.retention import start_retention
+from pygate.watcher import start_watcher
+from pygate.workers import is_primary_worker
+from pygate.balances import list_wallets
+from pygate.packaging import package_name, push_package
+from pygate.powergate import get_shared_powergate, node_of, pool_stats
+from pygate.ffs_config import StorageConfig, get_default_config, set_default_config
+from pygate.resumable import (
+    TUS_VERSION,
+    TUS_EXTENSIONS,
+    CHECKSUM_ALGORITHMS,
+    UploadError,
+    parse_metadata,
+    create_upload,
+    write_chunk,
+    delete_upload,
+    upload_offset,
+    expires_at,
+)
+from pygate.jobs import (
+    new_batch_id,
+    submit_uploads,
+    batch_progress,
+    run_job_inline,
+    resume_jobs,
+    wait_for_change,
+    job_to_dict,
+    DONE,
+    FAILED,
+)
+
+# Registered on the application by create_app()
+blueprint = Blueprint("pygate", __name__)
+
+
+@blueprint.before_app_first_request
+def restart_pending_jobs():
+    """
+    Pick up the uploads that were queued when the application last stopped.
+    Of several worker processes only the primary one does.
+    """
+
+    if is_primary_worker():
+        resume_jobs()
+
+
+@blueprint.before_app_first_request
+def restart_pending_imports():
+    """
+    Resume the bulk imports that were running when the application last
+    stopped
+    """
+
+    if is_primary_worker():
+        resume_imports()
+
+
+@blueprint.before_app_first_request
+def restart_pending_config_runs():
+    """
+    Resume pushing the files of FFSes whose config changed before the
+    application last stopped
+    """
+
+    if is_primary_worker():
+        resume_config_runs()
 
 
-@app.route("/", methods=["GET"])
-@app.route("/files", methods=["GET", "POST"])
+@blueprint.before_app_first_request
+def start_log_retention():
+    """
+    Start archiving old log entries if a retention period is configured
+    """
+
+    if is_primary_worker():
+        start_retention()
+
+
+@blueprint.before_app_first_request
+def start_upload_sweeper():
+    """
+    Start deleting saved uploads once they are safely stored
+    """
+
+    if is_primary_worker():
+        start_sweeper()
+
+
+@blueprint.before_app_first_request
+def start_storage_watcher():
+    """
+    Start following the storage jobs of pushed files
+    """
+
+    if is_primary_worker():
+        start_watcher()
+
+
+@blueprint.route("/", methods=["GET"])
+@blueprint.route("/files", methods=["GET", "POST"])
 def files():
     """
     Upload new files to add to Filecoin via Powergate FFS and
@@ -45,176 +172,642 @@ def files():
             os.makedirs(upload_path)
         # Get the file(s) and filename(s) from the request
         uploads = request.files.getlist("uploadfile")
+        batch_id = new_batch_id()
+        jobs = []
+        skipped = []
 
         # Create a tarball package if the user requested it
         if form.make_package.data == True:
             if form.package_name.data == "Package name" or form.package_name.data == "":
                 # Return if the user did not provide a name for the package
-                stored_files = Files.query.all()
                 flash("Please give the package a name.")
-                return render_template(
-                    "files.html", upload_form=upload_form, stored_files=stored_files
-                )
-
-            # Create the tar package
-            tarball_name = form.package_name.data + ".tar"
-            tarball = tarfile.open(os.path.join(upload_path, tarball_name), "w:gz")
-
-        # Loop over all files selected for upload
-        for upload in uploads:
-            file_name = secure_filename(upload.filename)
-            try:
-                """TODO: ENCRYPT FILE"""
-                # Save the uploaded file
-                upload.save(os.path.join(upload_path, file_name))
-            except:
+                return render_template("files.html", upload_form=upload_form)
+
+            package = [
+                (secure_filename(upload.filename), upload.stream)
+                for upload in uploads
+                if upload.filename
+            ]
+            if not package:
                 # Return if the user did not provide a file to upload
-                stored_files = Files.query.all()
                 flash("Please choose a file to upload to Filecoin")
-                return render_template(
-                    "files.html", upload_form=upload_form, stored_files=stored_files
+                return render_template("files.html", upload_form=upload_form)
+
+            # Stream the files into one compressed package that is staged
+            # while it is being built, without saving any of them first
+            tarball_name = package_name(
+                secure_filename(form.package_name.data),
+                app.config["PACKAGE_COMPRESSION"],
+            )
+            jobs.append(
+                run_job_inline(
+                    tarball_name,
+                    lambda: push_package(package, tarball_name),
+                    batch_id=batch_id,
                 )
+            )
+        else:
+            # Save all selected files and queue them to be pushed in parallel
+            batch_id, jobs, skipped = submit_uploads(uploads, upload_path, batch_id)
+
+        if not jobs and not skipped:
+            # Return if the user did not provide a file to upload
+            flash("Please choose a file to upload to Filecoin")
+            return render_template("files.html", upload_form=upload_form)
+
+        if request.accept_mimetypes.best == "application/json":
+            return (
+                jsonify(
+                    batch_id=batch_id,
+                    jobs=[job_to_dict(job) for job in jobs],
+                    skipped=skipped,
+                ),
+                202,
+            )
 
-            # Add the file to the tar package if this option was selected
-            if form.make_package.data == True:
-                tarball.add(os.path.join(upload_path, file_name), file_name)
-                # Keep looping over files to add to tar package
-                continue
+        for job in jobs:
+            if job.status == DONE:
+                flash("Uploaded '{}' to Filecoin.".format(job.file_name))
+            elif job.status == FAILED:
+                flash(
+                    "'{}' failed to upload to Filecoin. {}".format(
+                        job.file_name, job.error
+                    )
+                )
+            else:
+                flash("Queued '{}' for upload to Filecoin.".format(job.file_name))
+        for file_name in skipped:
+            flash(
+                "'{}' was not uploaded because too many uploads are waiting to be "
+                "added to Filecoin. Please try again later.".format(file_name)
+            )
 
-            # Add uploaded files to Filecoin
-            push_to_filecoin(upload_path, file_name)
+        return render_template(
+            "files.html", upload_form=upload_form, jobs=jobs, batch_id=batch_id
+        )
 
-        if form.make_package.data == True:
-            tarball.close()
-            # Add tar package to Filecoin
-            push_to_filecoin(upload_path, tarball_name)
+    # The file listing itself is fetched page by page from api_files()
+    return render_template("files.html", upload_form=upload_form)
 
-    stored_files = Files.query.all()
 
-    return render_template(
-        "files.html", upload_form=upload_form, stored_files=stored_files
+@blueprint.route("/api/jobs/<int:job_id>", methods=["GET"])
+def api_job(job_id):
+    """
+    Return the current status of an upload job
+    """
+
+    job = Jobs.query.get_or_404(job_id)
+
+    return jsonify(job_to_dict(job))
+
+
+@blueprint.route("/api/uploads/<batch_id>", methods=["GET"])
+def api_upload_batch(batch_id):
+    """
+    Return the progress of every file of an upload batch
+    """
+
+    progress = batch_progress(batch_id)
+    if progress is None:
+        abort(404)
+
+    return jsonify(progress)
+
+
+@blueprint.route("/api/imports", methods=["GET", "POST"])
+def api_imports():
+    """
+    List the bulk imports (GET) or start importing a directory tree or
+    manifest under IMPORT_ROOT (POST, with a JSON "source" path)
+    """
+
+    if request.method == "GET":
+        runs = ImportRuns.query.order_by(ImportRuns.id.desc()).limit(100)
+        return jsonify(imports=[run_to_dict(run) for run in runs])
+
+    import_root = app.config["IMPORT_ROOT"]
+    if not import_root:
+        abort(403)
+
+    source = (request.get_json(silent=True) or {}).get("source")
+    if not isinstance(source, str) or not source:
+        return jsonify(error="Give the path to import as source"), 400
+
+    # Only paths inside the import root can be imported over HTTP
+    import_root = os.path.realpath(import_root)
+    source = os.path.realpath(os.path.join(import_root, source))
+    if os.path.commonpath([import_root, source]) != import_root:
+        abort(403)
+
+    try:
+        run = create_run(source)
+    except ImportRunError as e:
+        return jsonify(error=str(e)), 400
+    start_import(run.id)
+
+    return (
+        jsonify(run_to_dict(run)),
+        202,
+        {"Location": url_for(".api_import", run_id=run.id)},
     )
 
 
-@app.route("/download/<cid>", methods=["GET"])
-def download(cid):
+@blueprint.route("/api/imports/<int:run_id>", methods=["GET"])
+def api_import(run_id):
+    """
+    Return the progress of a bulk import and its first failed items
+    """
+
+    run = ImportRuns.query.get_or_404(run_id)
+
+    return jsonify(run_to_dict(run, failures=100))
+
+
+@blueprint.route("/api/imports/<int:run_id>/resume", methods=["POST"])
+def api_resume_import(run_id):
+    """
+    Resume a bulk import that stopped, trying its failed items again if
+    "retry_failed" is set in the JSON body
+    """
+
+    run = ImportRuns.query.get_or_404(run_id)
+    if running_elsewhere(run):
+        return jsonify(error="Import {} is running".format(run.id)), 409
+
+    retry_failed = bool((request.get_json(silent=True) or {}).get("retry_failed"))
+    start_import(run.id, retry_failed)
+
+    return jsonify(run_to_dict(run)), 202
+
+
+@blueprint.route("/uploads", methods=["OPTIONS", "POST"])
+def resumable_uploads():
     """
-    Retrieve a file from Filecoin via IPFS using Powergate and offer the user
-    the option to save it to their machine.
+    Describe the resumable upload protocol (OPTIONS) or start a new
+    resumable upload (POST) of Upload-Length bytes, named by the filename
+    key of Upload-Metadata
     """
 
-    # Retrieve File and FFS info using the CID
-    file = Files.query.filter_by(CID=cid).first()
-    ffs = Ffs.query.get(file.ffs_id)
+    if request.method == "OPTIONS":
+        return tus_response(204, resumable_options())
+
+    if request.headers.get("Tus-Resumable") != TUS_VERSION:
+        return tus_response(412, resumable_options())
 
     try:
-        # Retrieve data from Filecoin
-        powergate = PowerGateClient(app.config["POWERGATE_ADDRESS"])
-        data_ = powergate.ffs.get(file.CID, ffs.token)
-
-        # Save the downloaded data as a file
-        # Use the default download directory configured for the app
-        download_path = app.config["DOWNLOADDIR"]
-        if not os.path.exists(download_path):
-            os.makedirs(download_path)
-
-        with open(os.path.join(download_path, file.file_name), "wb") as out_file:
-            # Iterate over the data byte chunks and save them to an output file
-            for data in data_:
-                out_file.write(data)
-
-        # Create path to download file
-        safe_path = safe_join("../" + app.config["DOWNLOADDIR"], file.file_name)
-
-        # Update log table with download information
-        event = Logs(
-            timestamp=datetime.now().replace(microsecond=0),
-            event="Downloaded "
-            + file.file_name
-            + " (CID: "
-            + file.CID
-            + ") from Filecoin.",
+        length = int(request.headers.get("Upload-Length", ""))
+        metadata = parse_metadata(request.headers.get("Upload-Metadata"))
+        upload = create_upload(metadata.get("filename"), length)
+    except ValueError:
+        return tus_response(400, body="Upload-Length must be a number")
+    except UploadError as e:
+        return tus_response(e.status, body=str(e))
+
+    log_event(
+        "Started resumable upload of {} ({} bytes)".format(
+            upload.file_name, upload.length
         )
-        db.session.add(event)
-        db.session.commit()
+    )
 
-        # Offer the file for download to local machine
-        return send_file(safe_path, as_attachment=True)
-        """TODO: CLEAR CACHED FILES IN DOWNLOAD DIRECTORY"""
+    return tus_response(
+        201,
+        {
+            "Location": url_for(".resumable_upload", upload_id=upload.id),
+            "Upload-Expires": http_date(expires_at(upload)),
+        },
+    )
+
+
+@blueprint.route("/uploads/<upload_id>", methods=["HEAD", "PATCH", "DELETE"])
+def resumable_upload(upload_id):
+    """
+    Report how much of a resumable upload has been received (HEAD), add a
+    chunk at Upload-Offset (PATCH) or abandon the upload (DELETE)
+    """
+
+    if request.headers.get("Tus-Resumable") != TUS_VERSION:
+        return tus_response(412, resumable_options())
+
+    upload = Uploads.query.get(upload_id)
+    if upload is None:
+        return tus_response(404)
+
+    try:
+        if request.method == "HEAD":
+            headers = {
+                "Upload-Offset": str(upload_offset(upload)),
+                "Upload-Length": str(upload.length),
+                "Cache-Control": "no-store",
+            }
+            if upload.job_id is None:
+                headers["Upload-Expires"] = http_date(expires_at(upload))
+            return tus_response(200, headers)
+
+        if request.method == "DELETE":
+            delete_upload(upload)
+            return tus_response(204)
+
+        if request.mimetype != "application/offset+octet-stream":
+            return tus_response(415)
+        try:
+            offset = int(request.headers.get("Upload-Offset", ""))
+        except ValueError:
+            return tus_response(400, body="Upload-Offset must be a number")
+
+        write_chunk(
+            upload,
+            offset,
+            request.stream,
+            checksum=request.headers.get("Upload-Checksum"),
+        )
+    except UploadError as e:
+        return tus_response(e.status, body=str(e))
+
+    headers = {"Upload-Offset": str(upload.offset)}
+    if upload.job_id is not None:
+        # Complete uploads are pushed by a job that can be followed like any other
+        headers["Upload-Job"] = url_for(".api_job", job_id=upload.job_id)
+    else:
+        headers["Upload-Expires"] = http_date(expires_at(upload))
+
+    return tus_response(204, headers)
+
+
+def resumable_options():
+    headers = {
+        "Tus-Version": TUS_VERSION,
+        "Tus-Extension": TUS_EXTENSIONS,
+        "Tus-Checksum-Algorithm": ",".join(CHECKSUM_ALGORITHMS),
+    }
+    if app.config["RESUMABLE_UPLOAD_MAX_SIZE"] is not None:
+        headers["Tus-Max-Size"] = str(app.config["RESUMABLE_UPLOAD_MAX_SIZE"])
+
+    return headers
+
+
+def tus_response(status, headers=None, body=""):
+    response = Response(body, status=status, headers=headers)
+    response.headers["Tus-Resumable"] = TUS_VERSION
+
+    return response
+
+
+@blueprint.route("/api/jobs/<int:job_id>/events", methods=["GET"])
+def api_job_events(job_id):
+    """
+    Push the status changes of an upload job as server-sent events until
+    the job has either finished or failed
+    """
+
+    job = Jobs.query.get_or_404(job_id)
+
+    def events(job):
+        while True:
+            yield "data: {}\n\n".format(json.dumps(job_to_dict(job)))
+            if job.status in (DONE, FAILED):
+                return
+            job = wait_for_change(job.id, job.status)
+
+    return Response(stream_with_context(events(job)), mimetype="text/event-stream")
+
+
+@blueprint.route("/api/files", methods=["GET"])
+def api_files():
+    """
+    Return one page of the stored files for DataTables server-side processing
+    """
+
+    try:
+        draw = request.args.get("draw", 0, type=int)
+        start = max(request.args.get("start", 0, type=int), 0)
+        length = request.args.get("length", 10, type=int)
+        length = min(max(length, 1), app.config["FILES_PAGE_SIZE_MAX"])
+        sort_column = request.args.get("order_column", 2, type=int)
+        descending = request.args.get("order_dir", "desc") != "asc"
+
+        page, total, filtered, cursor = list_files(
+            length=length,
+            start=start,
+            search=request.args.get("search", "").strip(),
+            sort_column=sort_column,
+            descending=descending,
+            after=request.args.get("after"),
+        )
+    except (ValueError, TypeError):
+        # Malformed paging parameters or cursor
+        abort(400)
+
+    data = [
+        {
+            "file_name": file.file_name,
+            "file_size": file.file_size,
+            "upload_date": str(file.upload_date),
+            "CID": file.CID,
+            "ffs": str(file.Ffs),
+            "storage_status": file.storage_status,
+            "storage_error": file.storage_error,
+            "storage_updated": str(file.storage_updated)
+            if file.storage_updated
+            else None,
+            "download_url": url_for(".download", cid=file.CID),
+            "config_url": url_for(".config", ffs_id=file.Ffs.ffs_id),
+        }
+        for file in page
+    ]
+
+    return jsonify(
+        draw=draw,
+        recordsTotal=total,
+        recordsFiltered=filtered,
+        data=data,
+        next=cursor,
+    )
+
+
+@blueprint.route("/api/config_runs/<int:run_id>", methods=["GET"])
+def api_config_run(run_id):
+    """
+    Return the progress of pushing the files of a FFS with its changed
+    config, and the first files that failed
+    """
+
+    run = ConfigRuns.query.get_or_404(run_id)
+
+    return jsonify(config_run_to_dict(run, failures=100))
+
+
+@blueprint.route("/api/config_runs/<int:run_id>/resume", methods=["POST"])
+def api_resume_config_run(run_id):
+    """
+    Resume pushing the files of a config run that stopped, pushing its
+    failed files again if "retry_failed" is set in the JSON body
+    """
+
+    run = ConfigRuns.query.get_or_404(run_id)
+    if config_running_elsewhere(run):
+        return jsonify(error="Config run {} is running".format(run.id)), 409
+    if run.status == SUPERSEDED:
+        return jsonify(error="Config run {} was superseded".format(run.id)), 409
+
+    retry_failed = bool((request.get_json(silent=True) or {}).get("retry_failed"))
+    start_config_run(run.id, retry_failed)
+
+    return jsonify(config_run_to_dict(run)), 202
+
+
+@blueprint.route("/api/powergate/metrics", methods=["GET"])
+def api_powergate_metrics():
+    """
+    Report channel usage and call latency of the pooled Powergate clients
+    """
+
+    return jsonify(pools=pool_stats())
+
+
+@blueprint.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Report the request, Powergate, SQL, template and file I/O metrics of
+    this process in the Prometheus text format
+    """
+
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+@blueprint.route("/api/cache/metrics", methods=["GET"])
+def api_cache_metrics():
+    """
+    Report the size and hit, miss and eviction counters of the download cache
+    """
+
+    if not app.config["DOWNLOAD_CACHE"]:
+        return jsonify(enabled=False)
+
+    return jsonify(enabled=True, **get_cache().stats())
+
+
+@blueprint.route("/download/<cid>", methods=["GET"])
+def download(cid):
+    """
+    Retrieve a file from Filecoin via IPFS using Powergate and stream it to
+    the user as it arrives, optionally keeping a copy in the local cache.
+    """
+
+    # Retrieve File and FFS info using the CID, for every FFS storing it
+    copies = file_copies(cid)
+    if not copies:
+        abort(404)
+    file, ffs = copies[0]
+
+    # Serve cached files straight from disk, waiting for another request
+    # that is already fetching the same CID rather than fetching it twice
+    cache = get_cache() if app.config["DOWNLOAD_CACHE"] else None
+    if cache is not None:
+        cache_path = cache.get(file.CID, wait=app.config["DOWNLOAD_CACHE_WAIT"])
+        if cache_path is not None:
+            log_download(file)
+            try:
+                # send_file opens the file, which then stays readable even
+                # if it gets evicted while it is being sent. A front-end
+                # server sending it for USE_X_SENDFILE opens it later, so the
+                # cache keeps recently used files then.
+                return send_file(
+                    cache_path,
+                    as_attachment=True,
+                    attachment_filename=file.file_name,
+                    conditional=True,
+                )
+            finally:
+                cache.release(file.CID)
+
+    # Work out which bytes to send for HTTP Range requests. Requests for
+    # several ranges get the whole file, which RFC 7233 allows.
+    byte_range = None
+    if (
+        request.range is not None
+        and len(request.range.ranges) == 1
+        and file.file_size is not None
+    ):
+        byte_range = request.range.range_for_length(file.file_size)
+        if byte_range is None:
+            abort(416)
+
+    # Fill the cache from this request unless it only wants part of the file
+    cached = (
+        cache is not None
+        and byte_range is None
+        and cache.claim(file.CID, file.file_size)
+    )
+
+    # Retrieve data from Filecoin through the node of the FFS, failing over
+    # to the copies stored on other nodes
+    for file, ffs in copies:
+        try:
+            # Streamed for as long as the client reads, so a pooled client
+            # is not held for it
+            powergate = get_shared_powergate(node_of(ffs))
+            chunks = iter(powergate.ffs.get(file.CID, ffs.token))
+
+            # Wait for the first chunk so that a failed retrieval can still be
+            # reported on the files page instead of as a truncated download
+            first_chunk = next(chunks, b"")
+            break
+        except Exception as e:
+            error = e
+    else:
+        if cached:
+            cache.abandon(file.CID)
 
-    except Exception as e:
         # Output error message if download from Filecoin fails
-        flash("failed to download '{}' from Filecoin. {}".format(file.file_name, e))
+        flash(
+            "failed to download '{}' from Filecoin. {}".format(file.file_name, error)
+        )
 
         # Update log table with error
-        event = Logs(
-            timestamp=datetime.now().replace(microsecond=0),
-            event="Download ERROR: "
-            + file.file_name
-            + " CID: "
-            + file.CID
-            + " "
-            + str(e),
+        log_event(
+            "Download ERROR: " + file.file_name + " CID: " + file.CID + " " + str(error)
         )
-        db.session.add(event)
-        db.session.commit()
 
-        stored_files = Files.query.all()
+        return render_template("files.html", upload_form=UploadForm())
+
+    log_download(file)
+
+    data = timed_chunks("download", itertools.chain([first_chunk], chunks))
+
+    if byte_range is not None:
+        # Powergate only returns whole files, so skip to the requested range
+        data = slice_chunks(data, *byte_range)
+    elif cached:
+        data = cache.fill(file.CID, data)
+
+    response = Response(
+        stream_with_context(data), mimetype="application/octet-stream"
+    )
+    if cached:
+        # Wake up waiting requests even if the stream is never consumed
+        response.call_on_close(lambda: cache.abandon(file.CID))
+    response.headers.set("Content-Disposition", "attachment", filename=file.file_name)
+    response.headers["ETag"] = '"{}"'.format(file.CID)
+
+    if file.file_size is not None:
+        response.headers["Accept-Ranges"] = "bytes"
+        if byte_range is not None:
+            start, stop = byte_range
+            response.status_code = 206
+            response.headers["Content-Range"] = "bytes {}-{}/{}".format(
+                start, stop - 1, file.file_size
+            )
+            response.content_length = stop - start
+        else:
+            response.content_length = file.file_size
+
+    return response
+
 
-        return render_template("files.html", stored_files=stored_files)
+@blueprint.route("/analytics", methods=["GET"])
+def analytics():
+    """
+    Display the storage used in total and per FFS, and the uploads per day
+    """
 
+    return render_template("analytics.html", usage=usage_summary())
 
-@app.route("/wallets", methods=["GET"])
+
+@blueprint.route("/api/analytics", methods=["GET"])
+def api_analytics():
+    """
+    Report the storage used in total and per FFS, and the uploads of each of
+    the last `days` days
+    """
+
+    days = request.args.get("days", app.config["ANALYTICS_DAYS"], type=int)
+    if not 1 <= days <= 366:
+        abort(400)
+
+    return jsonify(usage_summary(days))
+
+
+@blueprint.route("/wallets", methods=["GET"])
 def wallets():
     """
     Retrieve all wallets from all FFSes and save them in a list for
-    presentation on the UI template
+    presentation on the UI template. Addresses and balances are fetched
+    concurrently and served from a short-lived cache.
     """
 
-    powergate = PowerGateClient(app.config["POWERGATE_ADDRESS"])
-
     ffses = Ffs.query.all()
-    wallets = []
-
-    for filecoin_filesystem in ffses:
-        addresses = powergate.ffs.addrs_list(filecoin_filesystem.token)
-
-        for address in addresses.addrs:
-            balance = powergate.wallet.balance(address.addr)
-            wallets.append(
-                {
-                    "ffs": filecoin_filesystem.ffs_id,
-                    "name": address.name,
-                    "address": address.addr,
-                    "type": address.type,
-                    "balance": str(balance.balance),
-                }
+    wallets, failed = list_wallets(ffses)
+
+    for filecoin_filesystem, e in failed:
+        flash(
+            "failed to list the wallets of FFS {}. {}".format(
+                filecoin_filesystem.ffs_id, e
             )
+        )
 
     return render_template("wallets.html", wallets=wallets)
 
 
-@app.route("/logs", methods=["GET"])
+@blueprint.route("/logs", methods=["GET"])
 def logs():
     """
-    Display all the log entries recorded by the application
+    Display the log entries recorded by the application
     """
 
-    logs = Logs.query.all()
+    # Write queued entries first so the page includes the latest events
+    flush_events()
 
-    return render_template("logs.html", logs=logs)
+    # The entries themselves are fetched page by page from api_logs()
+    return render_template("logs.html")
+
+
+@blueprint.route("/api/logs", methods=["GET"])
+def api_logs():
+    """
+    Return one page of log entries for DataTables server-side processing,
+    optionally within a time range (`since`, `until`) and matching keywords
+    """
+
+    try:
+        draw = request.args.get("draw", 0, type=int)
+        start = max(request.args.get("start", 0, type=int), 0)
+        length = request.args.get("length", 10, type=int)
+        length = min(max(length, 1), app.config["FILES_PAGE_SIZE_MAX"])
+        since = request.args.get("since") or None
+        until = request.args.get("until") or None
+
+        page, total, filtered, cursor = list_logs(
+            length=length,
+            start=start,
+            search=request.args.get("search", "").strip(),
+            since=datetime.fromisoformat(since) if since else None,
+            until=datetime.fromisoformat(until) if until else None,
+            descending=request.args.get("order_dir", "desc") != "asc",
+            after=request.args.get("after"),
+        )
+    except (ValueError, TypeError):
+        # Malformed paging parameters, time range or cursor
+        abort(400)
+
+    data = [{"timestamp": str(log.timestamp), "event": log.event} for log in page]
+
+    return jsonify(
+        draw=draw,
+        recordsTotal=total,
+        recordsFiltered=filtered,
+        data=data,
+        next=cursor,
+    )
 
 
-@app.route("/config", methods=["GET"])
-@app.route("/config/<ffs_id>", methods=["GET"])
+@blueprint.route("/config", methods=["GET"])
+@blueprint.route("/config/<ffs_id>", methods=["GET"])
 def config(ffs_id=None):
     """
     Create and edit FFS config settings
     """
     NewFFSForm = NewFfsForm()
 
-    powergate = PowerGateClient(app.config["POWERGATE_ADDRESS"])
-
     if ffs_id == None:
         active_ffs = Ffs.query.filter_by(default=True).first()
     else:
@@ -223,120 +816,12 @@ def config(ffs_id=None):
     if active_ffs == None:
         active_ffs = create_ffs(default=True)
 
-    default_config = powergate.ffs.default_config(active_ffs.token)
-
-    """TODO: Move MessageToDict helper to pygate-grpc client and return dict"""
-    msg_dict = MessageToDict(default_config)
-
-    # populate form values from config dictionary
-    try:
-        hot_enabled = msg_dict["defaultStorageConfig"]["hot"]["enabled"]
-    except KeyError:
-        hot_enabled = False
-    try:
-        allow_unfreeze = msg_dict["defaultStorageConfig"]["hot"]["allowUnfreeze"]
-    except KeyError:
-        allow_unfreeze = False
-    try:
-        add_timeout = msg_dict["defaultStorageConfig"]["hot"]["ipfs"]["addTimeout"]
-    except KeyError:
-        add_timeout = 0
-    try:
-        cold_enabled = msg_dict["defaultStorageConfig"]["cold"]["enabled"]
-    except KeyError:
-        cold_enabled = False
-    try:
-        rep_factor = msg_dict["defaultStorageConfig"]["cold"]["filecoin"]["repFactor"]
-    except KeyError:
-        rep_factor = 0
-    try:
-        deal_min_duration = msg_dict["defaultStorageConfig"]["cold"]["filecoin"][
-            "dealMinDuration"
-        ]
-    except KeyError:
-        deal_min_duration = 0
-    try:
-        excluded_miners_list = msg_dict["defaultStorageConfig"]["cold"]["filecoin"][
-            "excludedMiners"
-        ]
-        # Break out list into comma separate values
-        excluded_miners = ""
-        for miner in excluded_miners_list:
-            excluded_miners += miner
-            # Don't add a comma if this is only or last item in list
-            if (len(excluded_miners_list)) > 1:
-                if (excluded_miners_list.index(miner) + 1) != len(excluded_miners_list):
-                    excluded_miners += ","
-    except KeyError:
-        excluded_miners = None
-    try:
-        trusted_miners_list = msg_dict["defaultStorageConfig"]["cold"]["filecoin"][
-            "trustedMiners"
-        ]
-        # Break out list into comma separate values
-        trusted_miners = ""
-        for miner in trusted_miners_list:
-            trusted_miners += miner
-            # Don't add a comma if this is only or last item in list
-            if (len(trusted_miners_list)) > 1:
-                if (trusted_miners_list.index(miner) + 1) != len(trusted_miners_list):
-                    trusted_miners += ","
-    except KeyError:
-        trusted_miners = None
-    try:
-        country_codes_list = msg_dict["defaultStorageConfig"]["cold"]["filecoin"][
-            "countryCodes"
-        ]
-        # Break out list into comma separate values
-        country_codes = ""
-        for country in country_codes_list:
-            country_codes += country
-            # Don't add a comma if this is only or last item in list
-            if (len(country_codes_list)) > 1:
-                if (country_codes_list.index(country) + 1) != len(country_codes_list):
-                    country_codes += ","
-    except KeyError:
-        country_codes = None
-    try:
-        renew_enabled = msg_dict["defaultStorageConfig"]["cold"]["filecoin"]["renew"][
-            "enabled"
-        ]
-    except KeyError:
-        renew_enabled = False
-    try:
-        renew_threshold = msg_dict["defaultStorageConfig"]["cold"]["filecoin"]["renew"][
-            "threshold"
-        ]
-    except KeyError:
-        renew_threshold = 0
-
-    wallet_address = msg_dict["defaultStorageConfig"]["cold"]["filecoin"]["addr"]
-
-    try:
-        max_price = msg_dict["defaultStorageConfig"]["cold"]["filecoin"]["maxPrice"]
-    except KeyError:
-        max_price = 0
-    try:
-        repairable = msg_dict["defaultStorageConfig"]["repairable"]
-    except KeyError:
-        repairable = True
+    default_config = get_default_config(active_ffs)
 
     # Instantiate config form
     ConfigForm = FfsConfigForm()
     ConfigForm.make_default.data = active_ffs.default
-    ConfigForm.hot_enabled.data = hot_enabled
-    ConfigForm.allow_unfreeze.data = allow_unfreeze
-    ConfigForm.add_timeout.data = add_timeout
-    ConfigForm.cold_enabled.data = cold_enabled
-    ConfigForm.rep_factor.data = rep_factor
-    ConfigForm.deal_min_duration.data = deal_min_duration
-    ConfigForm.excluded_miners.data = excluded_miners
-    ConfigForm.trusted_miners.data = trusted_miners
-    ConfigForm.country_codes.data = country_codes
-    ConfigForm.renew_enabled.data = renew_enabled
-    ConfigForm.renew_threshold.data = renew_threshold
-    ConfigForm.max_price.data = max_price
-    ConfigForm.repairable.data = repairable
+    default_config.fill_form(ConfigForm)
 
     all_ffses = Ffs.query.order_by((Ffs.default).desc()).all()
 
@@ -344,13 +829,13 @@ def config(ffs_id=None):
         "config.html",
         NewFfsForm=NewFFSForm,
         FfsConfigForm=ConfigForm,
-        wallet_address=wallet_address,
+        wallet_address=default_config.cold.addr,
         active_ffs=active_ffs,
         all_ffses=all_ffses,
     )
 
 
-@app.route("/new_ffs", methods=["POST"])
+@blueprint.route("/new_ffs", methods=["POST"])
 def new_ffs():
     """
     Create a new Filecoin Filesystem (FFS), including a default wallet and config
@@ -359,10 +844,10 @@ def new_ffs():
 
     new_ffs = create_ffs(default=form.default.data)
 
-    return redirect(url_for("config", ffs_id=new_ffs.ffs_id))
+    return redirect(url_for(".config", ffs_id=new_ffs.ffs_id))
 
 
-@app.route("/change_config/<ffs_id>/<wallet>", methods=["POST"])
+@blueprint.route("/change_config/<ffs_id>/<wallet>", methods=["POST"])
 def change_config(ffs_id, wallet):
     """
     Change the default configuration for a FFS, triggering a change to all files
@@ -381,52 +866,27 @@ def change_config(ffs_id, wallet):
         ffs.default = True
         db.session.commit()
 
-    exlcude_miners = []
-    trust_miners = []
-    countries = []
-    exclude_miners = form.excluded_miners.data.split(",")
-    trust_miners = form.trusted_miners.data.split(",")
-    countries = form.country_codes.data.split(",")
-
-    new_config = {
-        "hot": {
-            "enabled": form.hot_enabled.data,
-            "allowUnfreeze": form.allow_unfreeze.data,
-            "ipfs": {"addTimeout": form.add_timeout.data},
-        },
-        "cold": {
-            "enabled": form.cold_enabled.data,
-            "filecoin": {
-                "repFactor": form.rep_factor.data,
-                "dealMinDuration": form.deal_min_duration.data,
-                "excludedMiners": exclude_miners,
-                "trustedMiners": trust_miners,
-                "countryCodes": countries,
-                "renew": {
-                    "enabled": form.renew_enabled.data,
-                    "threshold": form.renew_threshold.data,
-                },
-                "addr": wallet,
-                "maxPrice": form.max_price.data,
-            },
-        },
-        "repairable": True,
-    }
-
-    new_config_json = json.dumps(new_config)
+    new_config = StorageConfig.from_form(form, wallet)
 
-    powergate = PowerGateClient(app.config["POWERGATE_ADDRESS"])
     try:
-        powergate.ffs.set_default_config(new_config_json, ffs.token)
+        set_default_config(ffs, new_config)
         event = "Changed default configuration for FFS " + ffs.ffs_id
+
+        # Push the files already stored with the new config in the background
+        run = create_config_run(ffs, new_config.to_json())
+        if run.total:
+            start_config_run(run.id)
+            flash(
+                "pushing {} files with the new configuration (run {})".format(
+                    run.total, run.id
+                )
+            )
     except Exception as e:
         # Output error message if download from Filecoin fails
         flash("failed to change configuration. {}".format(e))
         event = str(e)
 
     # Log the configuration change or error
-    event = Logs(timestamp=datetime.now().replace(microsecond=0), event=event,)
-    db.session.add(event)
-    db.session.commit()
+    log_event(event)
 
-    return redirect(url_for("config", ffs_id=ffs_id))
+    return redirect(url_for(".config", ffs_id=ffs_id))
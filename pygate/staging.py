@@ -0,0 +1,183 @@
+"""
+Stage files in the hot set of a FFS straight from memory-mapped uploads,
+sending each chunk with a single copy and sizing the chunks from the
+throughput they reach
+"""
+
+import mmap
+import threading
+import time
+from functools import lru_cache
+from pygate import app
+
+# Chunk size the last staging in this process settled on, which the next
+# one starts from
+_learned_size = None
+_learned_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def stage_method():
+    """
+    Look up the staging call of the Powergate client on first use, returning
+    its path, its reply type and the protocol buffers key of the chunk field
+    of its requests. The call was named AddToHot before Powergate renamed it
+    to Stage.
+    """
+
+    from pygate_grpc import ffs as ffs_client
+
+    service = ffs_client.ffs_rpc_pb2.DESCRIPTOR.services_by_name["RPCService"]
+    method = service.methods_by_name.get("Stage") or service.methods_by_name["AddToHot"]
+    chunk_key = bytes([method.input_type.fields_by_name["chunk"].number << 3 | 2])
+
+    return (
+        "/{}/{}".format(service.full_name, method.name),
+        getattr(ffs_client.ffs_rpc_pb2, method.output_type.name),
+        chunk_key,
+    )
+
+
+def encode_chunk(chunk):
+    """
+    Serialize a staging request for a chunk of bytes or a memoryview,
+    copying the chunk once into the message instead of into a bytes object
+    and then into the message
+    """
+
+    length = len(chunk)
+    header = bytearray(stage_method()[2])
+    while length > 0x7F:
+        header.append(length & 0x7F | 0x80)
+        length >>= 7
+    header.append(length)
+
+    return b"".join((header, chunk))
+
+
+def stage_chunks(powergate, chunks, token):
+    """
+    Stage a stream of chunks with a Powergate client, returning the
+    reply with the CID of the staged data
+    """
+
+    from pygate_grpc import ffs as ffs_client
+
+    path, reply, _ = stage_method()
+    stage = powergate.channel.stream_unary(
+        path, request_serializer=encode_chunk, response_deserializer=reply.FromString
+    )
+
+    return powergate.call(
+        "ffs.stage", stage, iter(chunks), metadata=((ffs_client.TOKEN_KEY, token),)
+    )
+
+
+class ChunkSizer(object):
+    """
+    Pick the size of the next chunk by hill climbing: after every window of
+    `window` seconds the size is doubled or halved, and the direction is
+    reversed whenever the throughput of the window drops
+    """
+
+    def __init__(self, size, minimum, maximum, window=0.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.size = min(max(size, minimum), maximum)
+        self.window = window
+        self._direction = 1
+        self._bytes = 0
+        self._seconds = 0.0
+        self._throughput = None
+
+    def record(self, size, seconds):
+        """
+        Account for a chunk of `size` bytes that took `seconds` to send
+        """
+
+        self._bytes += size
+        self._seconds += seconds
+        if self._seconds < self.window:
+            return
+
+        throughput = self._bytes / self._seconds
+        if self._throughput is not None and throughput < self._throughput:
+            self._direction = -self._direction
+        self._throughput = throughput
+        self._bytes = 0
+        self._seconds = 0.0
+
+        size = self.size * 2 if self._direction > 0 else self.size // 2
+        if not self.minimum <= size <= self.maximum:
+            # Turn around at the limits
+            self._direction = -self._direction
+            size = min(max(size, self.minimum), self.maximum)
+        self.size = size
+
+
+def get_sizer():
+    """
+    Return a ChunkSizer for one staging, starting from the size learned by
+    earlier ones
+    """
+
+    with _learned_lock:
+        size = _learned_size or app.config["STAGE_CHUNK_SIZE"]
+
+    return ChunkSizer(
+        size, app.config["STAGE_CHUNK_SIZE_MIN"], app.config["STAGE_CHUNK_SIZE_MAX"]
+    )
+
+
+def mapped_chunks(path, sizer=None):
+    """
+    Yield the content of a file as memoryviews of a read-only memory map, in
+    chunks sized by `sizer`. Pages that have been sent are dropped from
+    memory as the file is read, so memory use stays flat however large the
+    file is.
+    """
+
+    global _learned_size
+
+    sizer = sizer or get_sizer()
+
+    with open(path, "rb") as in_file:
+        try:
+            mapped = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            return
+
+    view = memoryview(mapped)
+    can_advise = hasattr(mapped, "madvise")
+    if can_advise:
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+
+    chunk = None
+    offset = 0
+    released = 0
+    try:
+        while offset < len(mapped):
+            size = sizer.size
+            chunk = view[offset : offset + size]
+            started = time.perf_counter()
+            yield chunk
+            sizer.record(len(chunk), time.perf_counter() - started)
+            offset += len(chunk)
+
+            # The chunk has been serialized by now; its pages can go
+            done = offset // mmap.PAGESIZE * mmap.PAGESIZE
+            if can_advise and done > released and offset < len(mapped):
+                mapped.madvise(mmap.MADV_DONTNEED, released, done - released)
+                released = done
+    finally:
+        chunk = None
+        view.release()
+        try:
+            mapped.close()
+        except BufferError:
+            # A consumer still holds a chunk; the map closes once it is freed
+            pass
+
+    with _learned_lock:
+        _learned_size = sizer.size
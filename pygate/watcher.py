@@ -0,0 +1,296 @@
+"""
+Follow the Powergate storage jobs of pushed files and store their status
+"""
+
+import threading
+import time
+from datetime import datetime
+from functools import lru_cache
+from pygate import app, db
+from pygate.models import Ffs, Files
+from pygate.eventlog import log_event
+from pygate.ffs_config import call_ffs, ffs_method
+from pygate.powergate import get_shared_powergate
+
+# Storage job states, named after the JobStatus values of Powergate
+UNSPECIFIED = "unspecified"
+QUEUED = "queued"
+EXECUTING = "executing"
+FAILED = "failed"
+CANCELED = "canceled"
+SUCCESS = "success"
+
+PENDING = (QUEUED, EXECUTING)
+
+_watcher = None
+_watcher_lock = threading.Lock()
+_wake = threading.Event()
+
+
+class JobStream(object):
+    """
+    A WatchJobs stream following a set of storage jobs of one FFS from a
+    thread of its own
+    """
+
+    def __init__(self, client, token, job_ids):
+        from pygate_grpc import ffs as ffs_client
+
+        self.job_ids = frozenset(job_ids)
+        self.failed = False
+
+        # Called over the channel, as the Powergate client only wraps
+        # WatchJobs in later releases
+        path, request_type, reply_type, _ = watch_method()
+        watch = client.channel.unary_stream(
+            path,
+            request_serializer=request_type.SerializeToString,
+            response_deserializer=reply_type.FromString,
+        )
+        self._call = watch(
+            request_type(jids=sorted(self.job_ids)),
+            metadata=((ffs_client.TOKEN_KEY, token),),
+        )
+        self._thread = threading.Thread(
+            target=self._run, name="pygate-watch-jobs", daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def cancel(self):
+        self._call.cancel()
+
+    def _run(self):
+        try:
+            for reply in self._call:
+                job = reply.job
+                with app.app_context():
+                    record_status(job.id, status_name(job), job_error(job))
+        except Exception as e:
+            if not self._call.cancelled():
+                self.failed = True
+                with app.app_context():
+                    log_event("Storage job watch ERROR: " + str(e))
+
+
+class FailedStream(object):
+    """
+    Stands in for a stream that could not be opened, so its jobs are polled
+    and watched again on the next round
+    """
+
+    failed = True
+    running = False
+
+    def __init__(self, job_ids):
+        self.job_ids = frozenset(job_ids)
+
+    def cancel(self):
+        pass
+
+
+@lru_cache(maxsize=None)
+def watch_method():
+    """
+    The call streaming the updates of storage jobs
+    """
+
+    return ffs_method("WatchJobs")
+
+
+@lru_cache(maxsize=None)
+def show_all_method():
+    """
+    The call listing the CIDs of a FFS with their last storage job
+    """
+
+    return ffs_method("ShowAll")
+
+
+def status_name(job):
+    """
+    Return the storage job state of a Powergate Job message
+    """
+
+    status = job.DESCRIPTOR.fields_by_name["status"].enum_type
+    name = status.values_by_number[job.status].name
+
+    return name.replace("JOB_STATUS_", "").lower()
+
+
+def job_error(job):
+    """
+    Describe why a storage job failed, from its cause and its deal errors
+    """
+
+    errors = [job.err_cause] if job.err_cause else []
+    errors += [
+        "{}: {}".format(deal.miner, deal.message) for deal in job.deal_errors
+    ]
+
+    return "; ".join(errors)[:255] or None
+
+
+def record_status(job_id, status, error=None):
+    """
+    Store a new state of a storage job on every file pushed by it, logging
+    the change. Returns whether the state changed.
+    """
+
+    files = Files.__table__
+    with db.engine.begin() as connection:
+        changed = connection.execute(
+            files.update()
+            .where(files.c.storage_job_id == job_id)
+            .where(files.c.storage_status != status)
+            .values(
+                storage_status=status,
+                storage_error=error,
+                storage_updated=datetime.now().replace(microsecond=0),
+            )
+        ).rowcount
+
+    if changed:
+        event = "Storage job " + job_id + " " + status
+        if error:
+            event += ": " + error
+        log_event(event)
+
+    return bool(changed)
+
+
+def pending_jobs():
+    """
+    Return the ids of the unfinished storage jobs of every FFS, keyed by the
+    Powergate node and token of the FFS
+    """
+
+    rows = (
+        db.session.query(Ffs.node, Ffs.token, Files.storage_job_id)
+        .join(Files, Files.ffs_id == Ffs.id)
+        .filter(Files.storage_status.in_(PENDING))
+        .distinct()
+        .all()
+    )
+
+    pending = {}
+    for node, token, job_id in rows:
+        key = (node or app.config["POWERGATE_ADDRESS"], token)
+        pending.setdefault(key, set()).add(job_id)
+
+    return pending
+
+
+def poll_jobs(client, token, job_ids):
+    """
+    Mark the jobs among `job_ids` that Powergate reports as applied to their
+    CID as succeeded, with one call for all the files of a FFS
+    """
+
+    method = show_all_method()
+    reply = call_ffs(client, "ffs.show_all", method, method[1](), token)
+
+    for cid_info in reply.cid_infos:
+        if cid_info.job_id in job_ids:
+            record_status(cid_info.job_id, SUCCESS)
+
+
+def wake_watcher():
+    """
+    Have the watcher pick up newly pushed files now rather than on its next
+    round
+    """
+
+    _wake.set()
+
+
+def start_watcher():
+    """
+    Follow the storage jobs of pushed files from a background thread, unless
+    STORAGE_WATCH is switched off
+    """
+
+    global _watcher
+
+    if not app.config["STORAGE_WATCH"]:
+        return
+
+    with _watcher_lock:
+        if _watcher is None:
+            _watcher = threading.Thread(
+                target=_run_watcher, name="pygate-watcher", daemon=True
+            )
+            _watcher.start()
+
+
+def _run_watcher():
+    """
+    Follow the unfinished storage jobs of every FFS over WatchJobs streams,
+    opening a stream for the jobs added since the last round and closing
+    those whose jobs have all finished. The jobs of a stream that failed are
+    polled, then watched again, until a new stream can be opened.
+    """
+
+    streams = {}
+
+    while True:
+        with app.app_context():
+            try:
+                pending = pending_jobs()
+            except Exception as e:
+                log_event("Storage job watch ERROR: " + str(e))
+                pending = {}
+
+            for key in set(streams) - set(pending):
+                for stream in streams.pop(key):
+                    stream.cancel()
+
+            for key, job_ids in pending.items():
+                streams[key] = _watch(key, job_ids, streams.get(key, []))
+
+        _wake.wait(app.config["STORAGE_WATCH_INTERVAL"])
+        _wake.clear()
+        # Let pushes that finish together be picked up in one round
+        time.sleep(1)
+
+
+def _watch(key, job_ids, streams):
+    """
+    Bring the streams of a FFS up to date with its unfinished storage jobs,
+    returning the streams to keep
+    """
+
+    node, token = key
+    kept = []
+    missed = set()
+    for stream in streams:
+        if not stream.job_ids & job_ids:
+            # Every job it follows has finished
+            stream.cancel()
+        elif stream.running:
+            kept.append(stream)
+        elif stream.failed:
+            missed |= stream.job_ids & job_ids
+
+    watched = set()
+    for stream in kept:
+        watched |= stream.job_ids
+    new_ids = job_ids - watched
+    if not new_ids:
+        return kept
+
+    try:
+        client = get_shared_powergate(node)
+        if missed:
+            # Catch up on what the broken streams missed
+            poll_jobs(client, token, missed)
+        kept.append(JobStream(client, token, new_ids))
+    except Exception as e:
+        # Marked failed, so the jobs are polled on the next round
+        kept.append(FailedStream(new_ids))
+        log_event("Storage job watch ERROR: " + str(e))
+
+    return kept
@@ -0,0 +1,83 @@
+"""
+Elect one process of a multi-process deployment to run the background work
+that must only run once, such as resuming interrupted jobs
+"""
+
+import os
+import socket
+from pygate import app
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, where every process is primary
+    fcntl = None
+
+_lock_file = None
+
+
+def is_primary_worker():
+    """
+    Return whether this process holds the worker lock, taking it if no other
+    process does. The lock is held until the process exits, after which the
+    next process to ask takes over.
+    """
+
+    global _lock_file
+
+    if _lock_file is not None or fcntl is None:
+        return True
+
+    lock_file = open(app.config["WORKER_LOCK_FILE"], "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+
+    _lock_file = lock_file
+
+    return True
+
+
+def worker_id():
+    """
+    Identify this process among the workers of a deployment, as
+    "host:pid:start time"
+    """
+
+    pid = os.getpid()
+
+    return "{}:{}:{}".format(socket.gethostname(), pid, _start_time(pid))
+
+
+def worker_alive(worker):
+    """
+    Return whether the process identified by `worker_id` may still be
+    running. Processes on other hosts are assumed to be.
+    """
+
+    host, pid, started = (worker.rsplit(":", 2) + ["", ""])[:3]
+    if host != socket.gethostname():
+        return True
+
+    try:
+        pid = int(pid)
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        return True
+
+    # The pid may have been reused since, for instance by a restarted
+    # container whose processes start in the same order
+    return _start_time(pid) == started
+
+
+def _start_time(pid):
+    # Clock ticks between boot and the start of the process, where /proc
+    # tells (see proc(5)); the command name may contain spaces
+    try:
+        with open("/proc/{}/stat".format(pid)) as stat:
+            return stat.read().rpartition(")")[2].split()[19]
+    except (OSError, IndexError):
+        return ""
@@ -2,7 +2,9 @@
 Provide launch script for the Pygate application
 """
 
-from pygate import app
+from pygate import create_app
+
+app = create_app()
 
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0")
@@ -0,0 +1,107 @@
+"""
+Run the application against an in-process fake Powergate and a SQLite
+database in a temporary directory. Run from the repository root:
+
+    python -m pytest
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import pytest
+
+pytest.importorskip("pygate_grpc")
+
+from benchmarks.fake_powergate import FakePowergate  # noqa: E402
+
+WORKDIR = tempfile.mkdtemp(prefix="pygate-tests-")
+POWERGATE = FakePowergate()
+
+# Read by config.py on import, so set before the application is made
+os.environ["POWERGATE_ADDRESS"] = POWERGATE.start()
+os.environ.pop("POWERGATE_ADDRESSES", None)
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(WORKDIR, "tests.db")
+
+
+@pytest.fixture(scope="session")
+def app():
+    from pygate import create_app
+    from pygate.database import create_database
+
+    app = create_app()
+    app.config.update(
+        TESTING=True,
+        WTF_CSRF_ENABLED=False,
+        STORAGE_WATCH=False,
+        UPLOAD_PROGRESS_INTERVAL=0,
+        UPLOADDIR=os.path.join(WORKDIR, "uploads/"),
+        DOWNLOADDIR=os.path.join(WORKDIR, "downloads/"),
+        LOG_ARCHIVE_DIR=os.path.join(WORKDIR, "logs_archive/"),
+        PROFILE_DIR=os.path.join(WORKDIR, "profiles/"),
+        WORKER_LOCK_FILE=os.path.join(WORKDIR, "pygate.lock"),
+    )
+    # Tests start the background threads they need themselves
+    app.before_first_request_funcs = []
+
+    with app.app_context():
+        create_database()
+
+    yield app
+
+    POWERGATE.stop()
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+@pytest.fixture
+def powergate():
+    return POWERGATE
+
+
+@pytest.fixture
+def context(app):
+    """
+    An application context over an empty database
+    """
+
+    from pygate import db
+    from pygate import ffs_config
+    from pygate.eventlog import flush
+
+    with app.app_context():
+        yield app
+
+        flush()
+        db.session.remove()
+        # The log search index is emptied by the triggers of the logs table
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.commit()
+        ffs_config._configs.clear()
+
+
+@pytest.fixture
+def client(context):
+    return context.test_client()
+
+
+@pytest.fixture
+def wait_until(context):
+    """
+    Poll `predicate` until it returns a true value, failing the test after
+    `timeout` seconds. Rows are read again on every poll.
+    """
+
+    from pygate import db
+
+    def wait(predicate, timeout=10):
+        deadline = time.monotonic() + timeout
+        while True:
+            db.session.expire_all()
+            value = predicate()
+            if value:
+                return value
+            assert time.monotonic() < deadline, "timed out waiting"
+            time.sleep(0.02)
+
+    return wait
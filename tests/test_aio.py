@@ -0,0 +1,281 @@
+import asyncio
+import base64
+from datetime import datetime
+from urllib.parse import urlsplit
+import pytest
+
+pytest.importorskip("asgiref")
+
+from pygate import db, jobs  # noqa: E402
+from benchmarks.fake_powergate import CHUNK_SIZE  # noqa: E402
+from pygate.aio import AsyncApplication  # noqa: E402
+from pygate.helpers import get_default_ffs  # noqa: E402
+from pygate.models import Files, Jobs, Uploads  # noqa: E402
+
+TUS = [(b"tus-resumable", b"1.0.0")]
+
+
+def request_scope(path, method="GET", headers=()):
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": list(headers),
+        "server": ("localhost", 80),
+    }
+
+
+def asgi_request(application, method, path, headers=(), chunks=(b"",)):
+    """
+    Send a request through the ASGI application, returning its status,
+    headers and body
+    """
+
+    async def request():
+        messages = [
+            {"type": "http.request", "body": chunk, "more_body": True}
+            for chunk in chunks
+        ]
+        messages[-1]["more_body"] = False
+        sent = []
+        finished = asyncio.Event()
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            # The client stays until the whole response has been sent
+            await finished.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+            if message["type"] == "http.response.body" and not message.get(
+                "more_body"
+            ):
+                finished.set()
+
+        try:
+            await application(request_scope(path, method, headers), receive, send)
+        finally:
+            # The channels belong to the event loop of this request
+            for powergate in application.powergates.values():
+                await powergate.close()
+            application.powergates.clear()
+
+        return sent
+
+    sent = asyncio.run(request())
+    start = sent[0]
+    body = b"".join(message.get("body", b"") for message in sent[1:])
+
+    return (
+        start["status"],
+        {k.decode(): v.decode() for k, v in start["headers"]},
+        body,
+    )
+
+
+@pytest.fixture
+def application(context):
+    return AsyncApplication(context)
+
+
+def start_upload(application, length):
+    name = base64.b64encode(b"resumable.txt")
+    status, headers, _ = asgi_request(
+        application,
+        "POST",
+        "/uploads",
+        TUS
+        + [
+            (b"upload-length", str(length).encode()),
+            (b"upload-metadata", b"filename " + name),
+        ],
+    )
+    assert status == 201
+
+    return urlsplit(headers["location"]).path
+
+
+def send_chunk(application, location, offset, chunks):
+    return asgi_request(
+        application,
+        "PATCH",
+        location,
+        TUS
+        + [
+            (b"content-type", b"application/offset+octet-stream"),
+            (b"upload-offset", str(offset).encode()),
+        ],
+        chunks,
+    )
+
+
+def test_completed_upload_is_pushed_by_a_job(application, wait_until):
+    location = start_upload(application, 10)
+
+    status, headers, _ = send_chunk(application, location, 0, [b"01234"])
+    assert status == 204
+    assert headers["upload-offset"] == "5"
+    assert "upload-job" not in headers
+
+    status, headers, _ = send_chunk(application, location, 5, [b"567", b"89"])
+    assert status == 204
+    assert headers["upload-offset"] == "10"
+    job_id = Uploads.query.get(location.rsplit("/", 1)[1]).job_id
+    assert headers["upload-job"] == "/api/jobs/{}".format(job_id)
+    wait_until(lambda: Jobs.query.get(job_id).status == jobs.DONE)
+
+
+def test_chunk_at_the_wrong_offset_is_refused(application):
+    location = start_upload(application, 10)
+
+    status, headers, _ = send_chunk(application, location, 3, [b"34"])
+
+    assert status == 409
+    status, headers, _ = send_chunk(application, location, 0, [b"01"])
+    assert (status, headers["upload-offset"]) == (204, "2")
+
+
+SIZE = 300 * 1024
+
+
+@pytest.fixture
+def stored(context, powergate):
+    powergate.add_file("bafkasgi", SIZE)
+    db.session.add(
+        Files(
+            file_path=None,
+            file_name="asgi.bin",
+            upload_date=datetime.now().replace(microsecond=0),
+            file_size=SIZE,
+            CID="bafkasgi",
+            ffs_id=get_default_ffs().id,
+        )
+    )
+    db.session.commit()
+
+    return "/download/bafkasgi"
+
+
+@pytest.fixture
+def native(application, monkeypatch):
+    """
+    The ASGI application, failing requests that would be left to Flask
+    """
+
+    async def left_to_flask(scope, receive, send):
+        raise AssertionError("{} was left to Flask".format(scope["path"]))
+
+    monkeypatch.setattr(application, "wsgi", left_to_flask)
+
+    return application
+
+
+def test_download_is_streamed_on_the_event_loop(native, stored):
+    status, headers, body = asgi_request(native, "GET", stored)
+
+    assert status == 200
+    assert headers["content-length"] == str(SIZE)
+    assert headers["etag"] == '"bafkasgi"'
+    assert body == bytes(SIZE)
+
+
+def test_range_is_cut_from_the_stream(native, stored):
+    status, headers, body = asgi_request(
+        native, "GET", stored, [(b"range", b"bytes=-10")]
+    )
+
+    assert status == 206
+    assert headers["content-range"] == "bytes {}-{}/{}".format(
+        SIZE - 10, SIZE - 1, SIZE
+    )
+    assert len(body) == 10
+
+
+def test_several_ranges_get_the_whole_file(native, stored):
+    status, headers, body = asgi_request(
+        native, "GET", stored, [(b"range", b"bytes=0-1,5-6")]
+    )
+
+    assert status == 200
+    assert headers["content-length"] == str(SIZE)
+    assert len(body) == SIZE
+
+
+def test_download_stops_when_the_client_goes_away(native, powergate, context):
+    chunks = 64
+    powergate.add_file("bafklarge", chunks * CHUNK_SIZE)
+    db.session.add(
+        Files(
+            file_path=None,
+            file_name="large.bin",
+            upload_date=datetime.now().replace(microsecond=0),
+            file_size=chunks * CHUNK_SIZE,
+            CID="bafklarge",
+            ffs_id=get_default_ffs().id,
+        )
+    )
+    db.session.commit()
+
+    async def request():
+        sent = []
+        gone = asyncio.Event()
+
+        async def receive():
+            if not sent:
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await gone.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            # The server keeps taking the body after the client went away
+            sent.append(message)
+            if message["type"] == "http.response.body":
+                gone.set()
+
+        try:
+            await native(request_scope("/download/bafklarge"), receive, send)
+        finally:
+            for powergate in native.powergates.values():
+                await powergate.close()
+            native.powergates.clear()
+
+        return sent
+
+    sent = asyncio.run(request())
+
+    assert sent[0]["status"] == 200
+    assert len(sent) < chunks // 2
+    assert sent[-1].get("more_body")
+
+
+def test_unknown_cid_is_left_to_flask(application):
+    status, _, _ = asgi_request(application, "GET", "/download/bafkunknown")
+
+    assert status == 404
+
+
+def test_failed_retrieval_is_left_to_flask(application):
+    db.session.add(
+        Files(
+            file_path=None,
+            file_name="lost.bin",
+            upload_date=datetime.now().replace(microsecond=0),
+            file_size=1,
+            CID="bafklost",
+            ffs_id=get_default_ffs().id,
+        )
+    )
+    db.session.commit()
+
+    status, _, body = asgi_request(application, "GET", "/download/bafklost")
+
+    assert status == 200
+    assert b"failed to download" in body
@@ -0,0 +1,100 @@
+from datetime import date, datetime, timedelta
+import pytest
+from pygate import db
+from pygate.analytics import GIB, rebuild_usage, usage_summary
+from pygate.helpers import get_default_ffs, record_uploads
+from pygate.models import DailyUsage, FfsUsage, Files
+
+
+def new_file(name, size, upload_date=None):
+    return Files(
+        file_path=None,
+        file_name=name,
+        upload_date=upload_date,
+        file_size=size,
+        CID="bafk" + name,
+        ffs_id=get_default_ffs().id,
+    )
+
+
+def test_recorded_uploads_add_to_the_totals(context):
+    record_uploads([(new_file("first", 100), None), (new_file("second", 20), None)])
+    record_uploads([(new_file("third", 3), None)])
+
+    usage = usage_summary(7)
+
+    assert usage["files"] == 3
+    assert usage["bytes"] == 123
+    assert usage["ffses"][0]["ffs_id"] == get_default_ffs().ffs_id
+    assert usage["ffses"][0]["default"]
+    assert len(usage["daily"]) == 7
+    assert usage["daily"][-1] == {"day": str(date.today()), "files": 3, "bytes": 123}
+    assert usage["bytes_per_day"] == 123 / 7
+    assert usage["estimated_cost"] is None
+
+
+def test_rebuild_counts_the_files_table(context):
+    today = datetime.now().replace(microsecond=0)
+    db.session.add_all(
+        [
+            new_file("today", 10, today),
+            new_file("yesterday", 5, today - timedelta(days=1)),
+            new_file("last-year", 1, today - timedelta(days=400)),
+        ]
+    )
+    db.session.commit()
+
+    assert rebuild_usage() == 3
+    assert rebuild_usage() == 3
+
+    assert FfsUsage.query.one().bytes == 16
+    assert DailyUsage.query.count() == 3
+    usage = usage_summary(2)
+    assert usage["files"] == 3
+    assert [row["files"] for row in usage["daily"]] == [1, 1]
+
+
+def test_rebuild_command(app, context):
+    record_uploads([(new_file("first", 100), None)])
+    FfsUsage.query.delete()
+    db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=["rebuild-usage"])
+
+    assert result.output == "Counted 1 files\n"
+    assert FfsUsage.query.one().files == 1
+
+
+def test_cost_is_estimated_at_the_configured_price(context, monkeypatch):
+    monkeypatch.setitem(context.config, "STORAGE_PRICE_PER_GIB_MONTH", 0.5)
+    record_uploads([(new_file("large", 4 * GIB), None)])
+
+    usage = usage_summary()
+
+    assert usage["estimated_cost"] == 2
+    assert usage["ffses"][0]["estimated_cost"] == 2
+    assert usage["days"] == context.config["ANALYTICS_DAYS"]
+
+
+def test_api_reports_the_requested_days(client):
+    record_uploads([(new_file("first", 100), None)])
+
+    response = client.get("/api/analytics?days=3")
+
+    assert response.status_code == 200
+    assert response.json["files"] == 1
+    assert [row["files"] for row in response.json["daily"]] == [0, 0, 1]
+
+
+@pytest.mark.parametrize("days", ["0", "367", "-1"])
+def test_api_refuses_days_out_of_range(client, days):
+    assert client.get("/api/analytics?days=" + days).status_code == 400
+
+
+def test_analytics_page(client):
+    record_uploads([(new_file("first", 100), None)])
+
+    response = client.get("/analytics")
+
+    assert response.status_code == 200
+    assert get_default_ffs().ffs_id.encode() in response.data
@@ -0,0 +1,74 @@
+import time
+import pytest
+from pygate import balances
+from pygate.balances import list_wallets
+from pygate.helpers import get_default_ffs
+from pygate.powergate import get_pool
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(balances, "_entries", {})
+    monkeypatch.setattr(balances, "_inflight", {})
+
+
+def balance_calls():
+    calls = get_pool().stats()["calls"]
+
+    return calls.get("wallet.balance", {}).get("calls", 0)
+
+
+def test_wallets_are_listed_with_their_balance(context, powergate):
+    ffs = get_default_ffs()
+
+    wallets, failed = list_wallets([ffs])
+
+    assert failed == []
+    assert [wallet["address"] for wallet in wallets] == [powergate.wallet(ffs.token)]
+    assert wallets[0]["balance"] == "4000000000"
+    assert wallets[0]["refreshed"] is not None
+
+
+def test_cached_balance_is_served_until_it_expires(context):
+    ffs = get_default_ffs()
+    list_wallets([ffs])
+    before = balance_calls()
+
+    list_wallets([ffs])
+    assert balance_calls() == before
+
+    for key, (value, refreshed, _) in list(balances._entries.items()):
+        balances._entries[key] = (value, refreshed, time.monotonic())
+    wallets, _ = list_wallets([ffs])
+
+    # The expired balance is served while it is refreshed in the background
+    assert wallets[0]["balance"] == "4000000000"
+    deadline = time.monotonic() + 5
+    while balance_calls() == before and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert balance_calls() == before + 1
+
+
+def test_ffs_whose_wallets_cannot_be_listed_is_reported(context, monkeypatch):
+    ffs = get_default_ffs()
+
+    def refuse(node, token):
+        raise RuntimeError("unreachable")
+
+    monkeypatch.setattr(balances, "_fetch_addresses", refuse)
+    wallets, failed = list_wallets([ffs])
+
+    assert wallets == []
+    assert [(failed_ffs.id, str(e)) for failed_ffs, e in failed] == [
+        (ffs.id, "unreachable")
+    ]
+
+
+def test_wallets_page_shows_the_balances(client, powergate):
+    address = powergate.wallet(get_default_ffs().token)
+
+    response = client.get("/wallets")
+
+    assert response.status_code == 200
+    assert address.encode() in response.data
+    assert b"4000000000" in response.data
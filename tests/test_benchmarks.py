@@ -0,0 +1,47 @@
+from benchmarks.run import compare, failures
+
+
+def result(errors=0, p99_ms=10.0, requests_per_second=100.0):
+    return {
+        "rows": 1000,
+        "route": "files",
+        "file_size": None,
+        "requests": 200,
+        "errors": errors,
+        "requests_per_second": requests_per_second,
+        "p50_ms": 5.0,
+        "p99_ms": p99_ms,
+    }
+
+
+def test_same_timings_pass():
+    assert compare([result()], [result()], 0.2) == []
+    assert failures([result()]) == []
+
+
+def test_slower_route_is_a_regression():
+    regressions = compare([result(p99_ms=20.0)], [result()], 0.2)
+
+    assert regressions == ["files (1000 rows): p99 20.00 ms, was 10.00 ms"]
+
+
+def test_failed_requests_fail_the_comparison():
+    # Failing fast must not pass for a speed-up
+    regressions = compare(
+        [result(errors=50, p99_ms=1.0, requests_per_second=1000.0)], [result()], 0.2
+    )
+
+    assert regressions == [
+        "files (1000 rows): 50 of 200 requests failed, 0 of 200 in the baseline; "
+        "timings not compared"
+    ]
+    assert failures([result(errors=50)]) == [
+        "files (1000 rows): 50 of 200 requests failed"
+    ]
+
+
+def test_baseline_with_failed_requests_is_not_compared():
+    regressions = compare([result()], [result(errors=1)], 0.2)
+
+    assert len(regressions) == 1
+    assert "1 of 200 in the baseline" in regressions[0]
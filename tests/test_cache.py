@@ -0,0 +1,107 @@
+import os
+import socket
+import pytest
+from pygate.cache import PARTIAL_SUFFIX, RetrievalCache
+from pygate.workers import worker_id
+
+
+@pytest.fixture
+def directory(tmp_path):
+    return str(tmp_path / "cache")
+
+
+def cache_file(cache, cid, size):
+    assert cache.claim(cid, size)
+    assert b"".join(cache.fill(cid, [b"x" * size])) == b"x" * size
+
+
+def test_filled_file_is_served_from_the_cache(directory):
+    cache = RetrievalCache(directory, max_bytes=100)
+
+    assert cache.get("bafkone") is None
+    cache_file(cache, "bafkone", 10)
+    path = cache.get("bafkone")
+    cache.release("bafkone")
+
+    with open(path, "rb") as cached:
+        assert cached.read() == b"x" * 10
+    assert not cache.claim("bafkone")
+    stats = cache.stats()
+    assert (stats["files"], stats["bytes"], stats["hits"]) == (1, 10, 1)
+
+
+def test_workers_share_the_cache(directory):
+    first = RetrievalCache(directory, max_bytes=100)
+    second = RetrievalCache(directory, max_bytes=100)
+
+    cache_file(first, "bafkone", 10)
+    cache_file(second, "bafktwo", 20)
+
+    assert second.get("bafkone") is not None
+    second.release("bafkone")
+    assert first.stats()["bytes"] == second.stats()["bytes"] == 30
+
+
+def test_files_pinned_by_another_worker_are_not_evicted(directory):
+    first = RetrievalCache(directory, max_bytes=25)
+    second = RetrievalCache(directory, max_bytes=25)
+    cache_file(first, "bafkone", 10)
+    cache_file(first, "bafktwo", 10)
+
+    pinned = second.get("bafkone")
+    cache_file(first, "bafkthree", 10)
+
+    assert os.path.exists(pinned)
+    assert first.get("bafktwo") is None
+    assert first.stats()["evictions"] == 1
+    second.release("bafkone")
+
+    cache_file(first, "bafkfour", 10)
+    assert second.get("bafkone") is None
+
+
+def test_partial_files_of_running_workers_are_kept(directory):
+    RetrievalCache(directory, max_bytes=100)
+    running = os.path.join(directory, "bafkone." + worker_id() + PARTIAL_SUFFIX)
+    # A process id above the kernel's limit is never running
+    gone = "{}:{}:1".format(socket.gethostname(), 2 ** 22 + 1)
+    stale = os.path.join(directory, "bafktwo." + gone + PARTIAL_SUFFIX)
+    for path in (running, stale):
+        open(path, "wb").close()
+
+    cache = RetrievalCache(directory, max_bytes=100)
+
+    assert os.path.exists(running)
+    assert not os.path.exists(stale)
+    assert cache.stats()["files"] == 0
+
+
+def test_recently_used_files_are_kept_for_the_front_end_server(directory):
+    cache = RetrievalCache(directory, max_bytes=25, min_age=60)
+    cache_file(cache, "bafkone", 10)
+    cache_file(cache, "bafktwo", 10)
+    cache_file(cache, "bafkthree", 10)
+
+    assert cache.stats()["evictions"] == 0
+
+    # Sent more than a minute ago
+    old = os.path.getmtime(cache.path("bafkone")) - 120
+    os.utime(cache.path("bafkone"), (old, old))
+    cache_file(cache, "bafkfour", 10)
+
+    assert not os.path.exists(cache.path("bafkone"))
+    assert os.path.exists(cache.path("bafktwo"))
+    assert cache.stats()["evictions"] == 1
+
+
+def test_downloads_left_in_the_directory_are_removed(directory):
+    os.makedirs(directory)
+    left = os.path.join(directory, "report.pdf")
+    with open(left, "wb") as download:
+        download.write(b"x" * 10)
+
+    cache = RetrievalCache(directory, max_bytes=100)
+
+    assert not os.path.exists(left)
+    assert cache.stats()["files"] == 0
+    assert cache.stats()["bytes"] == 0
@@ -0,0 +1,80 @@
+from sqlalchemy import create_engine, inspect, text
+from pygate import db
+from pygate.database import upgrade_tables
+
+# The tables as created by the first release
+BASELINE_SCHEMA = [
+    """
+    CREATE TABLE ffs (
+        id INTEGER NOT NULL PRIMARY KEY,
+        ffs_id VARCHAR(36),
+        token VARCHAR(36),
+        creation_date DATETIME,
+        "default" BOOLEAN
+    )
+    """,
+    "CREATE INDEX ix_ffs_ffs_id ON ffs (ffs_id)",
+    "CREATE INDEX ix_ffs_token ON ffs (token)",
+    """
+    CREATE TABLE files (
+        id INTEGER NOT NULL PRIMARY KEY,
+        file_path VARCHAR(255),
+        file_name VARCHAR(255),
+        upload_date DATETIME,
+        file_size INTEGER,
+        "CID" VARCHAR(64),
+        ffs_id INTEGER NOT NULL REFERENCES ffs (id)
+    )
+    """,
+    "CREATE INDEX ix_files_file_name ON files (file_name)",
+    'CREATE INDEX "ix_files_CID" ON files ("CID")',
+    """
+    CREATE TABLE logs (
+        id INTEGER NOT NULL PRIMARY KEY,
+        timestamp DATETIME,
+        event VARCHAR(255)
+    )
+    """,
+]
+
+
+def test_baseline_database_is_upgraded_to_the_models(tmp_path):
+    engine = create_engine("sqlite:///{}".format(tmp_path / "baseline.db"))
+    with engine.begin() as connection:
+        for statement in BASELINE_SCHEMA:
+            connection.execute(text(statement))
+        connection.execute(
+            text(
+                'INSERT INTO ffs (id, ffs_id, token, "default") '
+                "VALUES (1, 'ffs', 'token', 1)"
+            )
+        )
+        connection.execute(
+            text("INSERT INTO files (id, file_name, ffs_id) VALUES (1, 'a.txt', 1)")
+        )
+
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        added = upgrade_tables(connection)
+
+    assert "ffs.node" in added
+    assert "ffs.config_changed" in added
+    assert "files.storage_status" in added
+    assert "files.content_hash" in added
+    inspector = inspect(engine)
+    for table in db.metadata.sorted_tables:
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        assert columns == {column.name for column in table.columns}
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        assert indexes >= {index.name for index in table.indexes}
+    with engine.connect() as connection:
+        node, status = connection.execute(
+            text(
+                "SELECT ffs.node, files.storage_status FROM files "
+                "JOIN ffs ON ffs.id = files.ffs_id"
+            )
+        ).first()
+    assert (node, status) == (None, None)
+
+    with engine.begin() as connection:
+        assert upgrade_tables(connection) == []
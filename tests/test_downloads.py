@@ -0,0 +1,141 @@
+from datetime import datetime
+import pytest
+from pygate import db
+from pygate import cache as cache_module
+from pygate.cache import RetrievalCache
+from pygate.eventlog import flush
+from pygate.helpers import get_default_ffs
+from pygate.models import Files, Logs
+
+SIZE = 300 * 1024
+
+
+@pytest.fixture
+def stored(context, powergate):
+    """
+    A file stored in the default FFS that Powergate can retrieve
+    """
+
+    powergate.add_file("bafkdownload", SIZE)
+    db.session.add(
+        Files(
+            file_path=None,
+            file_name="download.bin",
+            upload_date=datetime.now().replace(microsecond=0),
+            file_size=SIZE,
+            CID="bafkdownload",
+            ffs_id=get_default_ffs().id,
+        )
+    )
+    db.session.commit()
+
+    return "/download/bafkdownload"
+
+
+def test_download_is_streamed_whole(client, stored):
+    response = client.get(stored)
+
+    assert response.status_code == 200
+    assert response.headers["Content-Length"] == str(SIZE)
+    assert response.headers["ETag"] == '"bafkdownload"'
+    assert "download.bin" in response.headers["Content-Disposition"]
+    assert response.data == bytes(SIZE)
+
+
+def test_range_is_cut_from_the_stream(client, stored):
+    response = client.get(stored, headers={"Range": "bytes=100000-100009"})
+
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 100000-100009/{}".format(SIZE)
+    assert len(response.data) == 10
+
+
+def test_unsatisfiable_range_is_refused(client, stored):
+    response = client.get(stored, headers={"Range": "bytes={}-".format(SIZE)})
+
+    assert response.status_code == 416
+
+
+def test_several_ranges_get_the_whole_file(client, stored):
+    response = client.get(stored, headers={"Range": "bytes=0-1,5-6"})
+
+    assert response.status_code == 200
+    assert response.headers["Content-Length"] == str(SIZE)
+    assert len(response.data) == SIZE
+
+
+def test_unknown_cid_is_not_found(client):
+    assert client.get("/download/bafkunknown").status_code == 404
+
+
+def test_failed_retrieval_is_reported_on_the_files_page(client, context):
+    db.session.add(
+        Files(
+            file_path=None,
+            file_name="lost.bin",
+            upload_date=datetime.now().replace(microsecond=0),
+            file_size=1,
+            CID="bafklost",
+            ffs_id=get_default_ffs().id,
+        )
+    )
+    db.session.commit()
+
+    response = client.get("/download/bafklost")
+
+    assert response.status_code == 200
+    assert b"failed to download" in response.data
+    flush()
+    assert Logs.query.filter(Logs.event.like("Download ERROR: lost.bin%")).count()
+
+
+@pytest.fixture
+def cache(client, tmp_path, monkeypatch):
+    """
+    Downloads cached in a cache of their own
+    """
+
+    cache = RetrievalCache(str(tmp_path / "downloads"), max_bytes=10 * SIZE)
+    monkeypatch.setattr(cache_module, "_cache", cache)
+    monkeypatch.setitem(client.application.config, "DOWNLOAD_CACHE", True)
+
+    return cache
+
+
+def test_second_download_is_served_from_the_cache(client, stored, cache):
+    first = client.get(stored)
+    assert first.data == bytes(SIZE)
+    second = client.get(stored)
+
+    assert second.status_code == 200
+    assert second.data == bytes(SIZE)
+    stats = cache.stats()
+    assert (stats["misses"], stats["hits"], stats["files"]) == (1, 1, 1)
+    assert cache.get("bafkdownload") is not None
+    cache.release("bafkdownload")
+
+
+def test_range_request_does_not_fill_the_cache(client, stored, cache):
+    response = client.get(stored, headers={"Range": "bytes=0-9"})
+
+    assert response.status_code == 206
+    assert len(response.data) == 10
+    assert cache.stats()["files"] == 0
+
+
+def test_cache_metrics_report_its_counters(client, stored, cache):
+    # The cache is filled as the first response is read
+    assert client.get(stored).data == bytes(SIZE)
+    client.get(stored)
+
+    metrics = client.get("/api/cache/metrics").json
+
+    assert metrics["enabled"]
+    assert (metrics["hits"], metrics["misses"]) == (1, 1)
+    assert metrics["bytes"] == SIZE
+
+
+def test_cache_metrics_without_a_cache(client, monkeypatch):
+    monkeypatch.setitem(client.application.config, "DOWNLOAD_CACHE", False)
+
+    assert client.get("/api/cache/metrics").json == {"enabled": False}
@@ -0,0 +1,65 @@
+import pytest
+from pygate import eventlog
+from pygate.eventlog import flush, log_event
+from pygate.models import Logs
+
+
+def logged():
+    return [entry.event for entry in Logs.query.order_by(Logs.id)]
+
+
+def test_queued_entries_are_written_in_order(context, monkeypatch):
+    monkeypatch.setitem(context.config, "LOG_BATCH_SIZE", 2)
+
+    for number in range(5):
+        log_event("event {}".format(number))
+    flush()
+
+    assert logged() == ["event {}".format(number) for number in range(5)]
+
+
+def test_long_events_are_cut_to_the_column(context):
+    log_event("x" * 1000)
+    flush()
+
+    assert logged() == ["x" * 255]
+
+
+def test_failed_write_keeps_the_entries_queued(context, monkeypatch):
+    class Unwritable(object):
+        class engine(object):
+            @staticmethod
+            def begin():
+                raise RuntimeError("database is locked")
+
+    with monkeypatch.context() as patched:
+        patched.setattr(eventlog, "db", Unwritable)
+        log_event("kept")
+        with pytest.raises(RuntimeError):
+            flush()
+        # Not while the background flusher holds a batch
+        with eventlog._writer_lock:
+            assert [entry["event"] for entry in eventlog._pending] == ["kept"]
+
+    flush()
+    assert logged() == ["kept"]
+
+
+def test_full_queue_is_written_by_the_caller(context, monkeypatch):
+    monkeypatch.setitem(context.config, "LOG_QUEUE_SIZE", 3)
+    monkeypatch.setitem(context.config, "LOG_BATCH_SIZE", 100)
+
+    for number in range(3):
+        log_event("event {}".format(number))
+
+    with eventlog._writer_lock:
+        assert len(eventlog._pending) == 0
+        assert len(logged()) == 3
+
+
+def test_logs_page_writes_the_queued_entries(client):
+    log_event("queued")
+
+    assert client.get("/logs").status_code == 200
+
+    assert logged() == ["queued"]
@@ -0,0 +1,81 @@
+from dataclasses import replace
+from datetime import datetime
+from urllib.parse import urlsplit
+from pygate import db
+from pygate.ffs_config import get_default_config, set_default_config
+from pygate.helpers import create_ffs, get_default_ffs
+from pygate.models import Ffs
+from pygate.powergate import get_pool, node_of
+
+
+def config_calls(ffs, method):
+    calls = get_pool(node_of(ffs)).stats()["calls"]
+
+    return calls.get(method, {}).get("calls", 0)
+
+
+def test_default_config_is_read_and_cached(context, powergate):
+    ffs = get_default_ffs()
+    before = config_calls(ffs, "ffs.default_config")
+
+    config = get_default_config(ffs)
+
+    assert config.hot.enabled
+    assert config.hot.add_timeout == 30
+    assert config.cold.rep_factor == 1
+    assert config.cold.addr == powergate.wallet(ffs.token)
+    assert get_default_config(ffs) is config
+    assert config_calls(ffs, "ffs.default_config") == before + 1
+
+
+def test_changed_config_is_read_again(context):
+    ffs = get_default_ffs()
+    config = get_default_config(ffs)
+    before = config_calls(ffs, "ffs.set_default_config")
+
+    set_default_config(ffs, replace(config, repairable=True))
+
+    assert config_calls(ffs, "ffs.set_default_config") == before + 1
+    assert get_default_config(ffs) is not config
+
+
+def test_config_page_shows_the_default_config(client, powergate):
+    response = client.get("/config")
+
+    assert response.status_code == 200
+    assert powergate.wallet(get_default_ffs().token).encode() in response.data
+
+
+def test_config_changed_by_another_worker_is_read_again(context):
+    ffs = get_default_ffs()
+    config = get_default_config(ffs)
+
+    # As recorded by set_default_config in another process
+    ffs.config_changed = datetime.now()
+    db.session.commit()
+
+    assert get_default_config(ffs) is not config
+    assert get_default_config(ffs) is get_default_config(ffs)
+
+
+def test_new_ffs_becomes_the_default(client, powergate):
+    first = get_default_ffs()
+
+    response = client.post("/new_ffs", data={"default": "y"})
+
+    created = Ffs.query.filter_by(default=True).one()
+    assert created.id != first.id
+    assert urlsplit(response.headers["Location"]).path == "/config/" + created.ffs_id
+
+
+def test_config_page_of_a_ffs_reads_its_config_once(client, powergate):
+    get_default_ffs()
+    other = create_ffs()
+    before = config_calls(other, "ffs.default_config")
+
+    for _ in range(2):
+        response = client.get("/config/" + other.ffs_id)
+        assert response.status_code == 200
+        assert powergate.wallet(other.token).encode() in response.data
+
+    assert config_calls(other, "ffs.default_config") == before + 1
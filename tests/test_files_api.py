@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta
+import pytest
+from pygate import db
+from pygate.helpers import get_default_ffs
+from pygate.models import Files
+
+START = datetime(2020, 10, 1, 12, 0, 0)
+
+
+@pytest.fixture
+def files(context):
+    """
+    Seven files uploaded at three moments, so that pages split rows with
+    the same upload date
+    """
+
+    ffs = get_default_ffs()
+    for number in range(7):
+        db.session.add(
+            Files(
+                file_path=None,
+                file_name="file{}.txt".format(number),
+                upload_date=START + timedelta(minutes=number // 3),
+                file_size=number,
+                CID="bafkfile{}".format(number),
+                ffs_id=ffs.id,
+            )
+        )
+    db.session.commit()
+
+    return [f.file_name for f in Files.query.order_by(Files.id)]
+
+
+def pages(client, **args):
+    """
+    Follow the cursors of /api/files from the first page to an empty one
+    """
+
+    names = []
+    after = None
+    while True:
+        query = dict(args)
+        if after is not None:
+            query["after"] = after
+        body = client.get("/api/files", query_string=query).get_json()
+        if not body["data"]:
+            assert body["next"] is None
+            return names
+        names.append([row["file_name"] for row in body["data"]])
+        after = body["next"]
+
+
+def test_cursor_pages_split_rows_of_the_same_date(client, files):
+    descending = pages(client, length=2)
+    ascending = pages(client, length=2, order_dir="asc")
+
+    assert [len(page) for page in descending] == [2, 2, 2, 1]
+    assert sum(descending, []) == list(reversed(files))
+    assert sum(ascending, []) == files
+
+
+def test_cursor_pages_by_name(client, files):
+    names = sum(pages(client, length=3, order_column=0, order_dir="asc"), [])
+
+    assert names == sorted(files)
+
+
+def test_offset_page_and_counts(client, files):
+    body = client.get(
+        "/api/files", query_string={"start": 5, "length": 10, "draw": 3}
+    ).get_json()
+
+    assert body["draw"] == 3
+    assert (body["recordsTotal"], body["recordsFiltered"]) == (7, 7)
+    assert [row["file_name"] for row in body["data"]] == files[1::-1]
+
+
+def test_search_counts_filtered_rows(client, files):
+    body = client.get("/api/files", query_string={"search": "file1"}).get_json()
+
+    assert (body["recordsTotal"], body["recordsFiltered"]) == (7, 1)
+    assert body["data"][0]["download_url"] == "/download/bafkfile1"
+
+
+def test_page_length_is_capped(client, files, monkeypatch):
+    monkeypatch.setitem(client.application.config, "FILES_PAGE_SIZE_MAX", 4)
+
+    body = client.get("/api/files", query_string={"length": 1000}).get_json()
+
+    assert len(body["data"]) == 4
+
+
+@pytest.mark.parametrize("after", ["not json", "[1]", '["not a date", 1]'])
+def test_malformed_cursor_is_refused(client, files, after):
+    response = client.get("/api/files", query_string={"after": after})
+
+    assert response.status_code == 400
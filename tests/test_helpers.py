@@ -0,0 +1,108 @@
+import hashlib
+import os
+from datetime import datetime
+import pytest
+from pygate import db
+from pygate.helpers import date_bounds, get_default_ffs, list_files, stage_upload
+from pygate.lifecycle import new_upload_directory
+from pygate.models import Files
+from pygate.watcher import FAILED, QUEUED, SUCCESS
+
+CONTENT = b"stored content"
+CONTENT_HASH = hashlib.sha256(CONTENT).hexdigest()
+
+
+def stored_copy(storage_status):
+    stored = Files(
+        file_path=None,
+        file_name="stored.txt",
+        upload_date=datetime.now().replace(microsecond=0),
+        file_size=len(CONTENT),
+        CID="bafkstored",
+        ffs_id=get_default_ffs().id,
+        content_hash=CONTENT_HASH,
+        storage_job_id="job",
+        storage_status=storage_status,
+    )
+    db.session.add(stored)
+    db.session.commit()
+
+    return stored
+
+
+def saved_upload():
+    directory = new_upload_directory()
+    with open(os.path.join(directory, "upload.txt"), "wb") as upload:
+        upload.write(CONTENT)
+
+    return directory
+
+
+def test_upload_of_stored_content_takes_its_cid(context):
+    stored = stored_copy(SUCCESS)
+
+    file_upload, duplicate = stage_upload(saved_upload(), "upload.txt", CONTENT_HASH)
+
+    assert duplicate.id == stored.id
+    assert file_upload.CID == "bafkstored"
+
+
+@pytest.mark.parametrize("storage_status", [QUEUED, FAILED, None])
+def test_upload_is_staged_unless_its_copy_was_stored(context, storage_status):
+    stored_copy(storage_status)
+
+    file_upload, duplicate = stage_upload(saved_upload(), "upload.txt", CONTENT_HASH)
+
+    assert duplicate is None
+    assert file_upload.CID != "bafkstored"
+    assert file_upload.content_hash == CONTENT_HASH
+
+
+def add_file(name, upload_date, CID=None):
+    file_upload = Files(
+        file_path=None,
+        file_name=name,
+        upload_date=upload_date,
+        file_size=1,
+        CID=CID or hashlib.sha256(name.encode()).hexdigest()[:46],
+        ffs_id=get_default_ffs().id,
+    )
+    db.session.add(file_upload)
+    db.session.commit()
+
+    return file_upload
+
+
+def searched(search):
+    page, _, _, _ = list_files(length=100, search=search)
+
+    return sorted(file_upload.file_name for file_upload in page)
+
+
+def test_search_takes_like_wildcards_literally(context):
+    now = datetime.now().replace(microsecond=0)
+    for name in ("a_b.txt", "axb.txt", "100%.txt", "1000.txt"):
+        add_file(name, now)
+
+    assert searched("a_") == ["a_b.txt"]
+    assert searched("100%") == ["100%.txt"]
+    assert searched("a") == ["a_b.txt", "axb.txt"]
+
+
+def test_search_matches_upload_date_prefixes(context):
+    add_file("september.txt", datetime(2020, 9, 30, 23, 59, 59))
+    add_file("october.txt", datetime(2020, 10, 1, 0, 0, 0))
+    add_file("later.txt", datetime(2021, 1, 1, 12, 30, 0))
+
+    assert searched("2020") == ["october.txt", "september.txt"]
+    assert searched("2020-09") == ["september.txt"]
+    assert searched("2020-10-01") == ["october.txt"]
+    assert searched("2021-01-01 12") == ["later.txt"]
+    assert searched("2021-01-01 12:30:00") == ["later.txt"]
+    assert searched("2021-01-01 12:31") == []
+
+
+def test_date_bounds_need_whole_fields():
+    assert date_bounds("2020-12") == (datetime(2020, 12, 1), datetime(2021, 1, 1))
+    assert date_bounds("2020-1") is None
+    assert date_bounds("report") is None
@@ -0,0 +1,212 @@
+import json
+import os
+from urllib.parse import urlsplit
+import pytest
+from pygate import db
+from pygate.imports import (
+    DONE,
+    FAILED,
+    RUNNING,
+    create_run,
+    import_root,
+    read_manifest,
+    run_import,
+    scan,
+    walk_directory,
+    walk_key,
+)
+from pygate.models import Files, ImportItems, ImportRuns
+
+
+@pytest.fixture
+def tree(tmp_path):
+    """
+    An import root holding a directory tree and a manifest, next to a file
+    outside of it
+    """
+
+    root = tmp_path / "root"
+    (root / "tree" / "sub").mkdir(parents=True)
+    (root / "tree" / "a.txt").write_bytes(b"a")
+    (root / "tree" / "sub" / "b.txt").write_bytes(b"bb")
+    (tmp_path / "secret.txt").write_bytes(b"secret")
+
+    return root
+
+
+def write_manifest(path, lines):
+    path.write_text("".join(json.dumps(line) + "\n" for line in lines))
+
+    return str(path)
+
+
+def test_manifest_paths_must_stay_in_the_import_root(tree):
+    manifest = write_manifest(
+        tree / "manifest.jsonl",
+        [
+            {"path": "tree/a.txt"},
+            {"path": "../secret.txt"},
+            {"path": str(tree.parent / "secret.txt")},
+            {"path": "tree/../../secret.txt"},
+            {"cid": "bafkexisting"},
+        ],
+    )
+
+    items = list(read_manifest(manifest))
+
+    assert items[0]["path"] == str(tree / "tree" / "a.txt")
+    assert [item.get("status") for item in items[1:4]] == [FAILED] * 3
+    assert all("outside" in item["error"] for item in items[1:4])
+    assert items[4]["CID"] == "bafkexisting"
+
+
+def test_directory_walk_does_not_follow_links_out_of_the_tree(tree):
+    os.symlink(tree.parent / "secret.txt", tree / "tree" / "link.txt")
+    os.symlink(tree / "tree" / "a.txt", tree / "tree" / "sub" / "inside.txt")
+
+    items = {item["file_name"]: item for item in walk_directory(str(tree / "tree"))}
+
+    assert items["link.txt"]["status"] == FAILED
+    assert "outside" in items["link.txt"]["error"]
+    assert items["sub/inside.txt"]["path"].endswith("inside.txt")
+    assert items["a.txt"]["file_size"] == 1
+
+
+def test_import_root_is_import_root_setting_or_the_source(context, tree, monkeypatch):
+    manifest = write_manifest(tree / "tree" / "manifest.jsonl", [])
+
+    assert import_root(manifest) == str(tree / "tree")
+
+    monkeypatch.setitem(context.config, "IMPORT_ROOT", str(tree))
+    assert import_root(manifest) == str(tree)
+    assert import_root(str(tree.parent / "secret.txt")) == str(tree.parent)
+
+
+def test_import_of_a_directory_records_its_files(context, tree):
+    run = run_import(create_run(str(tree / "tree")).id, workers=2)
+
+    assert (run.status, run.total, run.done, run.failed) == ("done", 2, 2, 0)
+    files = {f.file_name: f for f in Files.query}
+    assert sorted(files) == ["a.txt", "sub/b.txt"]
+    for item in ImportItems.query.filter_by(run_id=run.id):
+        assert files[item.file_name].id == item.file_id
+
+
+def test_links_made_after_the_scan_are_not_followed(context, tree):
+    run = create_run(str(tree / "tree"))
+    scan(run)
+    os.remove(tree / "tree" / "a.txt")
+    os.symlink(tree.parent / "secret.txt", tree / "tree" / "a.txt")
+
+    run = run_import(run.id)
+
+    assert (run.done, run.failed) == (1, 1)
+    failed = ImportItems.query.filter_by(run_id=run.id, status=FAILED).one()
+    assert failed.file_name == "a.txt"
+    assert "outside" in failed.error
+
+
+def test_walk_order_is_the_order_of_walk_keys(tree):
+    (tree / "tree" / "sub" / "deeper").mkdir()
+    (tree / "tree" / "sub" / "deeper" / "c.txt").write_bytes(b"c")
+    (tree / "tree" / "z.txt").write_bytes(b"z")
+
+    names = [item["file_name"] for item in walk_directory(str(tree / "tree"))]
+
+    assert names == ["a.txt", "z.txt", "sub/b.txt", "sub/deeper/c.txt"]
+    assert names == sorted(names, key=walk_key)
+
+
+def test_scan_resumes_after_the_last_path_found(context, tree):
+    run = create_run(str(tree / "tree"))
+    scan(run)
+    # Sorts before the files found, which would shift a resume by position
+    (tree / "tree" / "0.txt").write_bytes(b"0")
+    (tree / "tree" / "sub" / "c.txt").write_bytes(b"c")
+
+    scan(run)
+
+    names = [item.file_name for item in ImportItems.query.filter_by(run_id=run.id)]
+    assert sorted(names) == ["a.txt", "sub/b.txt", "sub/c.txt"]
+
+
+def test_items_with_the_same_cid_get_their_own_file(context, tree):
+    (tree / "tree" / "copy.txt").write_bytes(b"a")
+
+    run = run_import(create_run(str(tree / "tree")).id)
+
+    assert run.done == 3
+    items = ImportItems.query.filter_by(run_id=run.id).all()
+    assert len({item.file_id for item in items}) == 3
+    for item in items:
+        assert Files.query.get(item.file_id).file_name == item.file_name
+
+
+@pytest.fixture
+def import_api(client, tree, monkeypatch):
+    monkeypatch.setitem(client.application.config, "IMPORT_ROOT", str(tree))
+
+    return client
+
+
+def test_imports_api_is_off_without_an_import_root(client):
+    response = client.post("/api/imports", json={"source": "tree"})
+
+    assert response.status_code == 403
+    assert ImportRuns.query.count() == 0
+
+
+@pytest.mark.parametrize(
+    "body, status_code",
+    [
+        ({}, 400),
+        ({"source": ["tree"]}, 400),
+        ({"source": "missing"}, 400),
+        ({"source": "../secret.txt"}, 403),
+        ({"source": "/etc"}, 403),
+    ],
+)
+def test_import_sources_are_checked(import_api, body, status_code):
+    response = import_api.post("/api/imports", json=body)
+
+    assert response.status_code == status_code
+    assert ImportRuns.query.count() == 0
+
+
+def test_import_is_started_listed_and_resumed(import_api, tree, wait_until):
+    response = import_api.post("/api/imports", json={"source": "tree"})
+
+    assert response.status_code == 202
+    location = urlsplit(response.headers["Location"]).path
+    run_id = response.json["id"]
+    assert location == "/api/imports/{}".format(run_id)
+    wait_until(lambda: ImportRuns.query.get(run_id).status == DONE)
+    progress = import_api.get(location).json
+    assert (progress["total"], progress["done"], progress["pending"]) == (2, 2, 0)
+    assert progress["failures"] == []
+    listed = import_api.get("/api/imports").json["imports"]
+    assert [run["id"] for run in listed] == [run_id]
+
+    # Files added since are imported by a resume
+    (tree / "tree" / "sub" / "c.txt").write_bytes(b"c")
+    response = import_api.post(location + "/resume", json={})
+
+    assert response.status_code == 202
+    wait_until(
+        lambda: ImportRuns.query.get(run_id).status == DONE
+        and ImportRuns.query.get(run_id).done == 3
+    )
+    assert Files.query.count() == 3
+
+
+def test_import_running_in_another_process_is_not_resumed(import_api, tree):
+    run = create_run(str(tree / "tree"))
+    run.status = RUNNING
+    run.worker = "elsewhere:1:1"
+    db.session.commit()
+
+    response = import_api.post("/api/imports/{}/resume".format(run.id))
+
+    assert response.status_code == 409
+    assert import_api.post("/api/imports/0/resume").status_code == 404
+    assert import_api.get("/api/imports/0").status_code == 404
@@ -0,0 +1,127 @@
+import io
+import os
+import threading
+import time
+from datetime import datetime
+from werkzeug.datastructures import FileStorage
+from pygate import db, jobs
+from pygate.helpers import get_default_ffs
+from pygate.lifecycle import new_upload_directory, track_copies
+from pygate.models import Files, Jobs
+
+
+def save_job(name, content, batch_id, status=jobs.QUEUED):
+    directory = new_upload_directory()
+    with open(os.path.join(directory, name), "wb") as upload:
+        upload.write(content)
+    job = Jobs(
+        file_path=directory,
+        file_name=name,
+        status=status,
+        created=datetime.now().replace(microsecond=0),
+        batch_id=batch_id,
+        file_size=len(content),
+    )
+    job.ffs_id = get_default_ffs().id
+    db.session.add(job)
+    track_copies([job])
+    db.session.commit()
+
+    return job
+
+
+def test_submit_uploads_records_every_file(context, wait_until):
+    uploads = [
+        FileStorage(io.BytesIO(b"first"), filename="first.txt"),
+        FileStorage(io.BytesIO(b"second"), filename="second.txt"),
+    ]
+
+    batch_id, submitted, skipped = jobs.submit_uploads(
+        uploads, context.config["UPLOADDIR"]
+    )
+
+    assert skipped == []
+    assert len(submitted) == 2
+    progress = wait_until(
+        lambda: (jobs.batch_progress(batch_id) or {}).get("finished")
+        and jobs.batch_progress(batch_id)
+    )
+    assert [job["status"] for job in progress["jobs"]] == [jobs.DONE, jobs.DONE]
+    assert sorted(f.file_name for f in Files.query) == ["first.txt", "second.txt"]
+
+
+def test_pushed_file_is_recorded_before_its_batch_finishes(context):
+    first = save_job("first.txt", b"first", "batch").id
+    second = save_job("second.txt", b"second", "batch").id
+
+    jobs._run_job(first)
+
+    assert Jobs.query.get(first).status == jobs.DONE
+    assert Jobs.query.get(second).status == jobs.QUEUED
+    recorded = Files.query.one()
+    assert recorded.file_name == "first.txt"
+    assert recorded.CID == Jobs.query.get(first).CID
+
+
+def test_pushed_job_is_recorded_once(context):
+    job = save_job("file.txt", b"content", "batch", status=jobs.PUSHED)
+    job.CID = "bafkexample"
+    db.session.commit()
+
+    jobs.record_job(job)
+    jobs.record_job(job)
+
+    assert Files.query.filter_by(CID="bafkexample").count() == 1
+    assert Jobs.query.get(job.id).status == jobs.DONE
+
+
+def test_resume_records_pushed_jobs(context, wait_until):
+    job = save_job("file.txt", b"content", "batch", status=jobs.PUSHED)
+    job.CID = "bafkexample"
+    db.session.commit()
+
+    jobs.resume_jobs()
+
+    wait_until(lambda: Files.query.filter_by(CID="bafkexample").count() == 1)
+
+
+def test_wait_for_change_wakes_on_status_change(context):
+    job = save_job("file.txt", b"content", "batch", status=jobs.RUNNING)
+    job_id = job.id
+
+    def finish():
+        time.sleep(0.2)
+        with context.app_context():
+            jobs._set_status(Jobs.query.get(job_id), jobs.FAILED, "failed")
+
+    threading.Thread(target=finish).start()
+    started = time.monotonic()
+    changed = jobs.wait_for_change(job_id, jobs.RUNNING, timeout=10)
+
+    assert changed.status == jobs.FAILED
+    assert time.monotonic() - started < 5
+
+
+def test_wait_for_change_queries_without_the_lock(context, monkeypatch):
+    job = save_job("file.txt", b"content", "batch", status=jobs.RUNNING)
+    current_status = jobs._current_status
+    free = []
+
+    def take_lock():
+        if jobs._status_changed.acquire(timeout=1):
+            jobs._status_changed.release()
+            free.append(True)
+        else:
+            free.append(False)
+
+    def check_lock(job_id):
+        # Another thread can take the lock while the query runs
+        taker = threading.Thread(target=take_lock)
+        taker.start()
+        taker.join()
+        return current_status(job_id)
+
+    monkeypatch.setattr(jobs, "_current_status", check_lock)
+    jobs.wait_for_change(job.id, jobs.RUNNING, timeout=0.1)
+
+    assert free and all(free)
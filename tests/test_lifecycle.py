@@ -0,0 +1,151 @@
+import os
+from datetime import datetime, timedelta
+from pygate import db, jobs, lifecycle
+from pygate.eventlog import flush
+from pygate.helpers import get_default_ffs
+from pygate.lifecycle import adopt_copies, new_upload_directory, sweep, track_copies
+from pygate.models import Files, Jobs, Logs, StagedFiles
+from pygate.watcher import SUCCESS
+
+
+def saved_upload(status=jobs.FAILED, state=lifecycle.FAILED, retries=0, updated=None):
+    directory = new_upload_directory()
+    with open(os.path.join(directory, "file.txt"), "wb") as upload:
+        upload.write(b"content")
+    job = Jobs(
+        file_path=directory,
+        file_name="file.txt",
+        status=status,
+        created=datetime.now().replace(microsecond=0),
+        batch_id="batch",
+        file_size=7,
+    )
+    job.ffs_id = get_default_ffs().id
+    db.session.add(job)
+    track_copies([job])
+    db.session.flush()
+    copy = StagedFiles.query.filter_by(job_id=job.id).one()
+    copy.state = state
+    copy.retries = retries
+    copy.updated = updated or datetime.now().replace(microsecond=0)
+    db.session.commit()
+
+    return job.id, os.path.join(directory, "file.txt")
+
+
+def copy_of(job_id):
+    db.session.expire_all()
+
+    return StagedFiles.query.filter_by(job_id=job_id).first()
+
+
+def test_failed_upload_is_retried_after_the_delay(context, wait_until):
+    job_id, _ = saved_upload(updated=datetime.now() - timedelta(hours=1))
+    waiting_id, _ = saved_upload()
+
+    sweep()
+
+    wait_until(lambda: Jobs.query.get(job_id).status == jobs.DONE)
+    assert copy_of(job_id).retries == 1
+    assert copy_of(job_id).state in (lifecycle.PUSHED, lifecycle.CONFIRMED)
+    assert Jobs.query.get(waiting_id).status == jobs.FAILED
+    assert copy_of(waiting_id).state == lifecycle.FAILED
+
+
+def test_copy_is_kept_once_its_retries_failed(context):
+    job_id, path = saved_upload(retries=context.config["UPLOAD_RETRIES"])
+
+    assert sweep() == (0, 0)
+    assert sweep() == (0, 0)
+
+    assert copy_of(job_id).state == lifecycle.STRANDED
+    assert os.path.exists(path)
+    assert Jobs.query.get(job_id).status == jobs.FAILED
+    flush()
+    kept = Logs.query.filter(Logs.event.like("Upload of file.txt failed%")).all()
+    assert [entry.event for entry in kept] == [
+        "Upload of file.txt failed {} retries, kept at {}".format(
+            context.config["UPLOAD_RETRIES"], os.path.dirname(path)
+        )
+    ]
+
+
+def test_old_deleted_copies_are_pruned(context, monkeypatch):
+    monkeypatch.setitem(context.config, "UPLOAD_DELETE_AFTER", "pushed")
+    job_id, _ = saved_upload(status=jobs.DONE, state=lifecycle.PUSHED)
+    sweep()
+    copy = copy_of(job_id)
+    copy.updated = datetime.now() - timedelta(
+        days=context.config["UPLOAD_DELETED_KEEP_DAYS"] + 1
+    )
+    db.session.commit()
+
+    sweep()
+
+    assert copy_of(job_id) is None
+    assert Jobs.query.get(job_id).file_path is None
+    assert adopt_copies() == 0
+
+
+def pushed_upload(storage_job_id):
+    job_id, path = saved_upload(status=jobs.DONE, state=lifecycle.PUSHED)
+    copy = copy_of(job_id)
+    copy.storage_job_id = storage_job_id
+    db.session.commit()
+
+    return job_id, path
+
+
+def test_copies_are_deleted_once_their_storage_is_confirmed(context):
+    confirmed_id, confirmed_path = pushed_upload("stored")
+    pushed_id, pushed_path = pushed_upload("storing")
+    db.session.add(
+        Files(
+            file_path=None,
+            file_name="file.txt",
+            upload_date=datetime.now().replace(microsecond=0),
+            file_size=7,
+            CID="bafkstored",
+            ffs_id=get_default_ffs().id,
+            storage_job_id="stored",
+            storage_status=SUCCESS,
+        )
+    )
+    db.session.commit()
+
+    assert sweep() == (1, 7)
+
+    assert copy_of(confirmed_id).state == lifecycle.DELETED
+    assert not os.path.exists(confirmed_path)
+    assert copy_of(pushed_id).state == lifecycle.PUSHED
+    assert os.path.exists(pushed_path)
+
+
+def test_quota_deletes_the_oldest_pushed_copies(context, monkeypatch):
+    monkeypatch.setitem(context.config, "UPLOAD_DELETE_AFTER", None)
+    monkeypatch.setitem(context.config, "UPLOAD_QUOTA_HIGH_BYTES", 20)
+    monkeypatch.setitem(context.config, "UPLOAD_QUOTA_LOW_BYTES", 14)
+    saved_id, _ = saved_upload(status=jobs.QUEUED, state=lifecycle.SAVED)
+    oldest = [pushed_upload(None)[0] for _ in range(3)]
+
+    assert sweep() == (2, 14)
+
+    states = [copy_of(job_id).state for job_id in oldest]
+    assert states == [lifecycle.DELETED, lifecycle.DELETED, lifecycle.PUSHED]
+    assert copy_of(saved_id).state == lifecycle.SAVED
+
+
+def test_uploads_not_stored_are_kept_over_the_quota(context, monkeypatch):
+    monkeypatch.setitem(context.config, "UPLOAD_QUOTA_HIGH_BYTES", 0)
+    monkeypatch.setitem(context.config, "UPLOAD_QUOTA_LOW_BYTES", 0)
+    saved_id, saved_path = saved_upload(status=jobs.QUEUED, state=lifecycle.SAVED)
+    # Not due for its retry yet
+    failed_id, failed_path = saved_upload()
+
+    assert sweep() == (0, 0)
+
+    assert copy_of(saved_id).state == lifecycle.SAVED
+    assert copy_of(failed_id).state == lifecycle.FAILED
+    assert os.path.exists(saved_path) and os.path.exists(failed_path)
+    flush()
+    assert Logs.query.filter(Logs.event.like("Upload quota exceeded%")).count() == 1
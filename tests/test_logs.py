@@ -0,0 +1,88 @@
+import gzip
+import json
+import os
+from datetime import datetime, timedelta
+import pytest
+from pygate.eventlog import flush, log_event
+from pygate.models import Logs
+from pygate.retention import archive_logs
+
+START = datetime(2020, 9, 30, 23, 0, 0)
+
+
+@pytest.fixture
+def entries(context):
+    """
+    Six entries an hour apart, spanning the end of September 2020
+    """
+
+    events = [
+        "Uploaded report.pdf",
+        "Upload ERROR: photo.jpg",
+        "Downloaded report.pdf",
+        "Uploaded 100%_done.txt",
+        "Deleted photo.jpg",
+        "Uploaded notes.txt",
+    ]
+    for hour, event in enumerate(events):
+        log_event(event, START + timedelta(hours=hour))
+    flush()
+
+    return events
+
+
+def api_logs(client, **args):
+    return client.get("/api/logs", query_string=args).get_json()
+
+
+def test_logs_are_paged_by_cursor(client, entries):
+    first = api_logs(client, length=4)
+    second = api_logs(client, length=4, after=first["next"])
+
+    events = [row["event"] for row in first["data"] + second["data"]]
+    assert events == list(reversed(entries))
+    assert first["recordsTotal"] == 6
+
+
+def test_logs_are_filtered_by_time_range(client, entries):
+    body = api_logs(
+        client, since="2020-10-01T00:00:00", until="2020-10-01T02:00:00"
+    )
+
+    assert [row["event"] for row in body["data"]] == entries[2:0:-1]
+    assert (body["recordsTotal"], body["recordsFiltered"]) == (6, 2)
+
+
+@pytest.mark.parametrize(
+    "search, found",
+    [
+        ("report", [2, 0]),
+        ("upload photo", [1]),
+        ("100%", [3]),
+        ('"photo', [4, 1]),
+    ],
+)
+def test_logs_are_searched_by_words(client, entries, search, found):
+    body = api_logs(client, search=search)
+
+    assert [row["event"] for row in body["data"]] == [entries[i] for i in found]
+
+
+def test_malformed_time_range_is_refused(client, entries):
+    assert client.get("/api/logs?since=yesterday").status_code == 400
+
+
+def test_old_entries_are_archived_by_month(context, entries, tmp_path, monkeypatch):
+    directory = str(tmp_path / "archive")
+    monkeypatch.setitem(context.config, "LOG_ARCHIVE_DIR", directory)
+
+    archived = archive_logs(datetime(2020, 10, 1, 1, 0, 0), batch_size=1)
+
+    assert archived == 2
+    flush()
+    left = [entry.event for entry in Logs.query.order_by(Logs.id)]
+    assert left[:4] == entries[2:]
+    with gzip.open(os.path.join(directory, "logs-2020-09.jsonl.gz"), "rt") as month:
+        assert [json.loads(line)["event"] for line in month] == entries[:1]
+    with gzip.open(os.path.join(directory, "logs-2020-10.jsonl.gz"), "rt") as month:
+        assert [json.loads(line)["event"] for line in month] == entries[1:2]
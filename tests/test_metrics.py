@@ -0,0 +1,89 @@
+import os
+import threading
+import time
+from pygate import metrics
+from pygate.metrics import Counter, Histogram, Sampler, timed_chunks, write_profile
+
+
+def test_histogram_buckets_are_cumulative(monkeypatch):
+    monkeypatch.setattr(metrics, "_registry", [])
+    histogram = Histogram("test_seconds", "Test", ["route"], buckets=(0.1, 1))
+
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, route="/a")
+
+    assert histogram.samples() == [
+        'test_seconds_bucket{route="/a",le="0.1"} 1',
+        'test_seconds_bucket{route="/a",le="1"} 2',
+        'test_seconds_bucket{route="/a",le="+Inf"} 3',
+        'test_seconds_count{route="/a"} 3',
+        'test_seconds_sum{route="/a"} 5.55',
+    ]
+
+
+def test_label_values_are_escaped(monkeypatch):
+    monkeypatch.setattr(metrics, "_registry", [])
+    counter = Counter("test_total", "Test", ["name"])
+
+    counter.inc(name='a "quoted"\nname')
+
+    assert metrics.render().splitlines() == [
+        "# HELP test_total Test",
+        "# TYPE test_total counter",
+        'test_total{name="a \\"quoted\\"\\nname"} 1',
+    ]
+
+
+def test_requests_are_reported(client):
+    client.get("/api/files")
+
+    text = client.get("/metrics").get_data(as_text=True)
+
+    assert (
+        'pygate_requests_total{endpoint="pygate.api_files",method="GET",status="200"}'
+        in text
+    )
+    assert 'pygate_db_query_duration_seconds_count{operation="SELECT"}' in text
+    assert "pygate_requests_in_flight 1" in text
+
+
+def test_streamed_bytes_are_counted():
+    before = metrics.FILE_IO_BYTES._values.get(("test",), 0)
+
+    assert b"".join(timed_chunks("test", [b"ab", b"cde"])) == b"abcde"
+
+    assert metrics.FILE_IO_BYTES._values[("test",)] == before + 5
+
+
+def test_sampler_counts_the_stacks_of_a_thread():
+    sampler = Sampler(0.001)
+    started = threading.Event()
+    done = threading.Event()
+
+    def slow_request():
+        sampler.start(threading.get_ident())
+        started.set()
+        done.wait(5)
+
+    thread = threading.Thread(target=slow_request)
+    thread.start()
+    started.wait(5)
+    time.sleep(0.1)
+    stacks = sampler.stop(thread.ident)
+    done.set()
+    thread.join()
+
+    assert stacks
+    assert all("slow_request (test_metrics.py" in stack for stack in stacks)
+
+
+def test_profile_is_written_as_folded_stacks(context, tmp_path, monkeypatch):
+    monkeypatch.setitem(context.config, "PROFILE_DIR", str(tmp_path))
+    stacks = metrics.StackCounter({"main (a.py:1);handle (b.py:2)": 3})
+
+    write_profile(stacks, "pygate.files", 1.5)
+
+    (name,) = os.listdir(tmp_path)
+    assert name.endswith("-pygate.files-1500ms.folded")
+    with open(tmp_path / name) as profile:
+        assert profile.read() == "main (a.py:1);handle (b.py:2) 3\n"
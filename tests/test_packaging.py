@@ -0,0 +1,72 @@
+import io
+import tarfile
+import threading
+import time
+import pytest
+from pygate.models import Files
+from pygate.packaging import CHUNK_SIZE, package_name, push_package, stream_package
+
+
+def uploads(*contents):
+    return [
+        ("file{}.txt".format(number), io.BytesIO(content))
+        for number, content in enumerate(contents)
+    ]
+
+
+@pytest.mark.parametrize("compression", ["", "gz"])
+def test_package_is_a_tar_of_the_uploads(context, compression):
+    pipe = stream_package(uploads(b"first", b"second"), compression)
+
+    package = io.BytesIO(b"".join(pipe))
+
+    with tarfile.open(fileobj=package, mode="r:" + compression) as tarball:
+        members = {m.name: tarball.extractfile(m).read() for m in tarball}
+    assert members == {"file0.txt": b"first", "file1.txt": b"second"}
+
+
+def test_package_buffers_a_bounded_number_of_chunks(context, monkeypatch):
+    monkeypatch.setitem(context.config, "PACKAGE_BUFFER_CHUNKS", 2)
+    pipe = stream_package(uploads(bytes(8 * CHUNK_SIZE)), "")
+
+    time.sleep(0.2)
+    assert pipe._chunks.qsize() <= 2
+
+    assert sum(len(chunk) for chunk in pipe) > 8 * CHUNK_SIZE
+
+
+def test_failed_upload_stream_fails_the_package(context):
+    class Broken(io.BytesIO):
+        def read(self, *args):
+            raise IOError("upload went away")
+
+    pipe = stream_package([("broken.txt", Broken(b"content"))], "")
+
+    with pytest.raises(IOError, match="upload went away"):
+        b"".join(pipe)
+
+
+def test_abandoned_package_stops_its_writer(context, monkeypatch):
+    monkeypatch.setitem(context.config, "PACKAGE_BUFFER_CHUNKS", 1)
+    pipe = stream_package(uploads(bytes(8 * CHUNK_SIZE)), "")
+
+    next(iter(pipe))
+    pipe.cancel()
+
+    deadline = time.monotonic() + 5
+    while any(thread.name == "pygate-package" for thread in threading.enumerate()):
+        assert time.monotonic() < deadline, "the package writer is still running"
+        time.sleep(0.05)
+
+
+def test_unknown_compression_is_refused():
+    with pytest.raises(ValueError):
+        package_name("package", "bz2")
+    assert package_name("package", "gz") == "package.tar.gz"
+
+
+def test_pushed_package_is_recorded(context):
+    file_upload = push_package(uploads(b"first", b"second"), "package.tar")
+
+    assert Files.query.get(file_upload.id).file_name == "package.tar"
+    assert file_upload.CID.startswith("bafk")
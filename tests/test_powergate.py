@@ -0,0 +1,192 @@
+import os
+import threading
+import pytest
+from benchmarks.fake_powergate import FakePowergate
+from pygate import powergate
+from pygate.helpers import create_ffs, get_default_ffs, stage_upload
+from pygate.lifecycle import new_upload_directory
+from pygate.powergate import (
+    PoolTimeout,
+    PowerGatePool,
+    available_nodes,
+    get_pool,
+    node_of,
+    place_ffs,
+)
+
+
+@pytest.fixture
+def pool(context):
+    return PowerGatePool(
+        context.config["POWERGATE_ADDRESS"],
+        size=2,
+        timeout=0.2,
+        health_check_interval=60,
+        retry_interval=30,
+    )
+
+
+def test_checkout_reuses_released_clients(pool):
+    with pool.client() as first:
+        first.health.check()
+    with pool.client() as second:
+        pass
+
+    assert second is first
+    stats = pool.stats()
+    assert stats["open"] == 1
+    assert stats["checkouts"] == 2
+    assert stats["calls"]["health.check"]["calls"] == 1
+
+
+def test_checkout_times_out_when_every_client_is_in_use(pool):
+    clients = [pool.acquire(), pool.acquire()]
+
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+
+    assert pool.stats()["waits"] == 1
+    for pooled in clients:
+        pool.release(pooled)
+
+
+def test_checkout_waits_for_a_released_client(pool):
+    clients = [pool.acquire(), pool.acquire()]
+    threading.Timer(0.05, pool.release, [clients[0]]).start()
+
+    assert pool.acquire() is clients[0]
+
+    pool.release(clients[0])
+    pool.release(clients[1])
+
+
+def test_broken_client_is_replaced_and_closed(pool):
+    pooled = pool.acquire()
+    pooled.broken = True
+    pool.release(pooled)
+
+    with pool.client() as replaced:
+        replaced.health.check()
+
+    assert replaced is not pooled
+    assert pool.stats()["reconnects"] == 1
+    with pytest.raises(ValueError):
+        # Calls on a closed gRPC channel are refused
+        pooled.health.check()
+
+
+def test_failed_reconnect_gives_up_the_slot(pool, monkeypatch):
+    pooled = pool.acquire()
+    pooled.broken = True
+
+    def refuse(pool):
+        raise RuntimeError("no channel")
+
+    monkeypatch.setattr(powergate, "PooledClient", refuse)
+    with pytest.raises(RuntimeError):
+        pool.release(pooled)
+
+    stats = pool.stats()
+    assert stats["open"] == 0
+    assert stats["checkouts"] >= 1
+
+
+def test_shared_client_is_not_checked_out(pool):
+    clients = [pool.acquire(), pool.acquire()]
+
+    shared = pool.shared()
+    shared.health.check()
+
+    assert pool.shared() is shared
+    assert pool.stats()["in_use"] == 2
+    for pooled in clients:
+        pool.release(pooled)
+
+
+def test_broken_shared_client_is_replaced(pool):
+    shared = pool.shared()
+    shared.broken = True
+
+    assert pool.shared() is not shared
+    with pytest.raises(ValueError):
+        shared.health.check()
+
+
+@pytest.fixture(scope="module")
+def second_node():
+    node = FakePowergate()
+    address = node.start()
+
+    yield node, address
+
+    node.stop()
+
+
+@pytest.fixture
+def nodes(context, second_node, monkeypatch):
+    """
+    The addresses of two Powergate nodes, with pools of their own for the
+    test
+    """
+
+    first = context.config["POWERGATE_ADDRESS"]
+    second = second_node[1]
+    monkeypatch.setitem(context.config, "POWERGATE_ADDRESSES", [first, second])
+    monkeypatch.setattr(powergate, "_pools", {})
+
+    return first, second
+
+
+def test_least_loaded_node_is_picked(nodes):
+    first, second = nodes
+
+    assert place_ffs({}) == first
+    assert place_ffs({first: 1}) == second
+    assert place_ffs({first: 2, second: 1}) == second
+
+    get_pool(second).mark_down()
+    assert available_nodes() == [first]
+    assert place_ffs({first: 2}) == first
+
+    get_pool(first).mark_down()
+    assert available_nodes() == [first, second]
+
+
+def test_hash_placement_spreads_over_the_nodes(context, nodes, monkeypatch):
+    monkeypatch.setitem(context.config, "POWERGATE_PLACEMENT", "hash")
+
+    picked = [place_ffs({nodes[0]: count}) for count in range(20)]
+
+    assert set(picked) == set(nodes)
+    assert picked == [place_ffs({nodes[0]: count}) for count in range(20)]
+
+
+def test_ffses_are_created_and_used_on_their_node(nodes, second_node):
+    first, second = nodes
+
+    default = get_default_ffs()
+    other = create_ffs(default=True)
+
+    assert (node_of(default), node_of(other)) == (first, second)
+    assert get_pool(second).stats()["calls"]["ffs.create"]["calls"] == 1
+
+    directory = new_upload_directory()
+    with open(os.path.join(directory, "upload.txt"), "wb") as upload:
+        upload.write(b"on the second node")
+    file_upload, _ = stage_upload(directory, "upload.txt")
+
+    assert file_upload.ffs_id == other.id
+    assert second_node[0].file_size(file_upload.CID) == len(b"on the second node")
+    assert "ffs.stage" not in get_pool(first).stats()["calls"]
+
+
+def test_pool_metrics_report_the_calls_of_every_node(client):
+    get_default_ffs()
+
+    pools = client.get("/api/powergate/metrics").json["pools"]
+
+    address = client.application.config["POWERGATE_ADDRESS"]
+    stats = {pool["address"]: pool for pool in pools}[address]
+    assert stats["available"]
+    assert stats["calls"]["ffs.create"]["calls"] >= 1
+    assert stats["checkouts"] >= 1
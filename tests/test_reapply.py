@@ -0,0 +1,121 @@
+import json
+from datetime import datetime
+from urllib.parse import urlsplit
+import pytest
+from pygate import db, reapply
+from pygate.helpers import get_default_ffs
+from pygate.models import ConfigRuns, Files
+from pygate.reapply import ConfigRunError, create_config_run, run_config_push
+
+
+def add_files(count):
+    ffs = get_default_ffs()
+    for number in range(count):
+        db.session.add(
+            Files(
+                file_path=None,
+                file_name="{}.txt".format(number),
+                upload_date=datetime.now().replace(microsecond=0),
+                file_size=1,
+                CID="bafkreapply{}".format(number),
+                ffs_id=ffs.id,
+            )
+        )
+    db.session.commit()
+
+    return ffs
+
+
+@pytest.mark.parametrize("status", [reapply.RUNNING, reapply.DONE, reapply.FAILED])
+def test_new_config_supersedes_every_earlier_run(context, status):
+    ffs = add_files(1)
+    earlier = create_config_run(ffs, "{}")
+    earlier.status = status
+    db.session.commit()
+
+    later = create_config_run(ffs, "{}")
+
+    assert ConfigRuns.query.get(earlier.id).status == reapply.SUPERSEDED
+    assert later.status == reapply.RUNNING
+    with pytest.raises(ConfigRunError):
+        run_config_push(earlier.id, retry_failed=True)
+
+
+def test_interrupted_run_resumes_after_its_checkpoint(context, monkeypatch):
+    monkeypatch.setitem(context.config, "CONFIG_PUSH_BATCH_SIZE", 2)
+    ffs = add_files(5)
+    run = create_config_run(ffs, "{}")
+    checkpoint = Files.query.order_by(Files.id).all()[1].id
+    run.last_file_id = checkpoint
+    run.done = 2
+    db.session.commit()
+
+    run = run_config_push(run.id, workers=2)
+
+    assert (run.status, run.done, run.failed) == (reapply.DONE, 5, 0)
+    pushed = Files.query.filter(Files.storage_job_id.isnot(None))
+    assert all(f.id > checkpoint for f in pushed)
+    assert pushed.count() == 3
+
+
+def test_changed_config_pushes_the_files_of_the_ffs(client, powergate, wait_until):
+    ffs = add_files(3)
+    wallet = powergate.wallet(ffs.token)
+
+    response = client.post(
+        "/change_config/{}/{}".format(ffs.ffs_id, wallet),
+        data={
+            "hot_enabled": "y",
+            "add_timeout": "30",
+            "cold_enabled": "y",
+            "rep_factor": "2",
+            "deal_min_duration": "1000",
+        },
+    )
+
+    assert urlsplit(response.headers["Location"]).path == "/config/" + ffs.ffs_id
+    run = ConfigRuns.query.one()
+    config = json.loads(run.config)
+    assert config["cold"]["filecoin"]["repFactor"] == 2
+    assert config["cold"]["filecoin"]["addr"] == wallet
+    wait_until(lambda: ConfigRuns.query.get(run.id).status == reapply.DONE)
+    progress = client.get("/api/config_runs/{}".format(run.id)).json
+    assert (progress["total"], progress["done"], progress["failed"]) == (3, 3, 0)
+    assert progress["failures"] == []
+    assert Files.query.filter(Files.storage_job_id.isnot(None)).count() == 3
+
+
+def test_stopped_run_is_resumed(client, wait_until):
+    ffs = add_files(3)
+    run = create_config_run(ffs, "{}")
+    run.status = reapply.FAILED
+    db.session.commit()
+
+    response = client.post("/api/config_runs/{}/resume".format(run.id), json={})
+
+    assert response.status_code == 202
+    wait_until(
+        lambda: ConfigRuns.query.get(run.id).status == reapply.DONE
+        and ConfigRuns.query.get(run.id).done == 3
+    )
+
+
+def test_superseded_or_running_run_is_not_resumed(client):
+    ffs = add_files(1)
+    earlier = create_config_run(ffs, "{}")
+    later = create_config_run(ffs, "{}")
+    later.worker = "elsewhere:1:1"
+    db.session.commit()
+
+    for run in (earlier, later):
+        response = client.post("/api/config_runs/{}/resume".format(run.id))
+        assert response.status_code == 409
+    assert client.post("/api/config_runs/0/resume").status_code == 404
+    assert client.get("/api/config_runs/0").status_code == 404
+
+
+def test_run_of_a_ffs_without_files_is_done(context):
+    run = create_config_run(get_default_ffs(), "{}")
+
+    assert (run.status, run.total) == (reapply.DONE, 0)
+    assert ConfigRuns.query.get(run.id).status == reapply.DONE
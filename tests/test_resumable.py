@@ -0,0 +1,159 @@
+import base64
+import hashlib
+import os
+from datetime import datetime, timedelta
+import pytest
+from pygate import db, jobs
+from pygate.models import Files, Jobs, Uploads
+from pygate.resumable import part_path
+
+TUS = {"Tus-Resumable": "1.0.0"}
+CHUNK = {"Content-Type": "application/offset+octet-stream"}
+
+
+def start_upload(client, length, name=b"resumable.txt"):
+    headers = dict(TUS)
+    headers["Upload-Length"] = str(length)
+    headers["Upload-Metadata"] = "filename " + base64.b64encode(name).decode()
+
+    return client.post("/uploads", headers=headers)
+
+
+@pytest.fixture
+def location(client):
+    response = start_upload(client, 10)
+    assert response.status_code == 201
+
+    return response.headers["Location"]
+
+
+def send_chunk(client, location, offset, data, **headers):
+    headers.update(TUS, **CHUNK)
+    headers["Upload-Offset"] = str(offset)
+
+    return client.patch(location, data=data, headers=headers)
+
+
+def offset_of(client, location):
+    return client.head(location, headers=TUS).headers["Upload-Offset"]
+
+
+def sha256(data):
+    return "sha256 " + base64.b64encode(hashlib.sha256(data).digest()).decode()
+
+
+def test_options_describe_the_protocol(client):
+    response = client.options("/uploads")
+
+    assert response.status_code == 204
+    assert response.headers["Tus-Version"] == "1.0.0"
+    assert "checksum" in response.headers["Tus-Extension"]
+
+
+@pytest.mark.parametrize(
+    "headers, status",
+    [
+        ({}, 412),
+        ({"Tus-Resumable": "1.0.0", "Upload-Length": "ten"}, 400),
+        ({"Tus-Resumable": "1.0.0", "Upload-Length": "10"}, 400),
+    ],
+)
+def test_malformed_creation_is_refused(client, headers, status):
+    assert client.post("/uploads", headers=headers).status_code == status
+
+
+def test_upload_over_the_maximum_size_is_refused(client, monkeypatch):
+    monkeypatch.setitem(client.application.config, "RESUMABLE_UPLOAD_MAX_SIZE", 5)
+
+    assert start_upload(client, 6).status_code == 413
+
+
+def test_chunks_complete_the_upload(client, location, wait_until):
+    response = send_chunk(client, location, 0, b"0123")
+    assert (response.status_code, response.headers["Upload-Offset"]) == (204, "4")
+    assert "Upload-Expires" in response.headers
+    assert offset_of(client, location) == "4"
+
+    response = send_chunk(client, location, 4, b"456789")
+
+    assert response.status_code == 204
+    assert response.headers["Upload-Offset"] == "10"
+    job_id = int(response.headers["Upload-Job"].rsplit("/", 1)[1])
+    wait_until(lambda: Jobs.query.get(job_id).status == jobs.DONE)
+    stored = Files.query.filter_by(file_name="resumable.txt").one()
+    assert stored.content_hash == hashlib.sha256(b"0123456789").hexdigest()
+    assert offset_of(client, location) == "10"
+
+
+def test_chunk_at_the_wrong_offset_is_refused(client, location):
+    send_chunk(client, location, 0, b"0123")
+
+    assert send_chunk(client, location, 2, b"23").status_code == 409
+    assert send_chunk(client, location, 6, b"67").status_code == 409
+    assert offset_of(client, location) == "4"
+
+
+def test_chunk_past_the_length_is_dropped(client, location):
+    assert send_chunk(client, location, 0, b"0123456789x").status_code == 413
+    assert offset_of(client, location) == "0"
+
+
+def test_chunk_must_match_its_checksum(client, location):
+    response = send_chunk(
+        client, location, 0, b"0123", **{"Upload-Checksum": sha256(b"other")}
+    )
+    assert response.status_code == 460
+    assert offset_of(client, location) == "0"
+
+    response = send_chunk(
+        client, location, 0, b"0123", **{"Upload-Checksum": sha256(b"0123")}
+    )
+    assert (response.status_code, response.headers["Upload-Offset"]) == (204, "4")
+
+
+def test_offset_never_passes_the_partial_file(client, location):
+    send_chunk(client, location, 0, b"0123")
+    upload = Uploads.query.get(location.rsplit("/", 1)[1])
+    with open(part_path(upload), "r+b") as part:
+        part.truncate(2)
+
+    assert offset_of(client, location) == "2"
+    assert send_chunk(client, location, 2, b"23").status_code == 204
+
+
+def test_unfinished_upload_can_be_abandoned(client, location):
+    send_chunk(client, location, 0, b"0123")
+    upload = Uploads.query.get(location.rsplit("/", 1)[1])
+    path = part_path(upload)
+
+    assert client.delete(location, headers=TUS).status_code == 204
+    assert client.head(location, headers=TUS).status_code == 404
+    assert not os.path.exists(path)
+
+
+def test_complete_upload_cannot_be_abandoned(client, location, wait_until):
+    response = send_chunk(client, location, 0, b"0123456789")
+
+    assert client.delete(location, headers=TUS).status_code == 409
+    job_id = int(response.headers["Upload-Job"].rsplit("/", 1)[1])
+    wait_until(lambda: Jobs.query.get(job_id).status == jobs.DONE)
+
+
+def test_idle_uploads_expire(client, location):
+    upload_id = location.rsplit("/", 1)[1]
+    upload = Uploads.query.get(upload_id)
+    upload.updated = datetime.now() - timedelta(days=2)
+    db.session.commit()
+
+    start_upload(client, 10)
+
+    assert Uploads.query.get(upload_id) is None
+
+
+def test_empty_upload_is_complete_at_once(client, wait_until):
+    response = start_upload(client, 0)
+
+    upload = Uploads.query.get(response.headers["Location"].rsplit("/", 1)[1])
+    assert upload.job_id is not None
+    job_id = upload.job_id
+    wait_until(lambda: Jobs.query.get(job_id).status == jobs.DONE)
@@ -0,0 +1,103 @@
+import hashlib
+import os
+import pytest
+from pygate import staging
+from pygate.helpers import get_default_ffs
+from pygate.powergate import get_shared_powergate, node_of
+from pygate.staging import ChunkSizer, encode_chunk, mapped_chunks, stage_chunks
+
+
+@pytest.fixture(autouse=True)
+def learned_size(monkeypatch):
+    # Keep the size learned by one test from starting the next one
+    monkeypatch.setattr(staging, "_learned_size", None)
+
+
+def write_file(tmp_path, content):
+    path = os.path.join(str(tmp_path), "upload.bin")
+    with open(path, "wb") as out_file:
+        out_file.write(content)
+
+    return path
+
+
+def test_encoded_chunk_is_a_staging_request():
+    from pygate_grpc import ffs as ffs_client
+
+    _, _, chunk_key = staging.stage_method()
+    chunk = os.urandom(300)
+    service = ffs_client.ffs_rpc_pb2.DESCRIPTOR.services_by_name["RPCService"]
+    method = service.methods_by_name.get("Stage") or service.methods_by_name["AddToHot"]
+    request = getattr(ffs_client.ffs_rpc_pb2, method.input_type.name)
+
+    assert request.FromString(encode_chunk(memoryview(chunk))).chunk == chunk
+    assert encode_chunk(chunk) == request(chunk=chunk).SerializeToString()
+    assert encode_chunk(b"").startswith(chunk_key)
+
+
+def test_file_is_mapped_in_chunks_of_the_sizer(tmp_path):
+    content = os.urandom(2500)
+    sizer = ChunkSizer(1000, 1000, 1000, window=60)
+
+    chunks = mapped_chunks(write_file(tmp_path, content), sizer)
+    chunks = [bytes(chunk) for chunk in chunks]
+
+    assert [len(chunk) for chunk in chunks] == [1000, 1000, 500]
+    assert b"".join(chunks) == content
+    assert staging._learned_size == 1000
+
+
+def test_empty_file_has_no_chunks(tmp_path):
+    assert list(mapped_chunks(write_file(tmp_path, b""))) == []
+
+
+def test_sizer_doubles_until_throughput_drops():
+    sizer = ChunkSizer(100, 25, 1000, window=1)
+
+    sizer.record(100, 1)
+    assert sizer.size == 200
+    sizer.record(400, 1)
+    assert sizer.size == 400
+    # Slower than the last window: turn around
+    sizer.record(200, 1)
+    assert sizer.size == 200
+    # Within the window nothing changes
+    sizer.record(1000, 0.5)
+    assert sizer.size == 200
+
+
+def test_sizer_turns_around_at_its_limits():
+    sizer = ChunkSizer(5000, 25, 1000, window=1)
+    assert sizer.size == 1000
+
+    sizer.record(100, 1)
+
+    assert sizer.size == 1000
+    sizer.record(200, 1)
+    assert sizer.size == 500
+
+
+def test_next_staging_starts_from_the_learned_size(context, tmp_path):
+    path = write_file(tmp_path, os.urandom(10))
+    staging._learned_size = context.config["STAGE_CHUNK_SIZE_MIN"] * 2
+
+    assert staging.get_sizer().size == context.config["STAGE_CHUNK_SIZE_MIN"] * 2
+    staging._learned_size = context.config["STAGE_CHUNK_SIZE_MAX"] * 2
+    assert staging.get_sizer().size == context.config["STAGE_CHUNK_SIZE_MAX"]
+    list(mapped_chunks(path, ChunkSizer(4, 4, 4)))
+    assert staging.get_sizer().size == context.config["STAGE_CHUNK_SIZE_MIN"]
+
+
+def test_mapped_file_is_staged_whole(context, powergate, tmp_path):
+    content = os.urandom(3 * 1024 * 1024 + 17)
+    ffs = get_default_ffs()
+    sizer = ChunkSizer(1024 * 1024, 1024 * 1024, 1024 * 1024, window=60)
+
+    staged = stage_chunks(
+        get_shared_powergate(node_of(ffs)),
+        mapped_chunks(write_file(tmp_path, content), sizer),
+        ffs.token,
+    )
+
+    assert staged.cid == "bafk" + hashlib.sha256(content).hexdigest()[:55]
+    assert powergate.file_size(staged.cid) == len(content)
@@ -0,0 +1,66 @@
+import os
+import subprocess
+import sys
+from click.testing import CliRunner
+from pygate import create_app
+from pygate.cli import get_version, main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LOADED = """
+import sys
+{}
+print(" ".join(sorted(name for name in ("flask", "grpc", "pygate_grpc")
+                      if name in sys.modules)))
+"""
+
+
+def loaded_modules(code):
+    """
+    Run `code` in a fresh interpreter and return which of Flask and the gRPC
+    modules it imported, from the last line it prints
+    """
+
+    result = subprocess.run(
+        [sys.executable, "-c", LOADED.format(code)],
+        cwd=ROOT,
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+
+    return result.stdout.decode().splitlines()[-1].split()
+
+
+def test_importing_the_package_builds_nothing():
+    assert loaded_modules("import pygate") == []
+
+
+def test_app_is_built_without_grpc():
+    assert loaded_modules("import pygate; pygate.create_app()") == ["flask"]
+
+
+def test_create_app_returns_the_shared_app(app):
+    import pygate
+
+    assert create_app() is app
+    assert pygate.app is app
+    assert "pygate.api_job" in app.view_functions
+
+
+def test_version_is_printed_without_loading_the_app():
+    code = (
+        "from pygate.cli import main\n"
+        "try:\n"
+        "    main(['--version'])\n"
+        "except SystemExit:\n"
+        "    pass"
+    )
+
+    assert loaded_modules(code) == []
+
+
+def test_version_option():
+    result = CliRunner().invoke(main, ["--version"])
+
+    assert result.exit_code == 0
+    assert result.output == "pygate-webapp, version {}\n".format(get_version())
@@ -0,0 +1,175 @@
+import io
+import json
+import os
+import threading
+import time
+import pytest
+from werkzeug.datastructures import FileStorage
+from pygate import jobs
+from pygate.jobs import UploadSpace
+from pygate.eventlog import flush
+from pygate.models import FfsUsage, Files, Jobs, Logs
+
+JSON = {"Accept": "application/json"}
+
+
+def post_files(client, *files, **fields):
+    data = dict(fields)
+    data["uploadfile"] = [(io.BytesIO(content), name) for name, content in files]
+
+    return client.post("/files", data=data, headers=JSON)
+
+
+def test_uploads_are_pushed_as_a_batch(client, wait_until):
+    response = post_files(client, ("first.txt", b"first"), ("second.txt", b"2nd"))
+
+    assert response.status_code == 202
+    body = response.get_json()
+    assert [job["file_name"] for job in body["jobs"]] == ["first.txt", "second.txt"]
+    progress_url = "/api/uploads/{}".format(body["batch_id"])
+    progress = wait_until(
+        lambda: client.get(progress_url).get_json()["finished"]
+        and client.get(progress_url).get_json()
+    )
+    assert [job["status"] for job in progress["jobs"]] == [jobs.DONE, jobs.DONE]
+    assert [job["bytes_staged"] for job in progress["jobs"]] == [5, 3]
+    assert Files.query.count() == 2
+
+
+def test_each_pushed_file_is_recorded_with_its_log_entry(
+    client, monkeypatch, wait_until
+):
+    stage_upload = jobs.stage_upload
+
+    def fail_broken(upload_path, file_name, *args, **kwargs):
+        if file_name == "broken.txt":
+            raise RuntimeError("staging failed")
+        return stage_upload(upload_path, file_name, *args, **kwargs)
+
+    monkeypatch.setattr(jobs, "stage_upload", fail_broken)
+
+    body = post_files(client, ("good.txt", b"good"), ("broken.txt", b"bad")).get_json()
+    progress_url = "/api/uploads/{}".format(body["batch_id"])
+    progress = wait_until(
+        lambda: client.get(progress_url).get_json()["finished"]
+        and client.get(progress_url).get_json()
+    )
+
+    # The pushed file is recorded although another file of its batch failed
+    assert [job["status"] for job in progress["jobs"]] == [jobs.DONE, jobs.FAILED]
+    assert [f.file_name for f in Files.query] == ["good.txt"]
+    flush()
+    assert Logs.query.filter(Logs.event.like("Uploaded good.txt%")).count() == 1
+    assert FfsUsage.query.one().files == 1
+
+
+def test_uploads_over_the_pending_space_are_turned_away(
+    client, monkeypatch, wait_until
+):
+    monkeypatch.setattr(jobs, "_space", UploadSpace(4))
+    monkeypatch.setitem(client.application.config, "UPLOAD_SPACE_WAIT", 0)
+    jobs._space.reserve(1)
+
+    response = post_files(client, ("small.txt", b"abc"), ("large.txt", b"large"))
+
+    body = response.get_json()
+    assert [job["file_name"] for job in body["jobs"]] == ["small.txt"]
+    assert body["skipped"] == ["large.txt"]
+    wait_until(lambda: jobs._space.used == 1)
+
+
+def test_batch_does_not_wait_for_its_own_space(client, monkeypatch, wait_until):
+    monkeypatch.setattr(jobs, "_space", UploadSpace(4))
+    monkeypatch.setitem(client.application.config, "UPLOAD_SPACE_WAIT", 2)
+
+    started = time.monotonic()
+    response = post_files(client, ("first.txt", b"abc"), ("second.txt", b"def"))
+
+    assert time.monotonic() - started < 1
+    body = response.get_json()
+    assert [job["file_name"] for job in body["jobs"]] == ["first.txt"]
+    assert body["skipped"] == ["second.txt"]
+    wait_until(lambda: jobs._space.used == 0)
+
+
+def test_failed_save_gives_up_the_whole_batch(context, monkeypatch):
+    monkeypatch.setattr(jobs, "_space", UploadSpace(100))
+    directories = []
+    new_upload_directory = jobs.new_upload_directory
+    save_upload = jobs.save_upload
+
+    def new_directory(upload_path):
+        directories.append(new_upload_directory(upload_path))
+        return directories[-1]
+
+    def fail_second(upload, directory, file_name):
+        if len(directories) == 2:
+            raise OSError("disk full")
+        return save_upload(upload, directory, file_name)
+
+    monkeypatch.setattr(jobs, "new_upload_directory", new_directory)
+    monkeypatch.setattr(jobs, "save_upload", fail_second)
+    uploads = [
+        FileStorage(io.BytesIO(b"first"), filename="first.txt"),
+        FileStorage(io.BytesIO(b"second"), filename="second.txt"),
+    ]
+
+    with pytest.raises(OSError):
+        jobs.submit_uploads(uploads, context.config["UPLOADDIR"])
+
+    assert jobs._space.used == 0
+    assert len(directories) == 2
+    assert not any(os.path.exists(directory) for directory in directories)
+    assert Jobs.query.count() == 0
+
+
+def test_package_is_pushed_inline(client):
+    response = post_files(
+        client,
+        ("first.txt", b"first"),
+        ("second.txt", b"second"),
+        make_package="y",
+        package_name="bundle",
+    )
+
+    body = response.get_json()
+    assert [(job["file_name"], job["status"]) for job in body["jobs"]] == [
+        ("bundle.tar.gz", jobs.DONE)
+    ]
+
+
+def test_job_events_end_when_the_job_is_done(client):
+    body = post_files(client, ("file.txt", b"content")).get_json()
+
+    response = client.get("/api/jobs/{}/events".format(body["jobs"][0]["id"]))
+
+    events = [
+        json.loads(line[len("data: ") :])
+        for line in response.data.decode().splitlines()
+        if line.startswith("data: ")
+    ]
+    assert events[-1]["status"] == jobs.DONE
+    assert all(event["status"] != jobs.FAILED for event in events)
+
+
+def test_unknown_batch_is_not_found(client):
+    assert client.get("/api/uploads/unknown").status_code == 404
+    assert client.get("/api/jobs/12345").status_code == 404
+
+
+def test_upload_space_waits_for_released_space():
+    space = UploadSpace(10)
+    assert space.reserve(8)
+
+    assert not space.reserve(5, timeout=0.05)
+    threading.Timer(0.05, space.release, [8]).start()
+    assert space.reserve(5, timeout=5)
+    assert space.used == 5
+
+
+@pytest.mark.parametrize("used, allowed", [(0, True), (1, False)])
+def test_upload_larger_than_the_space_goes_alone(used, allowed):
+    space = UploadSpace(10)
+    space.reserve(used)
+
+    assert space.reserve(20, timeout=0) is allowed
@@ -0,0 +1,87 @@
+from datetime import datetime
+import pytest
+from pygate import db
+from pygate.helpers import get_default_ffs
+from pygate.models import Files
+from pygate.powergate import get_pool, node_of
+from pygate.watcher import FailedStream, JobStream, QUEUED, SUCCESS, _watch
+
+
+@pytest.fixture
+def ffs_key(context):
+    ffs = get_default_ffs()
+
+    return node_of(ffs), ffs.token
+
+
+@pytest.fixture
+def streams():
+    opened = []
+
+    yield opened
+
+    for stream in opened:
+        stream.cancel()
+
+
+def add_pushed_file(job_id):
+    file_upload = Files(
+        file_path=None,
+        file_name=job_id + ".txt",
+        upload_date=datetime.now().replace(microsecond=0),
+        file_size=1,
+        CID="bafk" + job_id,
+        ffs_id=get_default_ffs().id,
+        storage_job_id=job_id,
+        storage_status=QUEUED,
+    )
+    db.session.add(file_upload)
+    db.session.commit()
+
+
+def test_watched_jobs_are_recorded(ffs_key, streams, wait_until):
+    add_pushed_file("job-1")
+
+    streams.extend(_watch(ffs_key, {"job-1"}, []))
+
+    assert [stream.job_ids for stream in streams] == [{"job-1"}]
+    wait_until(
+        lambda: Files.query.filter_by(storage_job_id="job-1").one().storage_status
+        == SUCCESS
+    )
+
+
+def test_streams_are_opened_for_new_jobs_only(ffs_key, streams):
+    first = _watch(ffs_key, {"job-1"}, [])
+    streams.extend(first)
+
+    second = _watch(ffs_key, {"job-1", "job-2"}, first)
+    streams.extend(second[1:])
+
+    assert second[0] is first[0]
+    assert [stream.job_ids for stream in second] == [{"job-1"}, {"job-2"}]
+    assert all(isinstance(stream, JobStream) for stream in second)
+
+
+def test_streams_of_finished_jobs_are_closed(ffs_key, streams):
+    opened = _watch(ffs_key, {"job-1"}, [])
+    opened = _watch(ffs_key, {"job-1", "job-2"}, opened)
+    streams.extend(opened)
+
+    kept = _watch(ffs_key, {"job-2"}, opened)
+
+    assert kept == opened[1:]
+    assert opened[0]._call.cancelled()
+
+
+def test_jobs_of_failed_streams_are_polled_and_watched_again(ffs_key, streams):
+    calls = get_pool(ffs_key[0]).stats()["calls"]
+    polls = calls.get("ffs.show_all", {}).get("calls", 0)
+
+    kept = _watch(ffs_key, {"job-1"}, [FailedStream({"job-1"})])
+    streams.extend(kept)
+
+    calls = get_pool(ffs_key[0]).stats()["calls"]
+    assert calls["ffs.show_all"]["calls"] == polls + 1
+    assert [stream.job_ids for stream in kept] == [{"job-1"}]
+    assert isinstance(kept[0], JobStream)
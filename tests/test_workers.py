@@ -0,0 +1,71 @@
+import socket
+import subprocess
+import sys
+import pytest
+from pygate import db, workers
+from pygate.workers import is_primary_worker, worker_alive, worker_id
+
+fcntl = pytest.importorskip("fcntl")
+
+TRY_LOCK = """
+import fcntl, sys
+with open(sys.argv[1], "a") as lock_file:
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        sys.exit(1)
+"""
+
+
+def exited_worker():
+    process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(0.5)"])
+    worker = "{}:{}:{}".format(
+        socket.gethostname(), process.pid, workers._start_time(process.pid)
+    )
+    process.wait()
+
+    return worker
+
+
+def test_this_worker_is_alive():
+    assert worker_alive(worker_id())
+
+
+def test_exited_worker_is_not_alive():
+    assert not worker_alive(exited_worker())
+
+
+def test_reused_pid_is_not_the_same_worker():
+    host, pid, started = worker_id().split(":")
+
+    assert not worker_alive("{}:{}:{}".format(host, pid, int(started) - 1))
+
+
+def test_workers_of_other_hosts_are_assumed_alive():
+    assert worker_alive("elsewhere.example:1:1")
+
+
+def test_one_process_is_the_primary_worker(context, tmp_path, monkeypatch):
+    lock_path = str(tmp_path / "pygate.lock")
+    monkeypatch.setitem(context.config, "WORKER_LOCK_FILE", lock_path)
+    monkeypatch.setattr(workers, "_lock_file", None)
+
+    def other_process_takes_lock():
+        return subprocess.run([sys.executable, "-c", TRY_LOCK, lock_path]).returncode
+
+    assert is_primary_worker()
+    assert is_primary_worker()
+    assert other_process_takes_lock() == 1
+
+    workers._lock_file.close()
+    assert other_process_takes_lock() == 0
+
+
+def test_sqlite_connections_use_write_ahead_logging(context):
+    if db.engine.dialect.name != "sqlite":
+        pytest.skip("SQLite only")
+
+    assert db.session.execute("PRAGMA journal_mode").scalar() == "wal"
+    assert db.session.execute("PRAGMA busy_timeout").scalar() == int(
+        context.config["SQLITE_BUSY_TIMEOUT"] * 1000
+    )